@@ -44,15 +44,29 @@
 # default setting replaces the target name with the URL filename)
 
 
-import urllib2, urlparse
+import urlparse
 import SCons.Builder, SCons.Node, SCons.Errors
+import urlcache
+import perftrace
 
 
 # define an own node, for checking the data behind the URL,
 # we must download only than, if the data is changed, the
 # node derivates from the Python.Value node
+# The data behind the URL is fetched with a conditional GET through the download
+# cache (see urlcache.py) that is attached to the node by the emitter. When the data
+# was not changed since the last build, the server answers with "304 Not Modified"
+# and the signature is taken from the validators stored in the cache.
+# When "URLDOWNLOAD_OFFLINE" is set no requests are made at all: the signature is
+# taken from the validators of the last download and the file is copied from the
+# cache, so checking whether a node is up to date never touches the network
+# The first URLNode that is checked prefetches all URLs registered with the cache
+# concurrently, so the remaining URLNodes find their data already fetched
 class URLNode(SCons.Node.Python.Value) :
 
+    urldownload_prefetch = False
+    urldownload_workers = 8
+
     # overload the get_csig (copy the source from the
     # Python.Value node and append the data of the URL header
     def get_csig(self, calc=None):
@@ -62,23 +76,30 @@ class URLNode(SCons.Node.Python.Value) :
             pass
 
         try :
-            response = urllib2.urlopen( str(self.value) ).info()
+            cache = _get_cache(self)
+            if self.urldownload_prefetch :
+                cache.prefetch_registered( self.urldownload_workers )
+            record = cache.fetch( str(self.value) )
         except Exception, e :
             raise SCons.Errors.StopError( "%s [%s]" % (e, self.value) )
 
-        contents = ""
-        if "Last-Modified" in response :
-            contents = contents + response["Last-Modified"]
-        if "Content-Length" in response :
-            contents = contents + response["Content-Length"]
-        if "ETag" in response :
-            contents = contents + response["ETag"]
+        perftrace.count( "urldownload.miss" if record.get("modified") else "urldownload.hit" )
+        contents = urlcache.signature(record)
         if not contents :
             contents = self.get_contents()
         self.get_ninfo().csig = contents
         return contents
 
 
+# returns the download cache of a node, the cache is set by the emitter
+# @param node URLNode
+def _get_cache( node ) :
+    try :
+        return node.urldownload_cache
+    except AttributeError :
+        return urlcache.get_cache( SCons.Node.FS.get_default_fs().Dir("#.scons-cache/urldownload").abspath )
+
+
 
 # creates the downloading output message
 # @param s original message
@@ -92,32 +113,43 @@ def __message( s, target, source, env ) :
         print s
 
 
-# the download function, which reads the data from the URL
-# and writes it down to the file
+# the download function, which copies the data of the URL
+# from the download cache to the file. The data is only downloaded
+# when it was not already fetched by get_csig
 # @param target target file on the local drive
 # @param source URL for download
 # @@param env environment object
 def __action( target, source, env ) :
     try :
-        stream = urllib2.urlopen( str(source[0]) )
-        file   = open( str(target[0]), "wb" )
-        file.write(stream.read())
-        file.close()
-        stream.close()
+        cache = _get_cache(source[0])
+        cache.fetch( str(source[0]) )
+        cache.copy_body( str(source[0]), str(target[0]) )
     except Exception, e :
         raise SCons.Errors.StopError( "%s [%s]" % (e, source[0]) )
 
 
-# defines the emitter of the builder
+# defines the emitter of the builder, the emitter attaches the
+# download cache to the URLNode
 # @param target target file on the local drive
 # @param source URL for download
 # @param env environment object
 def __emitter( target, source, env ) :
+    cache = urlcache.get_cache( env.Dir(env.subst("$URLDOWNLOAD_CACHEDIR")).abspath, int(env["URLDOWNLOAD_HOSTCONNECTIONS"]), float(env["URLDOWNLOAD_TIMEOUT"]) or None )
+    cache.register( str(source[0]) )
+    if env["URLDOWNLOAD_OFFLINE"] :
+        cache.offline = True
+    source[0].urldownload_cache = cache
+    source[0].urldownload_prefetch = env["URLDOWNLOAD_PREFETCH"]
+    source[0].urldownload_workers = int(env["URLDOWNLOAD_WORKERS"])
+
     if not env.get("URLDOWNLOAD_USEURLFILENAME", False) :
         return target, source
 
+    # the final URL (i.e. after following redirects) is taken from the download cache,
+    # only when the URL was never downloaded before a request is made. The record
+    # of that request (and the downloaded data) is reused by get_csig and the action
     try :
-        url = urlparse.urlparse( urllib2.urlopen( str(source[0]) ).geturl() )
+        url = urlparse.urlparse( cache.final_url( str(source[0]) ) )
     except Exception, e :
         raise SCons.Errors.StopError( "%s [%s]" % (e, source[0]) )
 
@@ -128,9 +160,17 @@ def __emitter( target, source, env ) :
 
 # generate function, that adds the builder to the environment,
 # the value "DOWNLOAD_USEFILENAME" replaces the target name with
-# the filename of the URL
+# the filename of the URL, the value "URLDOWNLOAD_CACHEDIR" sets
+# the directory of the download cache. "URLDOWNLOAD_PREFETCH" enables
+# fetching all URLs concurrently, using at most "URLDOWNLOAD_WORKERS"
+# threads and "URLDOWNLOAD_HOSTCONNECTIONS" connections per host. A download fails when the
+# server does not answer within "URLDOWNLOAD_TIMEOUT" seconds (0 waits forever). "URLDOWNLOAD_OFFLINE"
+# uses the state of the last downloads instead of accessing the network
 # @param env environment object
 def generate( env ) :
+    env.SetDefault( CACHE_DIR = "#.scons-cache" )
+    env["URLDOWNLOAD_CACHEDIR"] = "${CACHE_DIR}/urldownload"
+    env.SetDefault( URLDOWNLOAD_PREFETCH = True, URLDOWNLOAD_WORKERS = 8, URLDOWNLOAD_HOSTCONNECTIONS = 2, URLDOWNLOAD_TIMEOUT = urlcache.DEFAULT_TIMEOUT, URLDOWNLOAD_OFFLINE = False )
     env["URLDOWNLOADCOMSTR"] = "downloading $SOURCE to $TARGET"
     env["BUILDERS"]["URLDownload"] = SCons.Builder.Builder( action = __action,  emitter = __emitter,  target_factory = SCons.Node.FS.File,  source_factory = URLNode,  single_source = True,  PRINT_CMD_LINE_FUNC = __message )
     env.Replace(URLDOWNLOAD_USEURLFILENAME =  True )
@@ -0,0 +1,100 @@
+# Copyright 2015 GIP RENATER
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Running the checks of tests (see the Test builder in test.py) against parsed files
+
+Each file is parsed once and its checks run concurrently against the parsed tree. Checks that modify the tree run after
+the others, one at a time. The result and the time of each check is printed.
+
+A check is a tuple (name, function, file, modifies, uses_tree): function(tree, path, target, source, env) returns None
+on success and an error message otherwise. file is the file to check, e.g. "${SOURCE}", which is substituted with
+env.subst(). A file is not parsed when none of its checks use the tree, the functions then get None.
+"""
+
+import time
+from multiprocessing.pool import ThreadPool
+
+from lxml import etree
+
+
+# Return the checks of tests (see the Test builder in test.py) that have a check
+def from_tests(tests):
+    return [ (test['name'], test['check'], test['file'], test.get('modifies', False), test.get('tree', True))
+             for test in tests if 'check' in test ]
+
+
+# Run checks
+# @param checks list of (name, function, file, modifies, uses_tree)
+# @param workers maximum number of checks that run concurrently
+# @param path optional file to check instead of the files of the checks
+# @return number of checks that failed
+def run(checks, target, source, env, workers=4, path=None):
+    # Group the checks by the file they test
+    files = []
+    grouped = {}
+    for (name, check, file, modifies, uses_tree) in checks:
+        p = path or env.subst(file, target=target, source=source)
+        if not p in grouped:
+            files.append(p)
+            grouped[p] = []
+        grouped[p].append( (name, check, modifies, uses_tree) )
+
+    failed = 0
+    for p in files:
+        failed += _run_file(grouped[p], p, target, source, env, workers)
+    return failed
+
+
+def _run_file(checks, path, target, source, env, workers):
+    tree = None
+    if any( c[3] for c in checks ):
+        start = time.time()
+        try:
+            # The files are untrusted (e.g. downloaded metadata): entities are not expanded, as in xmlsig.py
+            tree = etree.parse(path, etree.XMLParser(huge_tree=True, resolve_entities=False, no_network=True))
+        except (etree.Error, IOError), e:
+            print "  %s: FAILED, can not parse '%s': %s" % (', '.join( [ c[0] for c in checks ] ), path, e)
+            return len(checks)
+        print "  parsed %s (%.3fs)" % (path, time.time() - start)
+
+    def run_check(check):
+        (name, function, modifies, uses_tree) = check
+        start = time.time()
+        try:
+            error = function(tree, path, target, source, env)
+        except Exception, e:
+            error = "%s: %s" % (e.__class__.__name__, e)
+        return (name, error, time.time() - start)
+
+    concurrent = [ c for c in checks if not c[2] ]
+    results = []
+    if len(concurrent) > 1:
+        pool = ThreadPool(min(len(concurrent), workers))
+        try:
+            results = pool.map(run_check, concurrent)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = map(run_check, concurrent)
+    results += map(run_check, [ c for c in checks if c[2] ])
+
+    failed = 0
+    for (name, error, duration) in results:
+        if error is None:
+            print "  %s: passed (%.3fs)" % (name, duration)
+        else:
+            print "  %s: FAILED (%.3fs): %s" % (name, duration, error)
+            failed += 1
+    return failed
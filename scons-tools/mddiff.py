@@ -0,0 +1,120 @@
+# Copyright 2015 GIP RENATER
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Entity level comparison of two SAML metadata files
+
+Both files are read one EntityDescriptor at a time. For every entity the SHA-1 of its exclusive canonical XML (c14n) is
+kept, and the SHA-1 of each of its parts: the attributes of the EntityDescriptor and each child element (e.g. the
+IDPSSODescriptor, Organization or ContactPerson). The entities of the two files are joined on entityID to find the
+added, removed and changed entities, and the parts of the changed entities that differ.
+
+Memory use depends on the number of entities, not on the size of the files. Comments and formatting are ignored.
+
+This module does not depend on SCons so it can be used from scripts as well (see scripts/mddiff.py).
+"""
+
+import hashlib
+
+from lxml import etree
+
+import samlmd
+
+
+# Return the entities in a metadata file
+# When an entityID occurs more than once, the first entity is used
+# @return dict of entityID => (hash of the entity, dict of part name => hash of the part)
+def summarize(path):
+    entities = {}
+    for e in samlmd.iterentities(path):
+        entity_id = e.get('entityID')
+        if entity_id in entities:
+            continue
+        entities[entity_id] = (_hash(e), _parts(e))
+    return entities
+
+
+def _hash(e):
+    return hashlib.sha1(etree.tostring(e, method='c14n', exclusive=True, with_comments=False)).hexdigest()
+
+
+# Return dict of part name => hash for the attributes and child elements of an entity
+# Repeated child elements are numbered, e.g. "ContactPerson[2]"
+def _parts(e):
+    parts = {'@attributes': hashlib.sha1(repr(sorted(e.attrib.items()))).hexdigest()}
+    counts = {}
+    for child in e:
+        if not isinstance(child.tag, basestring):
+            continue    # Comment or processing instruction
+        name = etree.QName(child).localname
+        counts[name] = counts.get(name, 0) + 1
+        if counts[name] > 1:
+            name = '%s[%d]' % (name, counts[name])
+        parts[name] = _hash(child)
+    return parts
+
+
+class Diff(object):
+
+    # @param old summary (see summarize()) of the old file
+    # @param new summary of the new file
+    def __init__(self, old, new):
+        self.old_count = len(old)
+        self.new_count = len(new)
+        self.added = sorted( e for e in new if e not in old )
+        self.removed = sorted( e for e in old if e not in new )
+        # list of (entityID, list of names of the parts that changed)
+        self.changed = []
+        for e in sorted( e for e in new if e in old and old[e][0] != new[e][0] ):
+            (old_parts, new_parts) = (old[e][1], new[e][1])
+            names = set(old_parts.keys()) | set(new_parts.keys())
+            self.changed.append( (e, sorted( n for n in names if old_parts.get(n) != new_parts.get(n) )) )
+
+    def same(self):
+        return not (self.added or self.removed or self.changed)
+
+    # Percentage of the entities of the old file that is not in the new file
+    def removed_percentage(self):
+        if not self.old_count:
+            return 0.0
+        return 100.0 * len(self.removed) / self.old_count
+
+    # Percentage of the entities of the old file that changed
+    def changed_percentage(self):
+        if not self.old_count:
+            return 0.0
+        return 100.0 * len(self.changed) / self.old_count
+
+    # Return a report of the differences as list of lines
+    # @param limit maximum number of entityIDs listed for added, removed and changed entities
+    def report(self, limit=30):
+        lines = ['%d entities before, %d after: %d added, %d removed (%.1f%%), %d changed' %
+                 (self.old_count, self.new_count, len(self.added), len(self.removed), self.removed_percentage(),
+                  len(self.changed))]
+        for (title, items) in (('added', [ (e, None) for e in self.added ]),
+                               ('removed', [ (e, None) for e in self.removed ]),
+                               ('changed', self.changed)):
+            if not items:
+                continue
+            lines.append('%s:' % title)
+            for (e, parts) in items[:limit]:
+                lines.append('  %s%s' % (e, ': ' + ', '.join(parts) if parts else ''))
+            if len(items) > limit:
+                lines.append('  ... and %d more' % (len(items) - limit))
+        return lines
+
+
+# Compare two metadata files
+# @return Diff
+def diff(old_path, new_path):
+    return Diff(summarize(old_path), summarize(new_path))
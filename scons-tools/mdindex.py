@@ -0,0 +1,437 @@
+# Copyright 2015 GIP RENATER
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Persistent per-entity index of SAML metadata files
+
+For a metadata file the index lists, in document order, for every EntityDescriptor:
+- the entityID;
+- the SHA-1 of the exclusive canonical XML (c14n) of the EntityDescriptor. This changes only when the entity changes,
+  not when e.g. the formatting of the file or another entity changes;
+- the byte range of the EntityDescriptor in the file, so the (unchanged) entity can be copied from the file without
+  parsing it;
+- the attributes of the entity that are commonly used to select entities: its child elements (e.g. the role
+  descriptors), registrationAuthority and entity attributes (e.g. entity categories). lookup() returns the entities
+  with an attribute, see mdquery.py for select expressions that are answered with it.
+
+An IndexStore keeps the indexes in a directory:
+- <key>.json: the index of a file with content key <key> (e.g. the SCons content signature of the file);
+- path-<sha1 of the path>: the key of the last index of the file at that path. Used to report the entities that were
+  added, removed or changed since the previous build.
+The store also keeps the result of select expressions per entity hash (see select_results()), so the expressions only
+need to be evaluated for new and changed entities. When the index of a file is replaced, the results of the entities
+that are not in any current index are removed.
+
+This module does not depend on SCons so it can be used from scripts as well.
+"""
+
+import os
+import re
+import json
+import mmap
+import hashlib
+import threading
+from xml.sax.saxutils import unescape
+
+from lxml import etree
+
+import samlmd
+from urlcache import AtomicFile
+
+
+INDEX_VERSION = 2
+
+# Prefixes of the attributes of an entity in an index
+CHILD = 'child\n'                                   # + {namespace}name of a child element
+REGISTRATION_AUTHORITY = 'registrationAuthority\n'  # + registrationAuthority
+ENTITY_ATTRIBUTE = 'entityAttribute\n'              # + Name + '\n' + string value of an AttributeValue
+
+# Start or end tag of an EntityDescriptor
+_tag_re = re.compile(r'<(/?)(?:[\w.-]+:)?EntityDescriptor(?=[\s/>])')
+_entity_id_re = re.compile(r'''\sentityID\s*=\s*(?:"([^"]*)"|'([^']*)')''')
+_xmlns_re = re.compile(r'''\sxmlns(?::([\w.-]+))?\s*=''')
+
+
+# An EntityDescriptor in an index
+# start and end are None when the index has no byte ranges
+# attributes are the positions of the attributes of the entity in Index.attributes
+class Entry(object):
+
+    __slots__ = ('entity_id', 'hash', 'start', 'end', 'ns', 'attributes')
+
+    def __init__(self, entity_id, hash, start=None, end=None, ns=0, attributes=()):
+        self.entity_id = entity_id
+        self.hash = hash
+        self.start = start
+        self.end = end
+        self.ns = ns
+        self.attributes = attributes
+
+
+class Index(object):
+
+    # @param entries list of Entry objects in document order
+    # @param nsmaps list of dicts of the namespaces in scope of the parent of an entity, indexed by Entry.ns
+    # @param ranges True when the byte ranges of the entries can be used to copy entities from the file
+    # @param attributes list of the attributes of the entries, indexed by the positions in Entry.attributes
+    def __init__(self, entries, nsmaps, ranges, attributes=()):
+        self.entries = entries
+        self.nsmaps = nsmaps
+        self.ranges = ranges
+        self.attributes = attributes
+        self.entities = {}      # entityID => first Entry with that entityID
+        for entry in reversed(entries):
+            self.entities[entry.entity_id] = entry
+        self._postings = {}     # attribute => list of the positions of the entries with the attribute
+        for (i, entry) in enumerate(entries):
+            for a in entry.attributes:
+                self._postings.setdefault(attributes[a], []).append(i)
+
+    # Return the positions (in entries) of the entries that have an attribute, e.g. CHILD + '{...}IDPSSODescriptor'
+    def lookup(self, attribute):
+        return self._postings.get(attribute, ())
+
+    # Make the index of a metadata file
+    # @param path name of the metadata file
+    @classmethod
+    def build(cls, path):
+        entries = []
+        nsmaps = []
+        attributes = {}     # attribute => position in the attribute list
+        info = None
+        for e in samlmd.iterentities(path):
+            if info is None:
+                info = e.getroottree().docinfo
+            parent = e.getparent()
+            nsmap = dict(parent.nsmap) if parent is not None else {}
+            if nsmap not in nsmaps:
+                nsmaps.append(nsmap)
+            c14n = etree.tostring(e, method='c14n', exclusive=True, with_comments=False)
+            entries.append(Entry(e.get('entityID'), hashlib.sha1(c14n).hexdigest(), ns=nsmaps.index(nsmap),
+                                 attributes=sorted( attributes.setdefault(a, len(attributes))
+                                                    for a in entity_attributes(e) )))
+
+        # Entities can only be copied from UTF-8 encoded files, without DTD (entity references), and when the byte
+        # ranges found by scanning for the tags match the entities found by the parser
+        ranges = (info is None or ((info.encoding or 'UTF-8').upper() in ('UTF-8', 'UTF8') and not info.doctype)) \
+                 and _scan_ranges(path, entries)
+        if not ranges:
+            for entry in entries:
+                entry.start = entry.end = None
+        return cls(entries, nsmaps, ranges, sorted(attributes, key=attributes.get))
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            data = json.load(f)
+        if data.get('version') != INDEX_VERSION:
+            raise ValueError('Unsupported index version')
+        nsmaps = [ dict( (None if p == '' else p, uri) for (p, uri) in nsmap.items() ) for nsmap in data['nsmaps'] ]
+        entries = [ Entry(*e) for e in data['entities'] ]
+        return cls(entries, nsmaps, data['ranges'], data['attributes'])
+
+    def save(self, path):
+        data = {
+            'version': INDEX_VERSION,
+            'ranges': self.ranges,
+            # JSON keys must be strings, the default namespace is stored with prefix ''
+            'nsmaps': [ dict( ('' if p is None else p, uri) for (p, uri) in nsmap.items() ) for nsmap in self.nsmaps ],
+            'attributes': self.attributes,
+            'entities': [ [e.entity_id, e.hash, e.start, e.end, e.ns, e.attributes] for e in self.entries ],
+        }
+        with AtomicFile(path) as f:
+            json.dump(data, f, separators=(',', ':'))
+
+    # Return the serialized EntityDescriptor of entry, copied from the indexed file
+    # Namespace declarations that the entity inherits in the indexed file, and that are not in nsmap, are added to
+    # the EntityDescriptor. The result can be written below a root element that declares the namespaces in nsmap.
+    # @param data content of the indexed file (string or mmap)
+    # @param entry Entry of this index
+    # @param nsmap namespaces declared on the root element of the output
+    def fragment(self, data, entry, nsmap=samlmd.ROOT_NSMAP):
+        if not self.ranges:
+            raise ValueError('Index has no byte ranges')
+        fragment = data[entry.start:entry.end]
+        inherited = self.nsmaps[entry.ns]
+        if all( nsmap.get(p) == uri for (p, uri) in inherited.items() ):
+            return fragment
+        name_end = _tag_re.match(fragment).end()
+        start_tag = fragment[:fragment.index('>')]
+        declared = set( m.group(1) for m in _xmlns_re.finditer(start_tag) )
+        decls = u''.join( u' %s="%s"' % (u'xmlns:' + p if p else u'xmlns', _escape(uri))
+                          for (p, uri) in sorted(inherited.items()) if nsmap.get(p) != uri and p not in declared )
+        decls = decls.encode('utf-8')
+        return fragment[:name_end] + decls + fragment[name_end:]
+
+    # Return a new document with the EntityDescriptor of entry as root element, parsed from its fragment
+    def parse(self, data, entry):
+        parser = etree.XMLParser(remove_comments=True, huge_tree=True, resolve_entities=False, no_network=True)
+        return etree.ElementTree(etree.fromstring(self.fragment(data, entry, {}), parser))
+
+
+# Return the set of the attributes of an EntityDescriptor element (see CHILD, REGISTRATION_AUTHORITY and
+# ENTITY_ATTRIBUTE)
+def entity_attributes(e):
+    attributes = set()
+    for child in e:
+        if isinstance(child.tag, basestring):
+            attributes.add(CHILD + child.tag)
+    for info in e.iterfind('md:Extensions/mdrpi:RegistrationInfo', samlmd.NS):
+        if info.get('registrationAuthority') is not None:
+            attributes.add(REGISTRATION_AUTHORITY + info.get('registrationAuthority'))
+    for attribute in e.iterfind('md:Extensions/mdattr:EntityAttributes/saml:Attribute', samlmd.NS):
+        if attribute.get('Name') is None:
+            continue
+        for value in attribute.iterfind('saml:AttributeValue', samlmd.NS):
+            attributes.add(ENTITY_ATTRIBUTE + attribute.get('Name') + '\n' + value.xpath('string()'))
+    return attributes
+
+
+# Find the byte ranges of the EntityDescriptor elements in a file and store them in entries
+# @return True when the ranges match the entries, i.e. the same number of entities with the same entityIDs
+def _scan_ranges(path, entries):
+    if not entries:
+        return True
+    with open(path, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            i = 0
+            start = None
+            for m in _tag_re.finditer(data):
+                if not m.group(1):
+                    if start is not None:
+                        return False    # Nested EntityDescriptor, e.g. in a comment
+                    tag_end = data.find('>', m.end())
+                    if tag_end < 0:
+                        return False
+                    start_tag = data[m.start():tag_end]
+                    if i >= len(entries) or _tag_entity_id(start_tag) != entries[i].entity_id:
+                        return False
+                    if start_tag.endswith('/'):
+                        entries[i].start, entries[i].end = m.start(), tag_end + 1
+                        i += 1
+                    else:
+                        start = m.start()
+                else:
+                    if start is None:
+                        return False
+                    tag_end = data.find('>', m.end())
+                    if tag_end < 0:
+                        return False
+                    entries[i].start, entries[i].end = start, tag_end + 1
+                    start = None
+                    i += 1
+            return i == len(entries) and start is None
+        finally:
+            data.close()
+
+
+def _tag_entity_id(start_tag):
+    m = _entity_id_re.search(start_tag)
+    if not m:
+        return None
+    value = m.group(1) if m.group(1) is not None else m.group(2)
+    return unescape(value, {'&quot;': '"', '&apos;': "'"}).decode('utf-8')
+
+
+def _escape(value):
+    return value.replace('&', '&amp;').replace('"', '&quot;').replace('<', '&lt;')
+
+
+# Compare two indexes
+# @return tuple of (added, removed, changed) lists of entityIDs
+def changes(old, new):
+    added = [ e for e in new.entities if e not in old.entities ]
+    removed = [ e for e in old.entities if e not in new.entities ]
+    changed = [ e for e in new.entities if e in old.entities and old.entities[e].hash != new.entities[e].hash ]
+    return (sorted(added), sorted(removed), sorted(changed))
+
+
+class IndexStore(object):
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._indexes = {}      # key => Index
+        self._results = {}      # select expression => { entity hash => bool }
+        self._locks = {}        # key => lock, so a file is only indexed by one thread at a time
+        self._lock = threading.Lock()
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _key_lock(self, key):
+        with self._lock:
+            return self._locks.setdefault(key, threading.Lock())
+
+    def _makedirs(self):
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:
+                if not os.path.isdir(self.directory):
+                    raise
+
+    # Return the Index of a metadata file
+    # The index is loaded from the store, or made and stored when the store does not have it.
+    # @param path name of the metadata file
+    # @param key content key of the file (e.g. a hash of the content). When None the SHA-1 of the file is used
+    def get(self, path, key=None):
+        if key is None:
+            key = samlmd.file_sha1(path)
+        with self._key_lock(key):
+            if key not in self._indexes:
+                index = None
+                try:
+                    index = Index.load(self._path(key + '.json'))
+                except (IOError, ValueError, KeyError, TypeError):
+                    pass
+                if index is None:
+                    index = Index.build(path)
+                    self._makedirs()
+                    index.save(self._path(key + '.json'))
+                self._indexes[key] = index
+            return self._indexes[key]
+
+    # Record index key as the current one of the file at path
+    # @return tuple of (added, removed, changed) lists of entityIDs compared to the previously recorded index of the
+    #         file, or None when there is no previous index or the content did not change
+    def update(self, path, key):
+        pointer = self._path('path-' + hashlib.sha1(os.path.abspath(path)).hexdigest())
+        with self._lock:
+            try:
+                with open(pointer, 'r') as f:
+                    previous = f.read().strip()
+            except IOError:
+                previous = None
+            if previous == key:
+                return None
+            self._makedirs()
+            with AtomicFile(pointer) as f:
+                f.write(key)
+        if previous is None:
+            return None
+        index = self.get(path, key)
+        try:
+            old = Index.load(self._path(previous + '.json'))
+        except (IOError, ValueError, KeyError, TypeError):
+            old = None
+        # The previous index is not needed anymore, unless another file has the same content (an index is made again
+        # when the content reappears)
+        with self._lock:
+            keys = self._current_keys()
+            if keys is not None and previous not in keys:
+                try:
+                    os.remove(self._path(previous + '.json'))
+                except OSError:
+                    pass
+        self._prune_select_results()
+        return changes(old, index) if old is not None else None
+
+    # Remove the stored select results of the entities that are not in the current index of any file (see update())
+    # Without this the results of every version of every entity would be kept. Nothing is removed when one of the
+    # current indexes can not be loaded, e.g. while it is made by another thread.
+    def _prune_select_results(self):
+        with self._lock:
+            keys = self._current_keys()
+            if keys is None:
+                return
+            live = set()
+            for key in keys:
+                try:
+                    index = self._indexes.get(key) or Index.load(self._path(key + '.json'))
+                except (IOError, ValueError, KeyError, TypeError):
+                    return
+                live.update( e.hash for e in index.entries )
+            names = os.listdir(self.directory)
+            expressions = dict( (os.path.basename(self._select_path(e)), e) for e in self._results )
+            for name in names:
+                if not (name.startswith('select-') and name.endswith('.json')):
+                    continue
+                expression = expressions.get(name)
+                if expression is not None:
+                    stored = self._results[expression]
+                else:
+                    try:
+                        with open(self._path(name), 'rb') as f:
+                            stored = json.load(f)
+                    except (IOError, ValueError):
+                        continue
+                pruned = dict( (h, r) for (h, r) in stored.items() if h in live )
+                if len(pruned) == len(stored):
+                    continue
+                # Replaced, not changed: the dict returned by select_results() may be in use
+                if expression is not None:
+                    self._results[expression] = pruned
+                if pruned:
+                    with AtomicFile(self._path(name)) as f:
+                        f.write(json.dumps(pruned, separators=(',', ':')))
+                else:
+                    try:
+                        os.remove(self._path(name))
+                    except OSError:
+                        pass
+
+    # Return the stored results of a select expression: a dict of entity hash => True when selected
+    # The dict must not be changed by the caller, use add_select_results()
+    def select_results(self, expression):
+        with self._lock:
+            if expression not in self._results:
+                try:
+                    with open(self._select_path(expression), 'rb') as f:
+                        self._results[expression] = json.load(f)
+                except (IOError, ValueError):
+                    self._results[expression] = {}
+            return self._results[expression]
+
+    # Add results of a select expression and store them
+    # @param results dict of entity hash => True when selected
+    def add_select_results(self, expression, results):
+        if not results:
+            return
+        with self._lock:
+            # Replaced, not changed, as in _prune_select_results()
+            stored = dict(self._results.get(expression, {}))
+            stored.update(results)
+            self._results[expression] = stored
+            data = json.dumps(stored, separators=(',', ':'))
+            self._makedirs()
+            with AtomicFile(self._select_path(expression)) as f:
+                f.write(data)
+
+    # Return the set of the keys of the current indexes of the files (see update()), None when a key can not be read
+    # Must be called holding self._lock
+    def _current_keys(self):
+        keys = set()
+        for name in os.listdir(self.directory):
+            if name.startswith('path-'):
+                try:
+                    with open(self._path(name), 'r') as f:
+                        keys.add(f.read().strip())
+                except IOError:
+                    return None
+        return keys
+
+    def _select_path(self, expression):
+        return self._path('select-%s.json' % hashlib.sha1(expression.encode('utf-8')).hexdigest())
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+# Return the (shared) IndexStore for a directory
+def get_store(directory):
+    directory = os.path.abspath(directory)
+    with _stores_lock:
+        if directory not in _stores:
+            _stores[directory] = IndexStore(directory)
+        return _stores[directory]
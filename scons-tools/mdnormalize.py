@@ -0,0 +1,343 @@
+# Copyright 2015 GIP RENATER
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Bounded memory replacement of scripts/normalize.xslt
+
+Normalizes an EntitiesDescriptor to minimise the differences between versions of the same metadata:
+- comments are removed;
+- the EntityDescriptor elements are output ordered by registrationAuthority and entityID (entities with the same
+  keys stay in document order).
+The Extensions of the EntitiesDescriptor are copied, a Signature is left out (as normalize.xslt does). Unlike
+normalize.xslt, entities in nested EntitiesDescriptor elements are output as well.
+
+The entities are read one at a time and kept in memory with their sort keys up to a memory budget. Beyond the budget
+sorted runs are written to temporary files, which are merged in key order when the output is written.
+
+When an mdindex.IndexStore is given, the entities are copied from the file using its index and the serialized
+(comment free) fragments are kept in a FragmentCache by a hash of the bytes of the entity in the source file. Unchanged
+entities are then not parsed or serialized again. The registrationAuthority of each entity is kept in the store as
+well, like the results of select expressions.
+
+With a store the output only depends on the content of the source file, not on the content of the cache.
+
+This module does not depend on SCons so it can be used from scripts as well.
+"""
+
+import os
+import mmap
+import heapq
+import marshal
+import hashlib
+import tempfile
+import threading
+
+from lxml import etree
+
+import samlmd
+
+
+EXTENSIONS = '{%s}Extensions' % samlmd.NS['md']
+
+# Sort key of an entity, evaluated with the EntityDescriptor as context node
+REGISTRATION_AUTHORITY = 'string(md:Extensions/mdrpi:RegistrationInfo/@registrationAuthority)'
+_registration_authority = etree.XPath(REGISTRATION_AUTHORITY, namespaces=samlmd.NS)
+
+DEFAULT_MEMORY = 64 * 1024 * 1024
+
+
+# Normalize a metadata file
+# @param source file name of the metadata
+# @param output file name of the normalized metadata
+# @param store optional mdindex.IndexStore, see above
+# @param key content key of the source file for the store (see IndexStore.get())
+# @param cache optional FragmentCache for the serialized entities. Only used with a store
+# @param memory number of bytes of serialized entities that is sorted in memory
+# @return number of entities written
+def normalize(source, output, store=None, key=None, cache=None, memory=DEFAULT_MEMORY):
+    head = read_head(source)
+    if head is None:
+        raise ValueError('%s: no root element' % source)
+    if head.tag != samlmd.ENTITIES_DESCRIPTOR:
+        # A single EntityDescriptor, only the comments need to be removed
+        parser = etree.XMLParser(remove_comments=True, huge_tree=True, resolve_entities=False, no_network=True)
+        etree.parse(source, parser).write(output, encoding='UTF-8', xml_declaration=True)
+        return 1
+
+    nsmap = dict(head.nsmap)
+    normalizer = Normalizer(nsmap, store, cache, memory, os.path.dirname(os.path.abspath(output)))
+    try:
+        index = store.get(source, key) if store is not None else None
+        if index is not None and index.ranges:
+            with open(source, 'rb') as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(f.fileno()).st_size else ''
+            try:
+                for entry in index.entries:
+                    normalizer.add_indexed(data, index, entry)
+            finally:
+                if data:
+                    data.close()
+        else:
+            for e in samlmd.iterentities(source):
+                # Serialized as root element, as in add_indexed(), for the same output
+                normalizer.add(samlmd.entity_document(e).getroot())
+        with samlmd.MetadataWriter(output, dict(head.attrib), nsmap) as w:
+            for extensions in head.iterchildren(EXTENSIONS):
+                w.write(samlmd.serialize(extensions, nsmap))
+            normalizer.write(w)
+        return normalizer.count
+    finally:
+        normalizer.close()
+
+
+# Return the root element of a metadata file with the child elements before the first EntityDescriptor or
+# EntitiesDescriptor (i.e. the Signature and Extensions of an EntitiesDescriptor)
+# Only the start of the file is read. Comments are not included.
+def read_head(source):
+    root = None
+    with open(source, 'rb') as f:
+        for event, e in etree.iterparse(f, events=('start',), remove_comments=True, huge_tree=True,
+                                        resolve_entities=False, no_network=True):
+            if root is None:
+                root = e
+                if e.tag != samlmd.ENTITIES_DESCRIPTOR:
+                    break
+            elif e.getparent() is root and e.tag in (samlmd.ENTITY_DESCRIPTOR, samlmd.ENTITIES_DESCRIPTOR):
+                # The preceding siblings are complete. Remove the partially read element
+                root.remove(e)
+                break
+    return root
+
+
+def _sort_key(registration_authority, entity_id, seq):
+    # Compare the UTF-8 encoded strings, so the order is by code point as in the stylesheet
+    return ((registration_authority or u'').encode('utf-8'), (entity_id or u'').encode('utf-8'), seq)
+
+
+# Normalizes entities: entities are added one at a time, and written in the order of their registrationAuthority and
+# entityID (entities with the same keys in the order they were added)
+class Normalizer(object):
+
+    # @param nsmap namespaces declared on the EntitiesDescriptor the entities are written to
+    # @param store optional mdindex.IndexStore, for the registrationAuthority of indexed entities
+    # @param cache optional FragmentCache for the serialized indexed entities
+    # @param memory number of bytes of serialized entities that is sorted in memory
+    # @param directory directory for the temporary files of the sort
+    def __init__(self, nsmap, store=None, cache=None, memory=DEFAULT_MEMORY, directory=None):
+        self.nsmap = nsmap
+        self.store = store
+        self.cache = cache
+        self._sorter = _Sorter(memory, directory)
+        self._authorities = store.select_results(REGISTRATION_AUTHORITY) if store is not None else {}
+        self._new_authorities = {}
+
+    @property
+    def count(self):
+        return self._sorter.count
+
+    # Add a parsed entity, the root element of its own document (see samlmd.entity_document())
+    def add(self, root):
+        self._sorter.add(_sort_key(_registration_authority(root), root.get('entityID'), self._sorter.count),
+                         samlmd.serialize(root, self.nsmap))
+
+    # Add the entity of an index entry (see mdindex.py) from the data of the indexed file
+    # The serialized entity is taken from the cache, and the registrationAuthority from the store, when available
+    def add_indexed(self, data, index, entry):
+        # The fragment key includes the namespace context of the entity
+        prefix = '%s\n%s\n' % (_nsmap_key(self.nsmap), _nsmap_key(index.nsmaps[entry.ns]))
+        fragment_key = hashlib.sha1(prefix + data[entry.start:entry.end]).hexdigest()
+        fragment = self.cache.get(fragment_key) if self.cache is not None else None
+        authority = self._authorities.get(entry.hash)
+        if fragment is None or authority is None:
+            root = index.parse(data, entry).getroot()
+            if authority is None:
+                authority = self._new_authorities[entry.hash] = unicode(_registration_authority(root))
+            if fragment is None:
+                fragment = samlmd.serialize(root, self.nsmap)
+                if self.cache is not None:
+                    self.cache.put(fragment_key, fragment)
+        self._sorter.add(_sort_key(authority, entry.entity_id, self._sorter.count), fragment)
+
+    # Write the entities in order
+    # @param w samlmd.MetadataWriter
+    def write(self, w):
+        if self.store is not None and self._new_authorities:
+            self.store.add_select_results(REGISTRATION_AUTHORITY, self._new_authorities)
+            self._new_authorities = {}
+        for data in self._sorter:
+            w.write(data)
+
+    def close(self):
+        self._sorter.close()
+
+
+# Return a string for a namespace map, the same for a map loaded from an index as for one taken from lxml
+def _nsmap_key(nsmap):
+    return ' '.join( '%s=%s' % (p or '', uri) for (p, uri) in sorted(nsmap.items()) ).encode('utf-8')
+
+
+# External sort of (key, data) records. Iterating returns the data in key order. Keys must be unique.
+class _Sorter(object):
+
+    # Approximate memory used per record besides the data
+    OVERHEAD = 128
+
+    # @param memory number of bytes of records kept in memory before a sorted run is written to a temporary file
+    # @param directory directory for the temporary files
+    def __init__(self, memory, directory):
+        self.memory = memory
+        self.directory = directory
+        self.count = 0
+        self._records = []
+        self._size = 0
+        self._runs = []
+
+    def add(self, key, data):
+        self._records.append( (key, data) )
+        self.count += 1
+        self._size += len(data) + len(key[0]) + len(key[1]) + self.OVERHEAD
+        if self._size > self.memory:
+            self._spill()
+
+    def _spill(self):
+        self._records.sort()
+        f = tempfile.TemporaryFile(prefix='.mdnormalize-', dir=self.directory)
+        self._runs.append(f)
+        for record in self._records:
+            marshal.dump(record, f)
+        f.seek(0)
+        self._records = []
+        self._size = 0
+
+    def __iter__(self):
+        if not self._runs:
+            self._records.sort()
+            return ( data for (key, data) in self._records )
+        if self._records:
+            self._spill()
+        return ( data for (key, data) in heapq.merge(*[ self._read(f) for f in self._runs ]) )
+
+    @staticmethod
+    def _read(f):
+        while True:
+            try:
+                yield marshal.load(f)
+            except EOFError:
+                return
+
+    def close(self):
+        for f in self._runs:
+            f.close()
+        self._runs = []
+        self._records = []
+
+
+# Serialized entities by a hash of their source, in a directory
+# The fragments that are used in a build are touched. Fragments that were not used by the previous build are removed
+# when the cache is first used in a build, so the cache does not grow with every changed entity.
+class FragmentCache(object):
+
+    # Marker file, its modification time is the start of the last build that used the cache
+    MARKER = 'last-build'
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._pruned = False
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    # @return the cached fragment, or None
+    def get(self, key):
+        self.prune()
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                fragment = f.read()
+        except IOError:
+            return None
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return fragment
+
+    def put(self, key, fragment):
+        self.prune()
+        path = self._path(key)
+        if not os.path.isdir(os.path.dirname(path)):
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError:
+                if not os.path.isdir(os.path.dirname(path)):
+                    raise
+        # Not synced to disk like AtomicFile: a lost fragment is made again
+        tmp_path = '%s.%d.%d.tmp' % (path, os.getpid(), threading.current_thread().ident)
+        with open(tmp_path, 'wb') as f:
+            f.write(fragment)
+        os.rename(tmp_path, path)
+
+    # Remove the fragments that were not used since the start of the previous build
+    # Only the first call does the pruning, so fragments are pruned once per build, before they are used
+    def prune(self):
+        with self._lock:
+            if self._pruned:
+                return
+            self._pruned = True
+            if not os.path.isdir(self.directory):
+                return
+            marker = os.path.join(self.directory, self.MARKER)
+            try:
+                previous = os.stat(marker).st_mtime
+            except OSError:
+                previous = None
+            with open(marker, 'a'):
+                os.utime(marker, None)
+        if previous is None:
+            return
+        for d in os.listdir(self.directory):
+            d = os.path.join(self.directory, d)
+            if not os.path.isdir(d):
+                continue
+            for name in os.listdir(d):
+                path = os.path.join(d, name)
+                try:
+                    if os.stat(path).st_mtime < previous:
+                        os.remove(path)
+                except OSError:
+                    pass
+
+    # Prune again at the next use, as at the start of a build
+    # Used by long-running builds (see watch.py), which use the same FragmentCache for each build
+    def reset(self):
+        with self._lock:
+            self._pruned = False
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+# Return the (shared) FragmentCache for a directory
+def get_cache(directory):
+    directory = os.path.abspath(directory)
+    with _caches_lock:
+        if directory not in _caches:
+            _caches[directory] = FragmentCache(directory)
+        return _caches[directory]
+
+
+# Return the FragmentCache objects made by get_cache()
+def caches():
+    with _caches_lock:
+        return _caches.values()
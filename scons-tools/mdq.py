@@ -0,0 +1,219 @@
+# Copyright 2015 GIP RENATER
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Per-entity publishing of metadata, for serving the entities like a Metadata Query (MDQ) server
+
+Splits an EntitiesDescriptor into one file per EntityDescriptor in <directory>/entities/. The name of a file is
+"{sha1}" followed by the SHA-1 (hex) of the entityID, which is the path of the MDQ request for the entity
+(/entities/%7Bsha1%7D...) after URL decoding, so the directory can be served by a static web server. Each file has the
+EntityDescriptor as root element, without comments or Signature, with a validUntil of the time it was written plus the
+validity (unless the entity has an earlier validUntil) and the cacheDuration.
+
+<directory>/index.json lists the published entities: entityID, file name, content hash and validUntil.
+
+Publishing is incremental: an entity is only written again when its content changed (the SHA-1 of its exclusive
+canonical form, as in mdindex.py), when the publication settings (e.g. validity, signing key) changed, or when less
+than the refresh time of its validity remains. The files of entities that are no longer in the source are removed.
+
+This module does not depend on SCons so it can be used from scripts as well.
+"""
+
+import os
+import mmap
+import json
+import hashlib
+import threading
+from datetime import datetime
+
+from lxml import etree
+
+import samlmd
+import mdindex
+from urlcache import AtomicFile
+
+
+ENTITIES_DIR = 'entities'
+INDEX_FILE = 'index.json'
+INDEX_VERSION = 1
+
+SIGNATURE = '{%s}Signature' % samlmd.NS['ds']
+
+
+# Return the file name of the entity with entityID entity_id
+def entity_name(entity_id):
+    return '{sha1}' + hashlib.sha1(entity_id.encode('utf-8')).hexdigest()
+
+
+# Return the published entities of a directory: dict of entityID => record (dict with file, hash and validUntil),
+# and the settings they were published with
+def load_index(directory):
+    try:
+        with open(os.path.join(directory, INDEX_FILE), 'rb') as f:
+            data = json.load(f)
+        if data.get('version') != INDEX_VERSION:
+            return ({}, None)
+        return (dict( (r['entityID'], r) for r in data['entities'] ), data.get('settings'))
+    except (IOError, ValueError, KeyError, TypeError):
+        return ({}, None)
+
+
+# Return True when an entity of a directory must be published again because its validity runs out
+# @param refresh timedelta. An entity is published again when less than refresh of its validity remains
+def refresh_due(directory, refresh, now=None):
+    (published, settings) = load_index(directory)
+    if settings is None:
+        return True
+    limit = samlmd.format_datetime((now or datetime.utcnow()) + refresh)
+    return any( r['validUntil'] < limit for r in published.values() )
+
+
+class Publisher(object):
+
+    # @param directory output directory
+    # @param validity timedelta, validity of the published entities
+    # @param cache_duration optional xs:duration for the cacheDuration of the published entities
+    # @param refresh timedelta, an entity is published again when less than refresh of its validity remains.
+    #        Defaults to half of the validity
+    # @param settings optional JSON serializable value. When it differs from the settings of the published entities
+    #        all entities are published again (e.g. the signing key)
+    def __init__(self, directory, validity, cache_duration=None, refresh=None, settings=None):
+        self.directory = directory
+        self.validity = validity
+        self.cache_duration = cache_duration
+        self.refresh = refresh if refresh is not None else validity / 2
+        self.settings = {'validity': validity.total_seconds(), 'cacheDuration': cache_duration, 'other': settings}
+        (self.published, published_settings) = load_index(directory)
+        if published_settings != self.settings:
+            self.published = {}
+        self.current = {}       # entityID => record of the entities in the source
+        self.written = {}       # entityID => record of the entities written by split()
+
+    # Write the entities of source that must be published (again)
+    # @param source file name of the metadata
+    # @param output directory for the written entity files, e.g. a directory of files to sign. Defaults to
+    #        <directory>/entities/
+    # @param store optional mdindex.IndexStore. When the source was indexed before it is not parsed again, only the
+    #        entities that are written are parsed
+    # @param key content key of the source file for the store (see IndexStore.get())
+    # @return list of (entityID, path of the written file)
+    def split(self, source, output=None, store=None, key=None, now=None):
+        output = output or os.path.join(self.directory, ENTITIES_DIR)
+        now = now or datetime.utcnow()
+        valid_until = samlmd.format_datetime(now + self.validity)
+        refresh_limit = samlmd.format_datetime(now + self.refresh)
+        index = store.get(source, key) if store is not None else mdindex.Index.build(source)
+
+        entries = {}        # entityID => Entry of the entities to write
+        for entry in index.entries:
+            if entry.entity_id is None or index.entities[entry.entity_id] is not entry:
+                continue    # A later duplicate, as in mdselect the first is used
+            old = self.published.get(entry.entity_id)
+            if old and old['hash'] == entry.hash and old['validUntil'] >= refresh_limit and \
+                    os.path.isfile(os.path.join(self.directory, ENTITIES_DIR, old['file'])):
+                self.current[entry.entity_id] = old
+            else:
+                entries[entry.entity_id] = entry
+
+        _makedirs(output)
+        written = []
+        for (entity_id, root) in _entities(source, index, entries):
+            name = entity_name(entity_id)
+            record = {'entityID': entity_id, 'file': name, 'hash': entries[entity_id].hash,
+                      'validUntil': self._finalize(root, valid_until)}
+            path = os.path.join(output, name)
+            _write(path, etree.tostring(root, encoding='UTF-8', xml_declaration=True))
+            self.written[entity_id] = record
+            written.append( (entity_id, path) )
+        return written
+
+    # Set the validUntil and cacheDuration of a published entity
+    # @return the validUntil of the entity
+    def _finalize(self, root, valid_until):
+        for signature in root.findall(SIGNATURE):
+            root.remove(signature)
+        own = samlmd.parse_datetime(root.get('validUntil') or '')
+        if own is None or samlmd.format_datetime(own) > valid_until:
+            root.set('validUntil', valid_until)
+        if self.cache_duration and not root.get('cacheDuration'):
+            root.set('cacheDuration', self.cache_duration)
+        return samlmd.format_datetime(samlmd.parse_datetime(root.get('validUntil')))
+
+    # Record the written entities that were published, remove the files of the entities that are no longer in the
+    # source, and write the index
+    # @param published entityIDs of the written entities that are now in <directory>/entities/. Defaults to all
+    # @return list of the entityIDs that were removed
+    def commit(self, published=None):
+        if published is None:
+            published = self.written.keys()
+        for entity_id in published:
+            self.current[entity_id] = self.written[entity_id]
+        removed = [ i for i in self.published if i not in self.current and i not in self.written ]
+        # All files that are not of an entity in the source are removed, also when the index was lost
+        keep = set( r['file'] for r in self.current.values() + self.written.values() )
+        entities = os.path.join(self.directory, ENTITIES_DIR)
+        for name in (os.listdir(entities) if os.path.isdir(entities) else []):
+            if name not in keep:
+                try:
+                    os.remove(os.path.join(entities, name))
+                except OSError:
+                    pass
+        # Entities that failed to be published are left out, so they are published by the next build
+        data = {
+            'version': INDEX_VERSION,
+            'settings': self.settings,
+            'entities': [ self.current[i] for i in sorted(self.current.keys()) ],
+        }
+        _makedirs(self.directory)
+        with AtomicFile(os.path.join(self.directory, INDEX_FILE)) as f:
+            json.dump(data, f, indent=1, sort_keys=True)
+        return removed
+
+
+# Return (entityID, root element) of the entities of entries, with the EntityDescriptor parsed as root element
+def _entities(source, index, entries):
+    if not entries:
+        return
+    if index.ranges:
+        with open(source, 'rb') as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            for (entity_id, entry) in entries.items():
+                yield (entity_id, index.parse(data, entry).getroot())
+        finally:
+            data.close()
+    else:
+        remaining = set(entries.keys())
+        for e in samlmd.iterentities(source):
+            # Only the first entity with an entityID, as in the index
+            if e.get('entityID') in remaining:
+                remaining.remove(e.get('entityID'))
+                yield (e.get('entityID'), samlmd.entity_document(e).getroot())
+
+
+def _makedirs(directory):
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            if not os.path.isdir(directory):
+                raise
+
+
+# Write a file, replacing it atomically
+def _write(path, data):
+    # Not synced to disk like AtomicFile, a lost file is written by the next build
+    tmp_path = '%s.%d.%d.tmp' % (path, os.getpid(), threading.current_thread().ident)
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.rename(tmp_path, path)
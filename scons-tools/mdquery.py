@@ -0,0 +1,231 @@
+# Copyright 2015 GIP RENATER
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Select expressions answered from the attribute index of a metadata file (see mdindex.py)
+
+compile() translates the XPath expressions commonly used to select entities into a query on the attributes that
+mdindex.Index keeps of every entity: its child elements (the role descriptors), registrationAuthority, entity
+attributes (e.g. entity categories) and entityID. Supported are expressions of the form
+
+  //md:EntityDescriptor[<condition>]...
+
+where a condition is a combination with "and", "or", "not()" and parentheses of:
+- md:IDPSSODescriptor (or any other child element): the entity has such a child element;
+- @entityID='...';
+- md:Extensions/mdrpi:RegistrationInfo/@registrationAuthority='...';
+- md:Extensions/mdattr:EntityAttributes/saml:Attribute[@Name='...']/saml:AttributeValue='...'.
+The prefixes are those of samlmd.NS. A query evaluates to the set of the positions of the selected entries of an
+index, using set intersection, union and difference instead of evaluating the XPath expression for every entity.
+compile() returns None for other expressions, these must be evaluated with XPath.
+
+This module does not depend on SCons so it can be used from scripts as well.
+"""
+
+import re
+import threading
+
+import samlmd
+import mdindex
+
+
+_token_re = re.compile(r'''\s*(?:(//|/|\[|\]|\(|\)|=|@)|'([^']*)'|"([^"]*)"|([A-Za-z_][\w.-]*(?::[A-Za-z_][\w.-]*)?))''')
+
+_compiled = {}      # expression => query or None
+_compiled_lock = threading.Lock()
+
+
+# Return the query for an XPath select expression, or None when the expression can not be answered from the index
+# Queries are cached for the duration of the build
+def compile(expression):
+    with _compiled_lock:
+        if expression not in _compiled:
+            try:
+                _compiled[expression] = _Parser(expression).parse()
+            except _Unsupported:
+                _compiled[expression] = None
+        return _compiled[expression]
+
+
+# Return the set of the positions (in index.entries) of the entries selected by a query
+def evaluate(query, index):
+    op = query[0]
+    if op == 'all':
+        return set(xrange(len(index.entries)))
+    elif op == 'attribute':
+        return set(index.lookup(query[1]))
+    elif op == 'entityID':
+        return set( i for (i, e) in enumerate(index.entries) if e.entity_id == query[1] )
+    elif op == 'not':
+        return set(xrange(len(index.entries))) - evaluate(query[1], index)
+    elif op == 'and':
+        result = evaluate(query[1], index)
+        for q in query[2:]:
+            if not result:
+                break
+            result &= evaluate(q, index)
+        return result
+    elif op == 'or':
+        result = set()
+        for q in query[1:]:
+            result |= evaluate(q, index)
+        return result
+    raise ValueError("Unknown query '%s'" % op)
+
+
+class _Unsupported(Exception):
+    pass
+
+
+class _Parser(object):
+
+    def __init__(self, expression):
+        self.tokens = []
+        position = 0
+        if isinstance(expression, str):
+            expression = expression.decode('utf-8')
+        expression = expression.strip()
+        while position < len(expression):
+            m = _token_re.match(expression, position)
+            if not m or m.end() == position:
+                raise _Unsupported()
+            if m.group(1):
+                self.tokens.append( ('op', m.group(1)) )
+            elif m.group(2) is not None or m.group(3) is not None:
+                self.tokens.append( ('literal', m.group(2) if m.group(2) is not None else m.group(3)) )
+            else:
+                self.tokens.append( ('name', m.group(4)) )
+            position = m.end()
+        self.position = 0
+
+    def _peek(self):
+        return self.tokens[self.position] if self.position < len(self.tokens) else (None, None)
+
+    def _next(self):
+        token = self._peek()
+        self.position += 1
+        return token
+
+    def _expect(self, kind, value=None):
+        token = self._next()
+        if token[0] != kind or (value is not None and token[1] != value):
+            raise _Unsupported()
+        return token[1]
+
+    # Resolve a prefixed name to {namespace}name
+    def _qname(self, name):
+        if not ':' in name:
+            raise _Unsupported()    # Unprefixed names are in no namespace, not used in SAML metadata
+        (prefix, local) = name.split(':', 1)
+        if prefix not in samlmd.NS:
+            raise _Unsupported()
+        return '{%s}%s' % (samlmd.NS[prefix], local)
+
+    # path := ('//' | '/') md:EntityDescriptor ('[' condition ']')*
+    def parse(self):
+        if self._next() not in (('op', '//'), ('op', '/')):
+            raise _Unsupported()
+        if self._qname(self._expect('name')) != samlmd.ENTITY_DESCRIPTOR:
+            raise _Unsupported()
+        conditions = []
+        while self._peek() == ('op', '['):
+            self._next()
+            conditions.append(self._or())
+            self._expect('op', ']')
+        if self._peek() != (None, None):
+            raise _Unsupported()
+        if not conditions:
+            return ('all',)
+        return conditions[0] if len(conditions) == 1 else ('and',) + tuple(conditions)
+
+    def _or(self):
+        operands = [self._and()]
+        while self._peek() == ('name', 'or'):
+            self._next()
+            operands.append(self._and())
+        return operands[0] if len(operands) == 1 else ('or',) + tuple(operands)
+
+    def _and(self):
+        operands = [self._unary()]
+        while self._peek() == ('name', 'and'):
+            self._next()
+            operands.append(self._unary())
+        return operands[0] if len(operands) == 1 else ('and',) + tuple(operands)
+
+    def _unary(self):
+        if self._peek() == ('name', 'not'):
+            self._next()
+            self._expect('op', '(')
+            operand = self._or()
+            self._expect('op', ')')
+            return ('not', operand)
+        if self._peek() == ('op', '('):
+            self._next()
+            operand = self._or()
+            self._expect('op', ')')
+            return operand
+        return self._comparison()
+
+    # comparison := relative path ('=' literal)? | literal '=' relative path
+    def _comparison(self):
+        if self._peek()[0] == 'literal':
+            value = self._next()[1]
+            self._expect('op', '=')
+            return self._condition(self._path(), value)
+        path = self._path()
+        if self._peek() == ('op', '='):
+            self._next()
+            return self._condition(path, self._expect('literal'))
+        return self._condition(path, None)
+
+    # Parse a relative path into a tuple of steps: '{namespace}name', '@name', or ('{namespace}name', Name) for an
+    # element step with a [@Name='...'] predicate
+    def _path(self):
+        steps = []
+        while True:
+            if self._peek() == ('op', '@'):
+                self._next()
+                steps.append('@' + self._expect('name'))
+            else:
+                step = self._qname(self._expect('name'))
+                if self._peek() == ('op', '['):
+                    self._next()
+                    self._expect('op', '@')
+                    self._expect('name', 'Name')
+                    self._expect('op', '=')
+                    step = (step, self._expect('literal'))
+                    self._expect('op', ']')
+                steps.append(step)
+            if self._peek() != ('op', '/'):
+                return tuple(steps)
+            self._next()
+
+    def _condition(self, path, value):
+        if value is None:
+            if len(path) == 1 and not isinstance(path[0], tuple) and not path[0].startswith('@'):
+                return ('attribute', mdindex.CHILD + path[0])
+        elif path == ('@entityID',):
+            return ('entityID', value)
+        elif path == _REGISTRATION_AUTHORITY_PATH:
+            return ('attribute', mdindex.REGISTRATION_AUTHORITY + value)
+        elif len(path) == 4 and path[0:2] == _ENTITY_ATTRIBUTES_PATH and isinstance(path[2], tuple) \
+                and path[2][0] == _ATTRIBUTE and path[3] == _ATTRIBUTE_VALUE:
+            return ('attribute', mdindex.ENTITY_ATTRIBUTE + path[2][1] + '\n' + value)
+        raise _Unsupported()
+
+
+_EXTENSIONS = '{%s}Extensions' % samlmd.NS['md']
+_REGISTRATION_AUTHORITY_PATH = (_EXTENSIONS, '{%s}RegistrationInfo' % samlmd.NS['mdrpi'], '@registrationAuthority')
+_ENTITY_ATTRIBUTES_PATH = (_EXTENSIONS, '{%s}EntityAttributes' % samlmd.NS['mdattr'])
+_ATTRIBUTE = '{%s}Attribute' % samlmd.NS['saml']
+_ATTRIBUTE_VALUE = '{%s}AttributeValue' % samlmd.NS['saml']
@@ -0,0 +1,555 @@
+# Copyright 2015 GIP RENATER
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+""" SCons tool for processing SAML metadata in the SCons process, one EntityDescriptor at a time
+
+Usage (in SConscript):
+env = Environment(tools=['mdstream'], toolpath='<(relative) path to mdstream.py>')
+
+Requires lxml (http://lxml.de/).
+"""
+
+
+from SCons.Script import *  # For PyCharm code completion
+import SCons.Builder, SCons.Util, SCons.Action, SCons.Errors
+
+import os
+import mmap
+import shutil
+import multiprocessing
+
+import xmlsectool
+
+try:
+    from lxml import etree
+    import samlmd
+    import mdindex
+    import mdnormalize
+    import mdq
+    import mdquery
+    import checks
+except ImportError:
+    etree = None
+
+
+""" Build command for selecting entities from metadata files
+Alternative for the pyff pseudo builder (see pyff.py) with the same arguments. The entities are read, selected and
+written one at a time, so memory use is bounded by the size of the largest entity instead of the size of the
+metadata.
+
+source:  The source SAML 2.0 XML metadata file(s). String, Node, list or dictionary of key => source, as for pyff.
+         When the same entityID occurs in multiple files, the entity from the first source file listed that is
+         selected is output.
+target:  Output file. String or Node.
+select:  Optional. String or list of strings "<key>!<xpath expression>" or "<key>", as for pyff. The XPath expression
+         is evaluated against each EntityDescriptor separately, with the EntityDescriptor as the document root, and
+         selects the entity when the EntityDescriptor is in the result. E.g.
+         "!//md:EntityDescriptor[md:IDPSSODescriptor]" - select all entities that contain an IDPSSODescriptor
+         "SOURCE_1!//md:EntityDescriptor" - select all entities from the file loaded with key "SOURCE_1"
+         "SOURCE_0" - select all entities loaded with key "SOURCE_0"
+remove:  Optional. String or list of strings of EntityIDs to remove from the selection.
+finalize: Optional. Tuple of attributes to set on the SAML 2.0 EntitiesDescriptor (Name, cacheDuration, validUntil)
+xslt:    Optional. String or Node object. The xslt stylesheet to apply to the output. Note that the XSLT is applied
+         to the complete output document, so this requires the complete output to be loaded in memory.
+mdq:     Optional. Directory to publish the selected entities to, one signed file per entity (see the mdq builder)
+
+The output is an EntitiesDescriptor with the selected entities in the order of the source files.
+
+Unless MDSTREAM_INDEXDIR is set to '', a per-entity index of each source file is kept in $MDSTREAM_INDEXDIR (see
+mdindex.py). Entities are then copied from the source files, and the select expressions are only evaluated for entities
+that are new or changed since a previous build. The number of added, removed and changed entities of a source file is
+reported when it changed since the last build.
+"""
+# Stand alone pseudo builder
+# Returns target nodes
+def _mdselect(env, source, target=[], select=None, remove=[], finalize=None, xslt=None, mdq=None) :
+    sources = _source_nodes(env, source)
+
+    if not SCons.Util.is_List(remove):
+        remove=[remove]
+
+    if select and not SCons.Util.is_List(select):
+        select=[select]
+
+    if finalize and len(finalize) < 3:
+        raise ValueError('mdselect: finalize argument requires tuple of (Name, cacheDuration, validUntil)')
+
+    overrides = {
+        'MDSELECT_KEYS': [ s[1] for s in sources ],
+        'MDSELECT_SELECT': [ env.subst(s) for s in select ] if select else None,
+        'MDSELECT_REMOVE': [ env.subst(r) for r in remove ],
+        'MDSELECT_FINALIZE': [ env.subst(f) for f in finalize[0:3] ] if finalize else None,
+        'MDSELECT_XSLT': env.File(xslt).path if xslt else None,
+    }
+    action = SCons.Action.Action(_mdselect_action, _mdselect_strfunction, varlist=overrides.keys())
+    c = env.Command( env.File(target), [ s[0] for s in sources ], action, **overrides )
+    if xslt:
+        env.Depends(c, env.File(xslt))
+    if mdq:
+        c += _mdq(env, c[0], mdq)
+    return c
+
+
+# Make list of (Node, key) from the source argument of a pseudo builder
+def _source_nodes(env, source):
+    if SCons.Util.is_Dict(source):
+        return [ (env.File(source[s]), s) for s in source ]
+    elif SCons.Util.is_List(source):
+        return [ (env.File(s[1]), "SOURCE_%s" % s[0]) for s in enumerate(source) ]
+    else:
+        return [ (env.File(source), "SOURCE_0") ]
+
+
+# Parse the select strings into a list of (key, XPath expression, compiled XPath) or (key, None, None)
+# An empty key matches all sources, None matches all entities of the source
+def _compile_selects(selects, keys):
+    compiled = []
+    for s in selects:
+        if '!' in s:
+            (key, xpath) = s.split('!', 1)
+            try:
+                compiled.append( (key, xpath, etree.XPath(xpath, namespaces=samlmd.NS)) )
+            except etree.XPathSyntaxError, e:
+                raise SCons.Errors.UserError("mdselect: invalid XPath in select '%s': %s" % (s, e))
+        elif s in keys:
+            compiled.append( (s, None, None) )
+        else:
+            raise SCons.Errors.UserError("mdselect: unsupported select '%s'. Use '<key>!<xpath>' or '<key>'" % s)
+    return compiled
+
+
+# Write the EntitiesDescriptor with the selected entities from sources to output
+# @param output file name or file object
+# @param sources list of (file name, key) or (file name, key, content key)
+# @param selects list of select strings or None to select all entities
+# @param remove list of entityIDs to leave out
+# @param finalize tuple of (Name, cacheDuration, validUntil) or None
+# @param store optional mdindex.IndexStore. When given, unchanged entities are copied from the source files and
+#        select expressions are only evaluated for entities for which the store has no result
+# @param normalizer optional mdnormalize.Normalizer. When given the selected entities are written in normalized order
+#        (as mdnormalize.normalize() of the output would), instead of in the order of the source files
+def select_entities(output, sources, selects=None, remove=(), finalize=None, store=None, normalizer=None):
+    compiled = _compile_selects(selects, [ s[1] for s in sources ]) if selects else None
+    remove = set(remove)
+    emitted = set()
+
+    attrib = {}
+    if finalize:
+        samlmd.finalize(attrib, finalize)
+
+    with samlmd.MetadataWriter(output, attrib, normalizer.nsmap if normalizer else samlmd.ROOT_NSMAP) as w:
+        for source in sources:
+            (path, key) = source[0:2]
+            xpaths = None
+            if compiled is not None:
+                xpaths = [ (expr, xp) for (k, expr, xp) in compiled if k in ('', key) ]
+                if not xpaths:
+                    continue    # Nothing can be selected from this source
+            index = store.get(path, source[2] if len(source) > 2 else None) if store is not None else None
+            if index is not None and index.ranges:
+                _select_indexed(w, path, index, xpaths, remove, emitted, store, normalizer)
+                continue
+            for e in samlmd.iterentities(path):
+                entity_id = e.get('entityID')
+                if entity_id in emitted or entity_id in remove:
+                    continue
+                doc = samlmd.entity_document(e)
+                root = doc.getroot()
+                if xpaths is not None and not any( xp is None or root in xp(doc) for (expr, xp) in xpaths ):
+                    continue
+                emitted.add(entity_id)
+                if normalizer is not None:
+                    normalizer.add(root)
+                else:
+                    w.write(samlmd.serialize(root))
+        if normalizer is not None:
+            normalizer.write(w)
+    return len(emitted)
+
+
+# Write the selected entities of an indexed source file
+# Entities are copied from the file. Select expressions that the attribute index of the file can answer (see
+# mdquery.py) are evaluated with set operations on the index. For the other expressions, only entities for which the
+# expression has no stored result are parsed.
+def _select_indexed(w, path, index, xpaths, remove, emitted, store, normalizer=None):
+    answered = {}       # expression => set of the positions of the selected entries
+    for (expr, xp) in xpaths or []:
+        query = mdquery.compile(expr) if xp is not None else None
+        if query is not None:
+            answered[expr] = mdquery.evaluate(query, index)
+    results = dict( (expr, store.select_results(expr)) for (expr, xp) in xpaths or []
+                    if xp is not None and expr not in answered )
+    new_results = dict( (expr, {}) for expr in results )
+    with open(path, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(f.fileno()).st_size else ''
+    try:
+        for (position, entry) in enumerate(index.entries):
+            if entry.entity_id in emitted or entry.entity_id in remove:
+                continue
+            if xpaths is not None:
+                doc = None
+                selected = False
+                for (expr, xp) in xpaths:
+                    if xp is None:
+                        selected = True
+                    elif expr in answered:
+                        selected = position in answered[expr]
+                    elif entry.hash in results[expr]:
+                        selected = results[expr][entry.hash]
+                    else:
+                        if doc is None:
+                            doc = index.parse(data, entry)
+                        selected = doc.getroot() in xp(doc)
+                        new_results[expr][entry.hash] = selected
+                    if selected:
+                        break
+                if not selected:
+                    continue
+            emitted.add(entry.entity_id)
+            if normalizer is not None:
+                normalizer.add_indexed(data, index, entry)
+            else:
+                w.write(index.fragment(data, entry, w.nsmap))
+    finally:
+        if data:
+            data.close()
+    for (expr, r) in new_results.items():
+        store.add_select_results(expr, r)
+
+
+def _mdselect_action(target, source, env):
+    xslt = env['MDSELECT_XSLT']
+    output = target[0].path + '.tmp' if xslt else target[0].path
+    try:
+        store = _index_store(env)
+        if store is not None:
+            sources = [ (s.path, k, s.get_csig()) for (s, k) in zip(source, env['MDSELECT_KEYS']) ]
+            _report_changes(store, sources)
+        else:
+            sources = zip( [ s.path for s in source ], env['MDSELECT_KEYS'] )
+        select_entities(output, sources, env['MDSELECT_SELECT'], env['MDSELECT_REMOVE'], env['MDSELECT_FINALIZE'],
+                        store)
+        if xslt:
+            transform = etree.XSLT(etree.parse(xslt))
+            result = transform(etree.parse(output, etree.XMLParser(huge_tree=True)))
+            result.write(target[0].path, encoding='UTF-8', xml_declaration=True)
+            os.remove(output)
+    except (etree.Error, IOError, ValueError), e:
+        print "mdselect: %s" % e
+        return 1
+    return 0
+
+""" Build command for normalizing a metadata file
+Bounded memory alternative for scripts/normalize.xslt (see mdnormalize.py): removes comments and outputs the
+EntityDescriptor elements ordered by registrationAuthority and entityID. Use it just before signing.
+
+source:  The source SAML 2.0 XML metadata file. String or Node.
+target:  Output file. String or Node.
+
+At most $MDNORMALIZE_MEMORY bytes of entities are sorted in memory, beyond that sorted runs are written to temporary
+files next to the target. Unless MDSTREAM_INDEXDIR is set to '', the serialized entities are kept in
+$MDNORMALIZE_CACHEDIR so only new and changed entities are serialized again.
+"""
+# Stand alone pseudo builder
+# Returns target nodes
+def _mdnormalize(env, source, target):
+    action = SCons.Action.Action(_mdnormalize_action, _mdnormalize_strfunction)
+    return env.Command(env.File(target), env.File(source), action)
+
+
+def _mdnormalize_action(target, source, env):
+    try:
+        store = _index_store(env)
+        if store is not None:
+            store.update(source[0].path, source[0].get_csig())
+        cache = mdnormalize.get_cache(env.Dir('$MDNORMALIZE_CACHEDIR').abspath) if store is not None else None
+        mdnormalize.normalize(source[0].path, target[0].path, store, source[0].get_csig() if store else None, cache,
+                              int(env.subst('$MDNORMALIZE_MEMORY')))
+    except (etree.Error, IOError, OSError, ValueError), e:
+        print "mdnormalize: %s" % e
+        return 1
+    return 0
+
+
+def _mdnormalize_strfunction(target, source, env):
+    return "mdnormalize: %s from %s" % (target[0], source[0])
+
+
+""" Build command for publishing the entities of a metadata file one file per entity, as a Metadata Query (MDQ) server
+serves them. Clients that need one entity fetch (and verify) that entity instead of the whole aggregate.
+
+source:  The source SAML 2.0 XML metadata file, e.g. the output of pyff or mdselect. String or Node.
+target:  Output directory. String or Node.
+sign:    Optional. Sign the entity files with xmlsectool, as XML_Sign does (default True)
+
+The entities are written to <target>/entities/{sha1}<SHA-1 of the entityID> (see mdq.py), with a validUntil of
+$MDQ_VALID_UNTIL (an xs:duration) from the time the entity is published, and a cacheDuration of $MDQ_CACHE_DURATION.
+<target>/index.json lists the published entities. Only entities that are new or changed since the last build, or of
+which less than half of the validity remains, are written and signed again. Up to $MDQ_SIGN_JOBS entities are signed
+in parallel, with XMLSECTOOL_BATCH each job uses its own batch signer.
+Files of entities that are not in the source anymore are removed.
+"""
+# Stand alone pseudo builder
+# Returns target nodes
+def _mdq(env, source, target, sign=True):
+    directory = env.Dir(target)
+    validity = samlmd.parse_duration(env.subst('$MDQ_VALID_UNTIL'))
+    if validity is None:
+        raise ValueError("mdq: MDQ_VALID_UNTIL '%s' is not an xs:duration" % env.subst('$MDQ_VALID_UNTIL'))
+    overrides = {
+        'MDQ_SIGN': bool(sign),
+        # Signing with another key publishes all entities again
+        'MDQ_SIGN_KEY': [ env.File('$XMLSECTOOLSH_KEYSTORE').abspath, env.subst('$XMLSECTOOLSH_KEYSTORE_KEY') ] if sign else None,
+    }
+    action = SCons.Action.Action(_mdq_action, _mdq_strfunction,
+                                 varlist=overrides.keys() + ['MDQ_VALID_UNTIL', 'MDQ_CACHE_DURATION'])
+    c = env.Command(directory.File(mdq.INDEX_FILE), env.File(source), action, **overrides)
+    # The index is the state of the published entities, SCons must not remove it before the action
+    env.Precious(c)
+    # Entities of which the validity runs out are published again, also when the source did not change
+    if mdq.refresh_due(directory.abspath, validity / 2):
+        env.AlwaysBuild(c)
+    env.Clean(c, directory)
+    return c
+
+
+def _mdq_action(target, source, env):
+    directory = os.path.dirname(target[0].path)
+    sign = env['MDQ_SIGN']
+    errors = []
+    try:
+        publisher = mdq.Publisher(directory, samlmd.parse_duration(env.subst('$MDQ_VALID_UNTIL')),
+                                  env.subst('$MDQ_CACHE_DURATION') or None, settings=env['MDQ_SIGN_KEY'])
+        store = _index_store(env)
+        if store is not None:
+            store.update(source[0].path, source[0].get_csig())
+        unsigned = os.path.join(directory, '.unsigned')
+        written = publisher.split(source[0].path, unsigned if sign else None, store,
+                                  source[0].get_csig() if store is not None else None)
+        published = None
+        if sign:
+            # Signed to a staging directory and then moved, so a client never reads a partially written file
+            signed = os.path.join(directory, '.signed')
+            entities = os.path.join(directory, mdq.ENTITIES_DIR)
+            for d in (signed, entities):
+                if not os.path.isdir(d):
+                    os.makedirs(d)
+            files = dict( (path, entity_id) for (entity_id, path) in written )
+            errors = xmlsectool.sign_files(env, [ (path, os.path.join(signed, os.path.basename(path))) for path in files ],
+                                           int(env['MDQ_SIGN_JOBS']))
+            failed = set( path for (path, error) in errors )
+            for (path, error) in errors[:10]:
+                print "mdq: error signing %s: %s" % (files[path], error)
+            if len(errors) > 10:
+                print "mdq: and %d more signing errors" % (len(errors) - 10)
+            published = []
+            for (path, entity_id) in files.items():
+                if path not in failed:
+                    os.rename(os.path.join(signed, os.path.basename(path)), os.path.join(entities, os.path.basename(path)))
+                    published.append(entity_id)
+            shutil.rmtree(unsigned, ignore_errors=True)
+            shutil.rmtree(signed, ignore_errors=True)
+        removed = publisher.commit(published)
+        print "mdq: %s: %d entities, %d published, %d removed" % \
+              (directory, len(publisher.current), len(written) - len(errors), len(removed))
+    except (etree.Error, IOError, OSError, ValueError), e:
+        print "mdq: %s" % e
+        return 1
+    return 1 if errors else 0
+
+
+def _mdq_strfunction(target, source, env):
+    return "mdq: %s from %s" % (os.path.dirname(str(target[0])), source[0])
+
+
+""" Build command for the whole output chain of a metadata file in one step: select, finalize, normalize, test and sign
+The stages that would otherwise each write and parse the complete metadata (e.g. pyff, mdnormalize, Test and XML_Sign)
+run in the SCons process on one stream of entities: the selected entities are normalized as they are read, the
+normalized file is written once, parsed once for all the tests and then signed.
+
+source:  The source SAML 2.0 XML metadata file(s), as for mdselect.
+target:  Output file. String or Node.
+select, remove, finalize: Optional, as for mdselect.
+normalize: Optional. Order the entities as mdnormalize does (default True)
+tests:   Optional. List of tests, as for the Test builder (e.g. env.TestXMLSchema()). The tests must have a check (see
+         test.py); the file argument of a test is ignored, the tests are run against the normalized file.
+sign:    Optional. Sign the output with xmlsectool, as XML_Sign does (default True)
+intermediate: Optional. Also write the intermediate files next to the target for debugging and archival:
+         <target>.selected.xml (the selected entities, when normalize is set) and <target>.unsigned.xml (the tested
+         file). The stages then run one after the other (default False)
+
+The target is only written when all tests passed and signing succeeded.
+"""
+# Stand alone pseudo builder
+# Returns target nodes
+def _mdpipeline(env, source, target, select=None, remove=[], finalize=None, normalize=True, tests=[], sign=True,
+                intermediate=False):
+    sources = _source_nodes(env, source)
+    target = env.File(target)
+
+    if not SCons.Util.is_List(remove):
+        remove=[remove]
+
+    if select and not SCons.Util.is_List(select):
+        select=[select]
+
+    if finalize and len(finalize) < 3:
+        raise ValueError('mdpipeline: finalize argument requires tuple of (Name, cacheDuration, validUntil)')
+
+    for test in tests:
+        if not 'check' in test:
+            raise SCons.Errors.UserError("mdpipeline: %s: only tests with a check (see test.py) can be used" % target)
+
+    overrides = {
+        'MDSELECT_KEYS': [ s[1] for s in sources ],
+        'MDSELECT_SELECT': [ env.subst(s) for s in select ] if select else None,
+        'MDSELECT_REMOVE': [ env.subst(r) for r in remove ],
+        'MDSELECT_FINALIZE': [ env.subst(f) for f in finalize[0:3] ] if finalize else None,
+        'MDPIPELINE_NORMALIZE': bool(normalize),
+        'MDPIPELINE_CHECKS': [ test['name'] for test in tests ],
+        # Signing with another key signs the output again
+        'MDPIPELINE_SIGN_KEY': [ env.File('$XMLSECTOOLSH_KEYSTORE').abspath, env.subst('$XMLSECTOOLSH_KEYSTORE_KEY') ] if sign else None,
+        'MDPIPELINE_INTERMEDIATE': bool(intermediate),
+    }
+    targets = [target]
+    if intermediate:
+        if normalize:
+            targets.append( _intermediate(target, 'selected') )
+        targets.append( _intermediate(target, 'unsigned') )
+    action = SCons.Action.Action(_mdpipeline_action, _mdpipeline_strfunction, varlist=overrides.keys())
+    c = env.Command( targets, [ s[0] for s in sources ], action,
+                     MDPIPELINE_CHECK_FUNCTIONS=checks.from_tests(tests), **overrides )
+    for test in tests:
+        if 'depends' in test:
+            env.Depends(c, test['depends'])
+    return c
+
+
+# Return the node of an intermediate file of a target, e.g. signed.unsigned.xml for signed.xml
+def _intermediate(target, name):
+    (root, ext) = os.path.splitext(target.abspath)
+    return target.File('%s.%s%s' % (root, name, ext or '.xml'))
+
+
+def _mdpipeline_action(target, source, env):
+    normalize = env['MDPIPELINE_NORMALIZE']
+    intermediate = env['MDPIPELINE_INTERMEDIATE']
+    output = target[0].path
+    unsigned = target[-1].path if intermediate else output + '.unsigned'
+    try:
+        store = _index_store(env)
+        if store is not None:
+            sources = [ (s.path, k, s.get_csig()) for (s, k) in zip(source, env['MDSELECT_KEYS']) ]
+            _report_changes(store, sources)
+        else:
+            sources = zip( [ s.path for s in source ], env['MDSELECT_KEYS'] )
+        cache = mdnormalize.get_cache(env.Dir('$MDNORMALIZE_CACHEDIR').abspath) if store is not None else None
+        memory = int(env.subst('$MDNORMALIZE_MEMORY'))
+        if normalize and intermediate:
+            selected = target[1].path
+            select_entities(selected, sources, env['MDSELECT_SELECT'], env['MDSELECT_REMOVE'],
+                            env['MDSELECT_FINALIZE'], store)
+            mdnormalize.normalize(selected, unsigned, store, None, cache, memory)
+        elif normalize:
+            # The selected entities are normalized as they are read, without writing the selection
+            normalizer = mdnormalize.Normalizer(samlmd.ROOT_NSMAP, store, cache, memory,
+                                                os.path.dirname(os.path.abspath(unsigned)))
+            try:
+                select_entities(unsigned, sources, env['MDSELECT_SELECT'], env['MDSELECT_REMOVE'],
+                                env['MDSELECT_FINALIZE'], store, normalizer)
+            finally:
+                normalizer.close()
+        else:
+            select_entities(unsigned, sources, env['MDSELECT_SELECT'], env['MDSELECT_REMOVE'],
+                            env['MDSELECT_FINALIZE'], store)
+
+        failed = checks.run(env['MDPIPELINE_CHECK_FUNCTIONS'], target, source, env, int(env.get('TEST_WORKERS', 4)),
+                            unsigned)
+        if failed:
+            print "mdpipeline: %s: %d tests failed" % (target[0], failed)
+            return 1
+
+        if env['MDPIPELINE_SIGN_KEY'] is not None:
+            for (path, error) in xmlsectool.sign_files(env, [ (unsigned, output) ]):
+                print "mdpipeline: error signing %s: %s" % (path, error)
+                return 1
+        elif intermediate:
+            shutil.copyfile(unsigned, output)
+        else:
+            os.rename(unsigned, output)
+    except (etree.Error, IOError, OSError, ValueError), e:
+        print "mdpipeline: %s" % e
+        return 1
+    finally:
+        if not intermediate and os.path.exists(unsigned):
+            os.remove(unsigned)
+    return 0
+
+
+def _mdpipeline_strfunction(target, source, env):
+    stages = ['select']
+    if env['MDPIPELINE_NORMALIZE']:
+        stages.append('normalize')
+    if env['MDPIPELINE_CHECKS']:
+        stages.append('%d tests' % len(env['MDPIPELINE_CHECKS']))
+    if env['MDPIPELINE_SIGN_KEY'] is not None:
+        stages.append('sign')
+    return "mdpipeline: %s from %s (%s)" % (target[0], ', '.join( [ str(s) for s in source ] ), ', '.join(stages))
+
+
+# Return the IndexStore in $MDSTREAM_INDEXDIR, or None when no index is used
+def _index_store(env):
+    if not env.get('MDSTREAM_INDEXDIR'):
+        return None
+    return mdindex.get_store(env.Dir('$MDSTREAM_INDEXDIR').abspath)
+
+
+# Print the number of entities that were added, removed and changed in the sources since the last build
+def _report_changes(store, sources):
+    for (path, key, content_key) in sources:
+        changes = store.update(path, content_key)
+        if changes:
+            print "mdselect: %s: %d added, %d removed, %d changed entities" % \
+                  ((path,) + tuple( len(c) for c in changes ))
+
+
+def _mdselect_strfunction(target, source, env):
+    return "mdselect: %s from %s" % (target[0], ', '.join( [ str(s) for s in source ] ))
+
+
+# Called by the Environment.Tools function
+# Add ourselves to the environment
+def generate( env ) :
+    if etree is None:
+        print 'WARNING: lxml not found, mdstream tool not available'
+        return
+    env.SetDefault(CACHE_DIR="#.scons-cache")
+    # Directory for the per-entity indexes of the source files. Set to '' to not use indexes
+    env.SetDefault(MDSTREAM_INDEXDIR="${CACHE_DIR}/mdindex")
+    # Bytes of entities sorted in memory by mdnormalize, and the directory for its serialized entities
+    env.SetDefault(MDNORMALIZE_MEMORY=mdnormalize.DEFAULT_MEMORY)
+    env.SetDefault(MDNORMALIZE_CACHEDIR="${CACHE_DIR}/mdnormalize")
+    # Validity and cacheDuration of the entities published by mdq, and the number of entities signed in parallel
+    env.SetDefault(MDQ_VALID_UNTIL='P10D', MDQ_CACHE_DURATION='PT1H', MDQ_SIGN_JOBS=multiprocessing.cpu_count())
+    env.AddMethod(_mdselect, "mdselect")
+    env.AddMethod(_mdnormalize, "mdnormalize")
+    env.AddMethod(_mdq, "mdq")
+    env.AddMethod(_mdpipeline, "mdpipeline")
+
+
+# Called during initialisation
+# The tool can make it known whether it exists (i.e. is available)
+def exists(env):
+    return etree is not None
@@ -0,0 +1,98 @@
+# Copyright 2015 GIP RENATER
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+""" SCons tool for running the commands of a parallel build (scons -j) safely
+
+Usage (in SConstruct, after the other tools changed SPAWN, e.g. after env.PerfTrace()):
+env = Environment(tools=['parallel'], toolpath='<(relative) path to parallel.py>')
+env.LimitResources()
+
+Every command (pyff, xmlsectool, xsltproc, xmllint, scripts, ...) then:
+- gets its own, new scratch directory as TMPDIR, which is removed when the command is done. Temporary files of
+  commands that run at the same time (e.g. the .fd files of validatexmlsignature.sh) do not share a directory;
+- takes resource tokens before it runs (see resources.py): RESOURCE_MEMORY MB of memory (default 3/4 of the physical
+  memory) and RESOURCE_JVMS JVMs (default the number of CPUs). RESOURCE_NEEDS lists the tokens a command needs, by a
+  regular expression that is searched in the command line, e.g. each xmlsectool command takes a JVM and
+  RESOURCE_JVM_MEMORY MB. A command waits until its tokens are available, so -j can be set to the number of CPUs
+  without starting more JVMs than fit in memory.
+The signing of the mdq builder (xmlsectool.sign_files) takes the same tokens.
+"""
+
+
+from SCons.Script import *  # For PyCharm code completion
+
+import time
+import multiprocessing
+
+import resources
+import perftrace
+
+
+_limited = False
+
+
+# Return a SPAWN function that runs commands with spawn in a scratch directory, holding their resource tokens
+def _spawn_wrapper(spawn):
+
+    def spawn_command(sh, escape, cmd, args, env):
+        start = time.time()
+        with resources.pool.use(resources.needs(' '.join(args))):
+            if time.time() - start > 0.1:
+                perftrace.count('resources.wait')
+            with resources.scratch() as path:
+                env = dict(env)
+                env['TMPDIR'] = path
+                return spawn(sh, escape, cmd, args, env)
+
+    return spawn_command
+
+
+# Run the commands of the build in scratch directories and with resource tokens
+def _LimitResources(env):
+    global _limited
+    if _limited:
+        return
+    _limited = True
+    resources.pool.limit('memory', int(env.subst('$RESOURCE_MEMORY')) if env.subst('$RESOURCE_MEMORY') else None)
+    resources.pool.limit('jvm', int(env.subst('$RESOURCE_JVMS')) if env.subst('$RESOURCE_JVMS') else None)
+    resources.command_classes[:] = [ (expression, dict( (r, int(env.subst(str(a)))) for (r, a) in amounts.items() ))
+                                     for (expression, amounts) in env['RESOURCE_NEEDS'] ]
+    resources.scratch_parent = env.subst('$RESOURCE_SCRATCH_DIR') or None
+    env['SPAWN'] = _spawn_wrapper(env['SPAWN'])
+
+
+# Called by the Environment.Tools function
+# Add ourselves to the environment
+def generate(env):
+    memory = resources.physical_memory()
+    env.SetDefault(RESOURCE_MEMORY=memory * 3 // 4 if memory else '')    # MB, '' for no limit
+    env.SetDefault(RESOURCE_JVMS=multiprocessing.cpu_count())           # '' for no limit
+    env.SetDefault(RESOURCE_JVM_MEMORY=1024)
+    env.SetDefault(RESOURCE_PYFF_MEMORY=1024)
+    env.SetDefault(RESOURCE_XSLT_MEMORY=256)
+    # Tokens needed by the commands: the first regular expression found in the command line is used
+    env.SetDefault(RESOURCE_NEEDS=[
+        (r'xmlsectool|\bjava\b', {'jvm': 1, 'memory': '$RESOURCE_JVM_MEMORY'}),
+        (r'pyff|validatexmlsignature', {'memory': '$RESOURCE_PYFF_MEMORY'}),
+        (r'xsltproc|xmllint', {'memory': '$RESOURCE_XSLT_MEMORY'}),
+    ])
+    env.SetDefault(RESOURCE_SCRATCH_DIR='')     # Parent directory of the scratch directories. Default: the tmp dir
+    env.AddMethod(_LimitResources, "LimitResources")
+
+
+# Called during initialisation
+# The tool can make it known whether it exists (i.e. is available)
+def exists(env):
+    return 1
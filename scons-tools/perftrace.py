@@ -0,0 +1,279 @@
+# Copyright 2015 GIP RENATER
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+""" SCons tool for tracing the performance of a build
+
+Usage (in SConstruct):
+env = Environment(tools=['perftrace'], toolpath='<(relative) path to perftrace.py>')
+env.PerfTrace('<build dir>/perftrace.json')
+
+When enabled, every action of env (and of its clones) that is run (pyff, XML_Sign, Test, URLDownload, ...) is recorded with:
+- the wall time;
+- the user and system CPU time of the SCons thread running the action, and of the commands it started;
+- the peak resident set size (RSS) of the commands started by the action;
+- the number of bytes of the sources (input) and targets (output);
+- the number of cache hits and misses reported by the tools (see count()).
+
+At the end of the build the actions are written as a Chrome trace file (load it in chrome://tracing or
+https://ui.perfetto.dev), and a summary table per kind of action is written next to it (<trace file>.txt) and printed.
+"""
+
+
+from SCons.Script import *  # For PyCharm code completion
+import SCons.Action, SCons.Util
+
+import os
+import sys
+import json
+import time
+import atexit
+import resource
+import threading
+import subprocess
+
+
+_current = threading.local()    # record of the action that is run by a thread
+_counters = {}                  # cache counters, also those reported outside of actions
+_lock = threading.Lock()
+_tracer = None
+
+
+# Add n to a cache counter, e.g. count('urldownload.hit')
+# The counter is added to the record of the action that is run by the calling thread, if any, and to the build totals.
+# Does nothing when tracing is not enabled, so tools can call it unconditionally.
+def count(name, n=1):
+    if _tracer is None:
+        return
+    record = getattr(_current, 'record', None)
+    if record is not None:
+        record['counters'][name] = record['counters'].get(name, 0) + n
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + n
+
+
+# Add the resource use of a child process that is not run through SPAWN (e.g. a long-lived worker) to the record of the
+# action that is run by the calling thread. Does nothing when tracing is not enabled.
+# @param user_time user CPU seconds used by the child for the action
+# @param sys_time system CPU seconds used by the child for the action
+# @param maxrss peak resident set size of the child in KB
+def child_usage(user_time, sys_time, maxrss):
+    record = getattr(_current, 'record', None)
+    if _tracer is None or record is None:
+        return
+    record['child_user'] += user_time
+    record['child_sys'] += sys_time
+    record['child_maxrss'] = max(record['child_maxrss'], maxrss)
+
+
+# RUSAGE_THREAD is Linux specific and not defined by the resource module of python 2
+_RUSAGE_THREAD = getattr(resource, 'RUSAGE_THREAD', 1 if sys.platform.startswith('linux') else None)
+
+def _thread_cpu():
+    if _RUSAGE_THREAD is None:
+        return (0.0, 0.0)
+    try:
+        r = resource.getrusage(_RUSAGE_THREAD)
+    except (ValueError, resource.error):
+        return (0.0, 0.0)
+    return (r.ru_utime, r.ru_stime)
+
+
+def _size(nodes):
+    if not nodes:
+        return 0
+    if not SCons.Util.is_List(nodes):
+        nodes = [nodes]
+    size = 0
+    for n in nodes:
+        try:
+            size += os.path.getsize(n.get_abspath())
+        except (OSError, AttributeError):
+            pass
+    return size
+
+
+class _Tracer(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.start = time.time()
+        self.events = []
+        self._tids = {}
+
+    def _tid(self):
+        ident = threading.current_thread().ident
+        with _lock:
+            return self._tids.setdefault(ident, len(self._tids) + 1)
+
+    # Run an action and record it
+    def run(self, call, action, target, source, env, args, kw):
+        executor = kw.get('executor')
+        if executor is not None:
+            # As in the action, the targets and sources are taken from the executor
+            target = executor.get_all_targets()
+            source = executor.get_all_sources()
+        record = {
+            'kind': _action_kind(action),
+            'user': 0.0, 'sys': 0.0, 'child_user': 0.0, 'child_sys': 0.0, 'child_maxrss': 0,
+            'input': _size(source),
+            'counters': {},
+        }
+        outer = getattr(_current, 'record', None)
+        _current.record = record
+        cpu = _thread_cpu()
+        start = time.time()
+        try:
+            return call(action, target, source, env, *args, **kw)
+        finally:
+            end = time.time()
+            cpu_end = _thread_cpu()
+            _current.record = outer
+            record['user'] = cpu_end[0] - cpu[0]
+            record['sys'] = cpu_end[1] - cpu[1]
+            record['output'] = _size(target)
+            record['wall'] = end - start
+            event = {
+                'name': str(target[0] if SCons.Util.is_List(target) else target) if target else record['kind'],
+                'cat': record['kind'],
+                'ph': 'X',
+                'ts': int((start - self.start) * 1000000),
+                'dur': int((end - start) * 1000000),
+                'pid': os.getpid(),
+                'tid': self._tid(),
+                'args': record,
+            }
+            with _lock:
+                self.events.append(event)
+
+    # Write the trace file and the summary table
+    def write(self):
+        summary = self.summary()
+        try:
+            with open(self.path, 'w') as f:
+                json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms',
+                           'otherData': {'counters': _counters, 'wall': time.time() - self.start,
+                                         'maxrss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}}, f)
+            with open(self.path + '.txt', 'w') as f:
+                f.write('\n'.join(summary) + '\n')
+        except (IOError, OSError), e:
+            print "perftrace: could not write %s: %s" % (self.path, e)
+            return
+        print '\n'.join(summary)
+        print "perftrace: trace written to %s" % self.path
+
+    # Return the summary table as list of lines
+    def summary(self):
+        kinds = {}
+        for e in self.events:
+            r = e['args']
+            k = kinds.setdefault(r['kind'], {'n': 0, 'wall': 0.0, 'cpu': 0.0, 'child_cpu': 0.0, 'child_maxrss': 0,
+                                             'input': 0, 'output': 0})
+            k['n'] += 1
+            k['wall'] += r['wall']
+            k['cpu'] += r['user'] + r['sys']
+            k['child_cpu'] += r['child_user'] + r['child_sys']
+            k['child_maxrss'] = max(k['child_maxrss'], r['child_maxrss'])
+            k['input'] += r['input']
+            k['output'] += r['output']
+        lines = ['%-32s %6s %10s %10s %10s %10s %10s %10s' %
+                 ('action', 'count', 'wall (s)', 'cpu (s)', 'child cpu', 'child rss', 'in (MB)', 'out (MB)')]
+        for (name, k) in sorted(kinds.items(), key=lambda i: -i[1]['wall']):
+            lines.append('%-32s %6d %10.2f %10.2f %10.2f %9dM %10.1f %10.1f' %
+                         (name[:32], k['n'], k['wall'], k['cpu'], k['child_cpu'], k['child_maxrss'] / 1024,
+                          k['input'] / 1048576.0, k['output'] / 1048576.0))
+        lines.append('build: %.2fs wall, %d actions, SCons peak rss %dM' %
+                     (time.time() - self.start, len(self.events),
+                      resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+        if _counters:
+            lines.append('caches: ' + ', '.join( '%s=%d' % i for i in sorted(_counters.items()) ))
+        return lines
+
+
+_GENERIC_NAMES = ('action', 'function', '<lambda>')
+
+# Return a short name for the kind of an action: the name of the python function that is run. Functions with a
+# generic name (e.g. "__action" of URLDownload) are named after their module, e.g. "URLDownload.action". For a command
+# the name of the program that is run is filled in by _spawn()
+def _action_kind(action):
+    f = getattr(action, 'execfunction', None)
+    if isinstance(f, SCons.Action.ActionCaller):
+        f = f.parent.actfunc    # E.g. Copy()
+    if f is None:
+        return 'command'
+    name = getattr(f, '__name__', 'function').lstrip('_')
+    if name in _GENERIC_NAMES and getattr(f, '__module__', None):
+        name = f.__module__.split('.')[-1] + '.' + name
+    return name
+
+
+# Replacement of the SPAWN of the posix platform that records the resource use of the command
+def _spawn(sh, escape, cmd, args, env):
+    proc = subprocess.Popen([sh, '-c', ' '.join(args)], env=env, close_fds=True)
+    (pid, status, rusage) = os.wait4(proc.pid, 0)
+    proc.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+    record = getattr(_current, 'record', None)
+    if record is not None:
+        if record['kind'] == 'command':
+            # The program that is run, e.g. "pyff" for "cd dir && pyff pipeline.fd"
+            words = args[args.index('&&') + 1:] if '&&' in args else args
+            record['kind'] = os.path.basename(words[0]) if words else 'command'
+        record['child_user'] += rusage.ru_utime
+        record['child_sys'] += rusage.ru_stime
+        record['child_maxrss'] = max(record['child_maxrss'], rusage.ru_maxrss)
+    return proc.returncode
+
+
+# Enable tracing of the actions of an environment and of its clones
+# SCons has no hook that is called around every action, so the call of the actions is replaced. This is only done
+# when tracing is enabled, only the actions of environments with PERFTRACE set are traced, and the original call is
+# restored when the trace is written.
+# @param path name of the Chrome trace file. The summary is written to path + ".txt"
+def _PerfTrace(env, path):
+    global _tracer
+    if _tracer is not None:
+        return
+    env['PERFTRACE'] = path
+    _tracer = _Tracer(env.File(path).abspath)
+    call = SCons.Action._ActionAction.__call__
+
+    def traced_call(self, target, source, env, *args, **kw):
+        # env is None for the Link and Unlink actions that SCons runs itself, these are traced as well
+        if _tracer is None or (env is not None and not env.get('PERFTRACE')):
+            return call(self, target, source, env, *args, **kw)
+        return _tracer.run(call, self, target, source, env, args, kw)
+
+    def finish():
+        global _tracer
+        SCons.Action._ActionAction.__call__ = call
+        tracer = _tracer
+        _tracer = None
+        tracer.write()
+
+    SCons.Action._ActionAction.__call__ = traced_call
+    if os.name == 'posix' and hasattr(os, 'wait4'):
+        env['SPAWN'] = _spawn
+    atexit.register(finish)
+
+
+# Called by the Environment.Tools function
+# Add ourselves to the environment
+def generate(env):
+    env.AddMethod(_PerfTrace, "PerfTrace")
+
+
+# Called during initialisation
+# The tool can make it known whether it exists (i.e. is available)
+def exists(env):
+    return 1
@@ -0,0 +1,173 @@
+# Copyright 2015 GIP RENATER
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Promotion of files without copying their data
+
+clone() puts a file in place under another name using (in order of the methods asked for):
+- reflink: a copy-on-write clone of the data (Linux, on file systems that support it, e.g. btrfs and XFS);
+- hardlink: a second name for the same file. The file must then not be changed in place, which holds for the files
+  made by SCons actions (SCons removes a target before building it);
+- copy: a copy of the data.
+The file is put in place with an atomic rename, so a reader never sees a partially written file.
+
+ContentStore keeps files by a hash of their content. Files with the same content that are promoted in different
+places (e.g. the same metadata tested in two stages, or in the builds that follow) are hardlinks of one stored file.
+
+This module does not depend on SCons so it can be used from scripts as well.
+"""
+
+import os
+import errno
+import shutil
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+METHODS = ('reflink', 'hardlink', 'copy')
+
+# ioctl to clone a file on Linux (_IOW(0x94, 9, int))
+_FICLONE = 0x40049409
+
+
+def _reflink(src, dst):
+    if fcntl is None or not hasattr(os, 'uname') or os.uname()[0] != 'Linux':
+        raise OSError(errno.EOPNOTSUPP, 'reflinks are not supported')
+    with open(src, 'rb') as s, open(dst, 'wb') as d:
+        fcntl.ioctl(d.fileno(), _FICLONE, s.fileno())
+    shutil.copystat(src, dst)
+
+
+def _hardlink(src, dst):
+    os.link(src, dst)
+
+
+def _copy(src, dst):
+    shutil.copy2(src, dst)
+
+
+_functions = {'reflink': _reflink, 'hardlink': _hardlink, 'copy': _copy}
+
+
+# Put a file with the content of src in place at dst
+# @param methods methods to try, in order (see METHODS)
+# @return the method that was used
+def clone(src, dst, methods=METHODS):
+    tmp = '%s.%d.%d.promote' % (dst, os.getpid(), threading.current_thread().ident)
+    error = None
+    for method in methods:
+        try:
+            _functions[method](src, tmp)
+        except (IOError, OSError), e:
+            error = e
+            _remove(tmp)
+            continue
+        try:
+            os.rename(tmp, dst)
+        except OSError:
+            _remove(tmp)
+            raise
+        return method
+    raise error or ValueError('no promotion method')
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+# Files by a hash of their content, in a directory. Only hardlinks are stored: a stored file shares its data with
+# all the places it is promoted to.
+class ContentStore(object):
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._pruned = False
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    # Store the file at path under key (a hash of its content) and return the stored file
+    # @return path of the stored file, or None when it can not be hardlinked (e.g. another file system)
+    def add(self, path, key):
+        self.prune()
+        stored = self._path(key)
+        if os.path.isfile(stored):
+            return stored
+        try:
+            if not os.path.isdir(os.path.dirname(stored)):
+                try:
+                    os.makedirs(os.path.dirname(stored))
+                except OSError:
+                    if not os.path.isdir(os.path.dirname(stored)):
+                        raise
+            clone(path, stored, ('hardlink',))
+        except (IOError, OSError):
+            return None
+        return stored
+
+    # Remove the stored files that are not linked from anywhere else (i.e. that have a link count of 1)
+    # Only the first call does the pruning, so files are pruned once per build, before files are added
+    def prune(self):
+        with self._lock:
+            if self._pruned:
+                return
+            self._pruned = True
+        if not os.path.isdir(self.directory):
+            return
+        for d in os.listdir(self.directory):
+            d = os.path.join(self.directory, d)
+            if not os.path.isdir(d):
+                continue
+            for name in os.listdir(d):
+                path = os.path.join(d, name)
+                try:
+                    if os.stat(path).st_nlink == 1:
+                        os.remove(path)
+                except OSError:
+                    pass
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+# Return the (shared) ContentStore for a directory
+def get_store(directory):
+    directory = os.path.abspath(directory)
+    with _stores_lock:
+        if directory not in _stores:
+            _stores[directory] = ContentStore(directory)
+        return _stores[directory]
+
+
+# Promote src to dst, through the store when one is given
+# @param store ContentStore or None
+# @param key hash of the content of src, for the store
+# @param methods methods to try, in order (see METHODS)
+# @return the method that was used
+def promote(src, dst, store=None, key=None, methods=METHODS):
+    if store is not None and 'hardlink' in methods:
+        stored = store.add(src, key)
+        if stored is not None:
+            try:
+                return clone(stored, dst, ('hardlink',))
+            except (IOError, OSError):
+                pass
+    return clone(src, dst, methods)
@@ -0,0 +1,160 @@
+# Copyright 2015 GIP RENATER
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+""" SCons tool for publishing files with precompressed variants
+
+Usage:
+env = Environment(tools=['publish'], toolpath='<(relative) path to publish.py>')
+env.Publish('signed.xml')
+
+Writes next to the file:
+- signed.xml.gz: the file compressed with gzip (at PUBLISH_GZIP_LEVEL, default 9);
+- signed.xml.br: the file compressed with brotli, when PUBLISH_BROTLI is set (requires the brotli python module);
+- signed.xml.json: a sidecar with the size, the SHA-256 and a strong ETag of the file and of each variant, and the
+  Last-Modified date of the file, for the web server.
+A web server can serve the variants directly (e.g. nginx gzip_static) instead of compressing the file for every
+request. The variants have the same modification time as the file and are reproducible (the gzip header has no file
+name and no time), so their ETags only change when the content changes.
+
+Each variant is a separate SCons command, so with -j they are written in parallel. As any SCons target they are only
+written again when the content signature of the file changes. Files are written to a temporary file that is renamed,
+so a web server never serves a partially written file.
+"""
+
+
+import SCons.Action
+import SCons.Errors
+import SCons.Util
+
+import os
+import json
+import gzip
+import hashlib
+from email.utils import formatdate
+
+try:
+    import brotli as _brotli
+except ImportError:
+    _brotli = None
+
+from urlcache import AtomicFile
+
+
+# Publish a file with precompressed variants and a sidecar
+# @param env environment object
+# @param source file to publish
+# @param target sidecar file. Defaults to the source file + '.json'
+# @param brotli write a brotli variant. Defaults to PUBLISH_BROTLI
+# @return list of the variant and sidecar nodes
+def _publish(env, source, target=None, brotli=None):
+    if SCons.Util.is_List(source):
+        source = source[0]      # E.g. the result of a builder
+    source = env.File(source)
+    if target is None:
+        target = source.abspath + '.json'
+    if brotli is None:
+        brotli = env.get('PUBLISH_BROTLI')
+    encodings = [('gzip', '.gz')]
+    if brotli:
+        if _brotli is None:
+            raise SCons.Errors.UserError("Publish: the brotli python module is required for the brotli variant of %s" %
+                                         source)
+        encodings.append(('br', '.br'))
+
+    nodes = []
+    variants = []
+    for (encoding, suffix) in encodings:
+        variant = env.Command(source.abspath + suffix, source,
+                              SCons.Action.Action(_compress_action, _compress_strfunction,
+                                                  varlist=['PUBLISH_GZIP_LEVEL', 'PUBLISH_BROTLI_QUALITY']),
+                              PUBLISH_ENCODING=encoding)
+        nodes += variant
+        variants.append( (encoding, variant[0]) )
+    sidecar = env.Command(target, [source] + [ v for (e, v) in variants ],
+                          SCons.Action.Action(_sidecar_action, _sidecar_strfunction, varlist=['PUBLISH_CONTENT_TYPE']),
+                          PUBLISH_ENCODINGS=[ e for (e, v) in variants ])
+    nodes += sidecar
+    return nodes
+
+
+# Write a compressed variant of the source to the target
+def _compress_action(target, source, env):
+    encoding = env['PUBLISH_ENCODING']
+    path = target[0].abspath
+    with open(source[0].abspath, 'rb') as f:
+        data = f.read()
+    with AtomicFile(path) as out:
+        if encoding == 'gzip':
+            # No file name and time in the header, so the output only depends on the content
+            z = gzip.GzipFile(filename='', mode='wb', compresslevel=int(env['PUBLISH_GZIP_LEVEL']), fileobj=out,
+                              mtime=0)
+            z.write(data)
+            z.close()
+        else:
+            out.write(_brotli.compress(data, quality=int(env['PUBLISH_BROTLI_QUALITY'])))
+    # The same Last-Modified as the file
+    st = os.stat(source[0].abspath)
+    os.utime(path, (st.st_atime, st.st_mtime))
+    return 0
+
+def _compress_strfunction(target, source, env):
+    return "Publish: %s (%s)" % (target[0], env['PUBLISH_ENCODING'])
+
+
+# Write the sidecar of the source (the first source) and its variants (the other sources)
+def _sidecar_action(target, source, env):
+    sidecar = _describe(source[0].abspath)
+    sidecar['content_type'] = env.subst('$PUBLISH_CONTENT_TYPE')
+    sidecar['last_modified'] = formatdate(os.stat(source[0].abspath).st_mtime, usegmt=True)
+    sidecar['encodings'] = {}
+    for (encoding, variant) in zip(env['PUBLISH_ENCODINGS'], source[1:]):
+        sidecar['encodings'][encoding] = _describe(variant.abspath)
+    with AtomicFile(target[0].abspath) as f:
+        json.dump(sidecar, f, indent=1, sort_keys=True)
+    return 0
+
+def _sidecar_strfunction(target, source, env):
+    return "Publish: %s" % target[0]
+
+# @return dict with the file name, size, SHA-256 and ETag of a file
+def _describe(path):
+    h = hashlib.sha256()
+    size = 0
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1048576), ''):
+            h.update(block)
+            size += len(block)
+    return {
+        'file': os.path.basename(path),
+        'size': size,
+        'sha256': h.hexdigest(),
+        'etag': '"%s"' % h.hexdigest(),
+    }
+
+
+# Called by the Environment.Tools function
+# Add ourselves to the environment
+def generate(env):
+    env.SetDefault(PUBLISH_GZIP_LEVEL=9)
+    env.SetDefault(PUBLISH_BROTLI=False)
+    env.SetDefault(PUBLISH_BROTLI_QUALITY=11)
+    env.SetDefault(PUBLISH_CONTENT_TYPE='application/samlmetadata+xml')
+    env.AddMethod(_publish, "Publish")
+
+
+# Called during initialisation
+# The tool can make it known whether it exists (i.e. is available)
+def exists(env):
+    return 1
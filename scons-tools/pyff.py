@@ -26,13 +26,29 @@ Introduction to building tools: https://bitbucket.org/scons/scons/wiki/ToolsForF
 
 
 from SCons.Script import *  # For PyCharm code completion
-import SCons.Builder, SCons.Util
+import SCons.Builder, SCons.Util, SCons.Errors, SCons.Action
 
 import re
 import yaml
 import hashlib
 import os
 import string
+import shutil
+import json
+import atexit
+import time
+import threading
+import subprocess
+
+from urlcache import AtomicFile
+import perftrace
+import resources
+
+try:
+    import xmlsig
+    from lxml import etree
+except ImportError:
+    xmlsig = None
 
 
 """ Build command for exececuting pyff
@@ -64,6 +80,8 @@ finalize: Optional. Tuple of attributes to set on the SAML 2.0 EntitiesDescripto
           - validUntil: Expiry date. ISO 8601 time string or XML timedelta expression. E.g. valid for 6 days starting
              now: PT6D
 xslt:    Optional. String or Node object. The xslt stylesheet to apply to the output
+mdq:     Optional. Directory to publish the entities of the output to, one signed file per entity. See the mdq builder
+         of the mdstream tool
 
 The order of the generated pipeline is:
 - load: Load the file(s) specified in source. This makes these files available for selection
@@ -72,10 +90,11 @@ The order of the generated pipeline is:
 - finalize: Set Name, cacheDuration and validUntil
 - xslt: Apply XSLT stylesheet
 - publish: Write metadata to target
+- mdq: Publish the entities of target one file per entity (when mdq is given)
 """
 # Stand alone peudo builder
 # Returns target nodes
-def _pyff(env, source, target=[], select=None, remove=[], finalize=None, xslt=None) :
+def _pyff(env, source, target=[], select=None, remove=[], finalize=None, xslt=None, mdq=None) :
 
     target_node=env.File(target)
     source_nodes=None   # Make list of (Node, selecor)
@@ -92,6 +111,13 @@ def _pyff(env, source, target=[], select=None, remove=[], finalize=None, xslt=No
     if select and not SCons.Util.is_List(select):
         select=[select]
 
+    # pyff is run in its own directory next to the target, so the .cache directory that pyff makes in the current
+    # directory is not shared with other pyff processes (scons -j). The paths in the fd file are relative to it
+    target_name = os.path.basename(target_node.path).translate(string.maketrans(' /\\', '___'))
+    run_dir = target_node.dir.Dir('pyff_' + target_name + '.run')
+    def rel(node):
+        return os.path.relpath(node.abspath, run_dir.abspath)
+
     ## Generate the fd file for pyff
     # Load
     # Note: The currently unreleased pyFF 0.10dev supports additional load options that change the behaviour of pyFF when loading metadata:
@@ -102,7 +128,7 @@ def _pyff(env, source, target=[], select=None, remove=[], finalize=None, xslt=No
     #fd= '- load max_workers 1 timeout 10 validate True fail_on_error True filter_invalid False:\n' # Load for pyFF 0.10dev
     fd= '- load:\n' # Load for pyFF 0.9.4
     for s in source_nodes :
-        fd+='  - ' + s[0].path +' as ' + s[1]
+        fd+='  - ' + rel(s[0]) +' as ' + s[1]
         fd+='\n'
 
     # Select
@@ -162,12 +188,11 @@ def _pyff(env, source, target=[], select=None, remove=[], finalize=None, xslt=No
     if xslt:
         xslt_node=env.File(xslt)
         fd+='- xslt:\n'
-        fd+='    stylesheet: ' + xslt_node.path + '\n'
+        fd+='    stylesheet: ' + rel(xslt_node) + '\n'
 
     fd+='- publish:\n'
-    fd+='    output: ' + target_node.path + '\n'
+    fd+='    output: ' + rel(target_node) + '\n'
 
-    target_name = os.path.basename(target_node.path).translate(string.maketrans(' /\\', '___'))
     fd_filename = "pyff_" + target_name + '_' + hashlib.sha1(fd).hexdigest() + ".fd"
     fd_node = env.File( fd_filename )
     #env.AlwaysBuild(fd_node)
@@ -181,63 +206,259 @@ def _pyff(env, source, target=[], select=None, remove=[], finalize=None, xslt=No
     source_nodes.append( (fd_node, None) )
     env.Clean(c1, fd_node)
 
-    # Note: pyff creates a .cache directory in current directory (i.e. the root dir, not the build dir)
-    c2 = env.Command( target_node, [ s[0] for s in source_nodes ], ["$PYFF --loglevel=${PYFF_LOGLEVEL} "+fd_node.path] )
+    if env.get('PYFF_MODE', 'subprocess') == 'worker':
+        pyff_actions = [ SCons.Action.Action(_pyff_worker_action, _pyff_worker_strfunction) ]
+    else:
+        pyff_actions = [ SCons.Action.Action(_pyff_action, _pyff_strfunction,
+                                             varlist=['PYFF', 'PYFF_LOGLEVEL', 'PYFF_RUN_DIR']) ]
+    c2 = env.Command( target_node, [ s[0] for s in source_nodes ], pyff_actions, PYFF_RUN_DIR=run_dir.path )
     if xslt_node:
         env.Depends(c2, xslt_node)
 
+    if mdq:
+        return [ c1, c2, env.mdq(source=target_node, target=mdq) ]
     return [ c1, c2 ]
 
 
+# Make a new, empty directory to run pyff in
+def _make_run_dir(run_dir):
+    shutil.rmtree(run_dir, ignore_errors=True)   # Left behind by an interrupted build
+    os.makedirs(run_dir)
+
+# Run pyff for the .fd file (the last source) in $PYFF_RUN_DIR. The directory is removed afterwards, also when pyff
+# fails
+def _pyff_action(target, source, env):
+    run_dir = env['PYFF_RUN_DIR']
+    _make_run_dir(run_dir)
+    try:
+        return _pyff_command(target, source, env)
+    finally:
+        shutil.rmtree(run_dir, ignore_errors=True)
+
+def _pyff_strfunction(target, source, env):
+    return None     # The command is printed when it is run
+
+_pyff_command = SCons.Action.Action("cd ${PYFF_RUN_DIR} && $PYFF --loglevel=${PYFF_LOGLEVEL} ${SOURCES[-1].abspath}")
+
+
+""" Long-lived pyFF process that runs all pipelines (PYFF_MODE=worker)
+The worker (scripts/pyffworker.py) is started on first use and runs under the python interpreter of the pyFF
+installation. This is the interpreter in $PYFF_PYTHON, or else the interpreter from the "#!" line of the $PYFF script.
+Pipelines are run one at a time. Each request holds the resource tokens of a pyff command (see resources.py) and the
+CPU time and peak memory reported by the worker are added to the performance trace of the action (see perftrace.py).
+When the worker can not be started pipelines are run using $PYFF instead.
+"""
+class _PyffWorker(object):
+
+    def __init__(self):
+        self.process = None
+        self.failed = False
+        self.lock = threading.Lock()
+
+    def _python(self, env):
+        if 'PYFF_PYTHON' in env:
+            return env.subst('$PYFF_PYTHON').split()
+        try:
+            with open(env.subst('$PYFF'), 'r') as f:
+                line = f.readline()
+            if line.startswith('#!') and 'python' in line:
+                return line[2:].split()
+        except IOError:
+            pass
+        return ['python']
+
+    def _start(self, env):
+        script = env.File('#scripts/pyffworker.py').srcnode().abspath
+        command = self._python(env) + [script, env.subst('$PYFF_WORKER_CACHE')]
+        print "Starting pyff worker: " + ' '.join(command)
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, env=env['ENV'])
+
+    # Run a pipeline
+    # @param env environment object
+    # @param pipeline path of the .fd file
+    # @param directory directory to run the pipeline in
+    # @return reply dict from the worker, or None when the worker is not available
+    def run(self, env, pipeline, directory):
+        with self.lock:
+            if self.failed:
+                return None
+            start = time.time()
+            with resources.pool.use(resources.needs(env.subst('$PYFF') + ' ' + pipeline)):
+                if time.time() - start > 0.1:
+                    perftrace.count('resources.wait')
+                try:
+                    if self.process is None:
+                        self._start(env)
+                    self.process.stdin.write(json.dumps({'pipeline': pipeline, 'directory': directory, 'loglevel': env.subst('${PYFF_LOGLEVEL}')}) + '\n')
+                    self.process.stdin.flush()
+                    line = self.process.stdout.readline()
+                except (OSError, IOError), e:
+                    line = None
+                    print "WARNING: pyff worker failed: %s" % e
+            if not line:
+                print "WARNING: pyff worker not available, running pyff for each pipeline"
+                self.failed = True
+                return None
+            reply = json.loads(line)
+            perftrace.child_usage(reply.get('user', 0.0), reply.get('sys', 0.0), reply.get('maxrss', 0))
+            return reply
+
+    def stop(self):
+        if self.process is not None:
+            self.process.stdin.close()
+            self.process.wait()
+            self.process = None
+
+_worker = _PyffWorker()
+atexit.register(_worker.stop)
+
+
+def _pyff_worker_action(target, source, env):
+    fd_path = source[-1].path  # The .fd file is the last source
+    run_dir = env['PYFF_RUN_DIR']
+    _make_run_dir(run_dir)
+    try:
+        reply = _worker.run(env, os.path.abspath(fd_path), os.path.abspath(run_dir))
+        if reply is None:
+            # Fallback to running pyff
+            return _pyff_command(target, source, env)
+        if reply['status'] != 0:
+            print "pyff worker: error running '%s': %s" % (fd_path, reply.get('error'))
+        return reply['status']
+    finally:
+        shutil.rmtree(run_dir, ignore_errors=True)
+
+def _pyff_worker_strfunction(target, source, env):
+    return "pyff worker: " + source[-1].path
+
+
+""" Build command for running a hand-written pyff pipeline (.fd) file
+The inputs (load resources and verification certificates) and outputs (publish) of the pipeline are found by scanning
+the .fd file (see _pyff_emitter). Relative paths in the pipeline are relative to the directory of the .fd file, pyff is
+run in that directory. pyff makes its .cache directory there, so pipelines in the same directory are run one at a time.
+
+source:  The pyff pipeline file. String or Node.
+
+Returns the target nodes: the published files.
+"""
+def _pyff_pipeline(env, source):
+    action = SCons.Action.Action(_pyff_pipeline_action, _pyff_pipeline_strfunction, varlist=['PYFF', 'PYFF_LOGLEVEL'])
+    builder = SCons.Builder.Builder(action=action, emitter=_pyff_emitter)
+    return builder(env, [], env.File(source))
+
+
+_directory_locks = {}   # directory => lock, held while pyff runs in the directory
+_directory_locks_lock = threading.Lock()
+
+def _pyff_pipeline_action(target, source, env):
+    directory = source[0].dir.abspath
+    with _directory_locks_lock:
+        lock = _directory_locks.setdefault(directory, threading.Lock())
+    with lock:
+        return _pyff_pipeline_command(target, source, env)
+
+def _pyff_pipeline_strfunction(target, source, env):
+    return None     # The command is printed when it is run
+
+_pyff_pipeline_command = SCons.Action.Action("cd ${SOURCE.dir} && $PYFF --loglevel=${PYFF_LOGLEVEL} ${SOURCE.file}")
+
+
 """ Scan a pyff .fd file for sources (input files) and targets (files generated)
+The result of a scan is kept in $PYFF_SCANDIR by the content signature of the .fd file, so an unchanged pipeline is
+not parsed again.
 """
 def _pyff_emitter(target, source, env):
-    target_add = set()
-    source_add = set()
+    target_add = []
+    source_add = []
 
-    # Match: "resource [as url] [[verify] verification] [via pipeline]"
-    load_arg_re = re.compile('^\s*(?P<resource>\S+)(?:\s+as\s+\S+)?(?:\s+(?:verify\s+)?(?P<verification>\S+))?(?:\s+via\s+\S+)?\s*$', re.IGNORECASE)
     for fn in source:
-        with open(fn.abspath, 'r') as stream:
-            f = yaml.safe_load(stream)
-            stream.close()
-
-            def walk_pipe(d):
-                for k,v in d.iteritems():
-                    if k.strip().startswith('load'):
-                        for arg in v:
-                            m=load_arg_re.match(arg)
-                            if (m != None):
-                                r = m.group('resource')
-                                if r.startswith('http://') or r.startswith('https://'):
-                                    print "Warning: dynamic dowloaded resource '{0}' in '{1}'. Ignoring...".format(r, fn.path)
-                                else:
-                                    source_add.add(r)
-                                #if 'verification' in m.groupdict().keys():
-                                if m.group('verification') != None:
-                                    print m.group('verification')
-                                    source_add.add( m.group('verification') )
-                            else:
-                                raise Exception( "Parse error while scanning '{0}' for dependencies. Expected argument format 'load resource [as url] [[verify] verification] [via pipeline]', found '{1}'".format(fn.abspath, arg) )
-                    elif k.strip().startswith('publish'):
-                        if isinstance(v, str):
-                            target_add.add(v)
-                        elif isinstance(v, dict) and 'output' in v.keys():
-                            target_add.add( v['output'] )
+        scan = _scan_pipeline(env, fn)
+        for r in scan['remote']:
+            print "Warning: dynamic dowloaded resource '{0}' in '{1}'. Ignoring...".format(r, fn.path)
+        source_add.extend( fn.dir.File(s) for s in scan['sources'] )
+        target_add.extend( fn.dir.File(t) for t in scan['targets'] )
+
+    if not target and not target_add:
+        raise SCons.Errors.UserError("pyff: no 'publish' found in '%s'" % ', '.join( [ str(s) for s in source ] ))
+    return target + target_add, source + source_add
+
+
+# Return the scan of a pyff .fd file: dict with the (relative) 'sources' and 'targets' of the pipeline, and the
+# 'remote' resources that are loaded by URL
+def _scan_pipeline(env, fn):
+    scan_path = None
+    if env.get('PYFF_SCANDIR'):
+        scan_path = os.path.join(env.Dir('$PYFF_SCANDIR').abspath, fn.get_csig() + '.json')
+        try:
+            with open(scan_path, 'r') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            pass
+
+    scan = _parse_pipeline(fn)
+    if scan_path:
+        try:
+            if not os.path.isdir(os.path.dirname(scan_path)):
+                os.makedirs(os.path.dirname(scan_path))
+            with AtomicFile(scan_path) as f:
+                json.dump(scan, f)
+        except (IOError, OSError), e:
+            print "WARNING: could not store scan of '{0}': {1}".format(fn.path, e)
+    return scan
+
+
+# Match: "resource [as url] [[verify] verification] [via pipeline]"
+_load_arg_re = re.compile('^\s*(?P<resource>\S+)(?:\s+as\s+\S+)?(?:\s+(?:verify\s+)?(?P<verification>\S+))?(?:\s+via\s+\S+)?\s*$', re.IGNORECASE)
+
+# The C implementation of the YAML loader (when PyYAML was built with libyaml) is much faster
+_yaml_loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+# Parse a pyff .fd file and walk the pipeline (recursively through forks) to find its sources and targets
+def _parse_pipeline(fn):
+    sources = []
+    targets = []
+    remote = []
+
+    def walk_pipe(d):
+        for k,v in d.iteritems():
+            if k.strip().startswith('load'):
+                for arg in v:
+                    m=_load_arg_re.match(arg)
+                    if (m != None):
+                        r = m.group('resource')
+                        if r.startswith('http://') or r.startswith('https://'):
+                            remote.append(r)
                         else:
-                            raise Exception( "Parse error while scanning '{0}' for dependencies. Found 'publish', but could not determine output file".format(fn.abspath) )
-                    elif k.strip().startswith('fork'):
-                        # Fork start a new pipline
-                        for i in v:
-                            if isinstance(i, dict):
-                                walk_pipe(i)
-            for i in f:
-                # Parse pipeline
-                if isinstance(i, dict):
-                    walk_pipe(i)
-        print "Scanned '{0}': Discovered sources: {1}; targets: {2}".format(fn.abspath, list(source_add), list(target_add))
-
-    return target + list(target_add), source + list(source_add)
+                            sources.append(r)
+                        if m.group('verification') != None:
+                            sources.append( m.group('verification') )
+                    else:
+                        raise Exception( "Parse error while scanning '{0}' for dependencies. Expected argument format 'load resource [as url] [[verify] verification] [via pipeline]', found '{1}'".format(fn.abspath, arg) )
+            elif k.strip().startswith('publish'):
+                if isinstance(v, basestring):
+                    targets.append(v)
+                elif isinstance(v, dict) and 'output' in v.keys():
+                    targets.append( v['output'] )
+                else:
+                    raise Exception( "Parse error while scanning '{0}' for dependencies. Found 'publish', but could not determine output file".format(fn.abspath) )
+            elif k.strip().startswith('fork'):
+                # Fork start a new pipline
+                for i in v:
+                    if isinstance(i, dict):
+                        walk_pipe(i)
+
+    with open(fn.abspath, 'r') as stream:
+        f = yaml.load(stream, Loader=_yaml_loader)
+    for i in f or []:
+        # Parse pipeline
+        if isinstance(i, dict):
+            walk_pipe(i)
+    # Remove duplicates, keeping the order
+    return {
+        'sources': [ s for (n, s) in enumerate(sources) if s not in sources[:n] ],
+        'targets': [ t for (n, t) in enumerate(targets) if t not in targets[:n] ],
+        'remote': remote,
+    }
 
 
 # Test whether the file is signed with the specified certificate
@@ -246,15 +467,58 @@ def _pyff_emitter(target, source, env):
 # @param certificate PEM encoded certificate
 # @param file XML file to check
 #
-# The "scripts/validatexmlsignature.sh" uses pyff to do the check
+# The signature is verified in the SCons process (see xmlsig.py) when lxml is available and TESTXMLSIGNATURE_NATIVE is
+# set. Successful verifications are remembered in $XMLSIG_CACHEDIR by the hash of the file and the fingerprint of the
+# certificate, so an unchanged file is not verified again.
+# Otherwise, and for signatures that xmlsig.py does not support, the "scripts/validatexmlsignature.sh" uses pyff to do
+# the check
 def _TestXMLSignature(env, certificate, file="${SOURCE}") :
     script_path=env.File('scripts/validatexmlsignature.sh').srcnode().path  # Get path before applying variant_dir with srcnode()
     certificate_path=env.File(certificate).path
+    script_command=script_path+" "+certificate_path+" "+file
+    if xmlsig is None or not env.get('TESTXMLSIGNATURE_NATIVE'):
+        return {
+            'action': SCons.Action.Action(script_command),
+            'depends': certificate
+        }
+
+    def verify_signature(target, source, env):
+        path = env.subst(file, target=target, source=source)
+        error = check_signature(None, path, target, source, env)
+        if error is not None:
+            print "TestXMLSignature: signature of '%s' is not valid: %s" % (path, error)
+            return 1
+        return 0
+
+    # Check for the parse once test runner of the Test builder (see test.py)
+    def check_signature(tree, path, target, source, env):
+        try:
+            cached = xmlsig.get_cache(env.Dir('$XMLSIG_CACHEDIR').abspath).verify(path, certificate_path, tree)
+        except xmlsig.UnsupportedSignature, e:
+            print "TestXMLSignature: %s, verifying using pyff" % e
+            if SCons.Action.Action(script_command)(target, source, env):
+                return 'verification using pyff failed'
+            return None
+        except (xmlsig.VerificationError, etree.Error, IOError), e:
+            return str(e)
+        perftrace.count('xmlsig.hit' if cached else 'xmlsig.miss')
+        if cached:
+            print "TestXMLSignature: '%s' was verified before" % path
+        return None
+
+    def verify_signature_strfunction(target, source, env):
+        return "TestXMLSignature: %s with %s" % (env.subst(file, target=target, source=source), certificate_path)
+
     return {
-        'action': SCons.Action.Action(script_path+" "+certificate_path+" ${SOURCE}"),
-        'depends': certificate
+        'action': SCons.Action.Action(verify_signature, verify_signature_strfunction),
+        'depends': certificate,
+        'check': check_signature,
+        'name': 'TestXMLSignature(%s)' % certificate_path,
+        'file': file,
+        'modifies': True
     }
 
+
 def _detect(env):
     pyff = env.WhereIs('pyff')
     if ('PYFF' in env):
@@ -271,9 +535,20 @@ def generate( env ) :
     if pyff:
         env['ENV']['LANG'] = 'en_US.UTF-8' # Required for pyff to parse files as UTF-8
         env['ENV']['PYFF'] = env['PYFF'] = pyff
+        env.SetDefault(PYFF_MODE = 'subprocess') # Set to 'worker' to run all pipelines in one long-lived pyff process
+        env.SetDefault(PYFF_WORKER_CACHE = 512)  # MB of metadata of which the worker keeps the parsed documents
+
+        env.SetDefault(CACHE_DIR = "#.scons-cache")
+        env.SetDefault(PYFF_SCANDIR = "${CACHE_DIR}/pyffscan")  # Scans of .fd files. Set to '' to scan each time
 
-        env.AddMethod(_TestXMLSignature, "TestXMLSignature")
         env.AddMethod(_pyff, "pyff")
+        env.AddMethod(_pyff_pipeline, "pyff_pipeline")
+
+    if pyff or xmlsig is not None:
+        env.SetDefault(CACHE_DIR = "#.scons-cache")
+        env.SetDefault(TESTXMLSIGNATURE_NATIVE = xmlsig is not None)  # Verify signatures in the SCons process
+        env.SetDefault(XMLSIG_CACHEDIR = "${CACHE_DIR}/xmlsig")     # Successful signature verifications
+        env.AddMethod(_TestXMLSignature, "TestXMLSignature")
 
 
 # Called during initialisation
@@ -0,0 +1,127 @@
+# Copyright 2015 GIP RENATER
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Resource tokens and scratch directories for running commands in parallel
+
+A ResourcePool has a number of tokens for each resource, e.g. 'memory' (MB) and 'jvm' (number of JVMs). A command
+takes the tokens it needs before it runs and returns them when it is done, so commands that would together use more
+than is available wait for each other. All tokens a command needs are taken at once, so commands can not deadlock.
+A command that needs more than the pool has gets all of it, i.e. it runs alone.
+
+scratch() makes a new directory for the temporary files of one command.
+
+This module does not depend on SCons so it can be used from scripts as well.
+"""
+
+import os
+import re
+import shutil
+import tempfile
+import threading
+from contextlib import contextmanager
+
+
+class ResourcePool(object):
+
+    def __init__(self):
+        self.capacity = {}      # resource => number of tokens
+        self.available = {}     # resource => number of tokens that are not taken
+        self._condition = threading.Condition()
+
+    # Set the number of tokens of a resource
+    # @param amount number of tokens, None for no limit
+    def limit(self, resource, amount):
+        with self._condition:
+            if amount is None:
+                self.capacity.pop(resource, None)
+                self.available.pop(resource, None)
+            else:
+                taken = self.capacity.get(resource, 0) - self.available.get(resource, 0)
+                self.capacity[resource] = amount
+                self.available[resource] = amount - taken
+            self._condition.notify_all()
+
+    # Return the tokens that are taken for needs (dict of resource => amount), limited to the capacity
+    def _clamp(self, needs):
+        return dict( (r, min(a, self.capacity[r])) for (r, a) in needs.items() if r in self.capacity and a > 0 )
+
+    # Take the tokens of needs (dict of resource => amount), waiting until they are all available
+    # @return the tokens that were taken, to pass to release()
+    def acquire(self, needs):
+        with self._condition:
+            taken = self._clamp(needs)
+            while any( self.available[r] < a for (r, a) in taken.items() ):
+                self._condition.wait()
+            for (r, a) in taken.items():
+                self.available[r] -= a
+            return taken
+
+    def release(self, taken):
+        with self._condition:
+            for (r, a) in taken.items():
+                if r in self.available:
+                    self.available[r] += a
+            self._condition.notify_all()
+
+    # Context manager that holds the tokens of needs
+    @contextmanager
+    def use(self, needs):
+        taken = self.acquire(needs)
+        try:
+            yield taken
+        finally:
+            self.release(taken)
+
+
+pool = ResourcePool()      # The pool shared by all commands of the build
+command_classes = []        # (regular expression, dict of resource => amount) of the commands of the build
+scratch_parent = None       # Parent directory of the scratch directories of the build, None for the tmp dir
+
+
+# Return the resources needed by a command
+# @param command command line
+# @param classes list of (regular expression, dict of resource => amount). The needs of the first expression that is
+#        found in the command are returned. Defaults to the classes of the build
+def needs(command, classes=None):
+    for (expression, amounts) in (classes if classes is not None else command_classes):
+        if re.search(expression, command):
+            return amounts
+    return {}
+
+
+# Context manager that makes a new scratch directory and removes it afterwards
+# @param directory parent directory of the scratch directory. Defaults to scratch_parent, or else the directory for
+#        temporary files
+@contextmanager
+def scratch(directory=None):
+    directory = directory or scratch_parent
+    if directory and not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            if not os.path.isdir(directory):
+                raise
+    path = tempfile.mkdtemp(prefix='scratch.', dir=directory or None)
+    try:
+        yield path
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+# Return the physical memory of this host in MB, or None when it is not known
+def physical_memory():
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') // 1048576
+    except (ValueError, OSError, AttributeError):
+        return None
@@ -0,0 +1,232 @@
+# Copyright 2015 GIP RENATER
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Helpers for processing SAML 2.0 metadata with lxml, shared by the metadata tools
+
+Metadata files are processed one EntityDescriptor at a time (iterentities) so memory use is bounded by the size of
+the largest entity, not by the size of the metadata file.
+
+This module does not depend on SCons so it can be used from scripts as well.
+"""
+
+import re
+import copy
+import hashlib
+from datetime import datetime, timedelta
+import _strptime  # Imported by the first datetime.strptime(), which is not thread safe in python 2
+
+from lxml import etree
+
+
+NS = {
+    'md': 'urn:oasis:names:tc:SAML:2.0:metadata',
+    'saml': 'urn:oasis:names:tc:SAML:2.0:assertion',
+    'ds': 'http://www.w3.org/2000/09/xmldsig#',
+    'xenc': 'http://www.w3.org/2001/04/xmlenc#',
+    'mdrpi': 'urn:oasis:names:tc:SAML:metadata:rpi',
+    'mdui': 'urn:oasis:names:tc:SAML:metadata:ui',
+    'mdattr': 'urn:oasis:names:tc:SAML:metadata:attribute',
+    'shibmd': 'urn:mace:shibboleth:metadata:1.0',
+    'idpdisc': 'urn:oasis:names:tc:SAML:profiles:SSO:idp-discovery-protocol',
+    'init': 'urn:oasis:names:tc:SAML:profiles:SSO:request-init',
+    'alg': 'urn:oasis:names:tc:SAML:metadata:algsupport',
+    'xsi': 'http://www.w3.org/2001/XMLSchema-instance',
+}
+
+ENTITY_DESCRIPTOR = '{%s}EntityDescriptor' % NS['md']
+ENTITIES_DESCRIPTOR = '{%s}EntitiesDescriptor' % NS['md']
+
+# Namespaces declared on the root of written metadata
+ROOT_NSMAP = dict( (p, NS[p]) for p in ('md', 'saml', 'ds', 'mdrpi', 'mdui', 'mdattr', 'shibmd') )
+
+
+# Iterate over the EntityDescriptor elements in a metadata file
+# The document is parsed incrementally. After an entity was yielded it is cleared and removed from the document,
+# so it must not be used after the next entity is requested. Use entity_document() to keep a copy.
+# Comments are not included.
+# @param source file name or file object of the metadata. The root element can be an EntitiesDescriptor or an
+#        EntityDescriptor
+def iterentities(source):
+    for event, e in etree.iterparse(source, events=('end',), tag=ENTITY_DESCRIPTOR, remove_comments=True,
+                                    huge_tree=True, resolve_entities=False, no_network=True):
+        yield e
+        release(e)
+
+
+# Return the root element of an XML file, without its children
+# Only the start of the file is read, up to and including the start tag of the root element
+# @param source file name
+def read_root(source):
+    with open(source, 'rb') as f:
+        for event, e in etree.iterparse(f, events=('start',), huge_tree=True, resolve_entities=False, no_network=True):
+            return e
+    return None
+
+
+# Free the memory used by an element that was returned by iterparse, and by its preceding siblings
+def release(e):
+    e.clear()
+    parent = e.getparent()
+    if parent is not None:
+        while e.getprevious() is not None:
+            del parent[0]
+
+
+# Return a new document with a copy of element e as root element
+# An XPath expression like "//md:EntityDescriptor[...]" evaluated on this document matches the root element
+def entity_document(e):
+    return etree.ElementTree(copy.deepcopy(e))
+
+
+# Return the SHA-1 (hex) of the content of a file
+def file_sha1(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(65536)
+            if not block:
+                break
+            h.update(block)
+    return h.hexdigest()
+
+
+_xmlns_re = re.compile(r'\s+xmlns:(?P<prefix>[\w.-]+)="(?P<uri>[^"]*)"')
+
+# Serialize an element for writing below a root element that declares the namespaces in nsmap
+# Namespace declarations on the element that are the same as those in nsmap are left out
+# @return UTF-8 encoded string
+def serialize(e, nsmap=ROOT_NSMAP):
+    data = etree.tostring(e, encoding='UTF-8', xml_declaration=False, with_tail=False)
+    end = data.index('>')
+    start_tag = _xmlns_re.sub(lambda m: '' if nsmap.get(m.group('prefix')) == m.group('uri') else m.group(0),
+                              data[:end])
+    return start_tag + data[end:]
+
+
+# Writes a metadata file with an EntitiesDescriptor root element
+# Usage:
+# with MetadataWriter(path, attrib) as w:
+#     w.write(samlmd.serialize(entity))
+class MetadataWriter(object):
+
+    # @param output file name or file object
+    # @param attrib dict with the attributes of the EntitiesDescriptor
+    # @param nsmap namespaces to declare on the EntitiesDescriptor
+    def __init__(self, output, attrib={}, nsmap=ROOT_NSMAP):
+        self.nsmap = nsmap
+        if hasattr(output, 'write'):
+            self._file = output
+            self._close = False
+        else:
+            self._file = open(output, 'wb')
+            self._close = True
+        root = etree.Element(ENTITIES_DESCRIPTOR, nsmap=nsmap)
+        for k in sorted(attrib.keys()):
+            root.set(k, attrib[k])
+        root.text = '\n'
+        data = etree.tostring(root, encoding='UTF-8', xml_declaration=False)
+        self._end_tag = data[data.rindex('</'):]
+        self._file.write("<?xml version='1.0' encoding='UTF-8'?>\n")
+        self._file.write(data[:data.rindex('</')])
+
+    # Write a serialized element (see serialize()) below the EntitiesDescriptor
+    def write(self, data):
+        self._file.write(data)
+        self._file.write('\n')
+
+    def close(self):
+        self._file.write(self._end_tag)
+        self._file.write('\n')
+        if self._close:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if type is None:
+            self.close()
+        elif self._close:
+            self._file.close()
+        return False
+
+
+_duration_re = re.compile(r'^(?P<sign>[-+]?)P(?:(?P<years>\d+)Y)?(?:(?P<months>\d+)M)?(?:(?P<days>\d+)D)?'
+                          r'(?:T(?:(?P<hours>\d+)H)?(?:(?P<minutes>\d+)M)?(?:(?P<seconds>\d+(?:\.\d+)?)S)?)?$')
+
+# Parse an xs:duration, e.g. "P10D" or "PT1H"
+# A month is counted as 30 days and a year as 365 days (as pyFF does)
+# @return timedelta, or None when s is not a duration
+def parse_duration(s):
+    m = _duration_re.match(s.strip())
+    if not m or s.strip() in ('P', 'PT', '-P', '+P'):
+        return None
+    d = m.groupdict(0)
+    delta = timedelta(days=int(d['days']) + int(d['months']) * 30 + int(d['years']) * 365,
+                      hours=int(d['hours']), minutes=int(d['minutes']), seconds=float(d['seconds']))
+    if d['sign'] == '-':
+        delta = -delta
+    return delta
+
+
+_datetime_re = re.compile(r'^(?P<date>\d{4,}-\d{2}-\d{2})T(?P<time>\d{2}:\d{2}:\d{2})(?P<fraction>\.\d+)?'
+                          r'(?P<tz>Z|[-+]\d{2}:\d{2})?$')
+
+# Parse an xs:dateTime, e.g. "2016-01-01T12:00:00Z"
+# A time without time zone is taken to be UTC
+# @return datetime in UTC (without tzinfo), or None when s is not an xs:dateTime
+def parse_datetime(s):
+    m = _datetime_re.match(s.strip())
+    if not m:
+        return None
+    dt = datetime.strptime(m.group('date') + 'T' + m.group('time'), '%Y-%m-%dT%H:%M:%S')
+    if m.group('fraction'):
+        dt += timedelta(seconds=float(m.group('fraction')))
+    tz = m.group('tz')
+    if tz and tz != 'Z':
+        offset = timedelta(hours=int(tz[1:3]), minutes=int(tz[4:6]))
+        dt = dt - offset if tz[0] == '+' else dt + offset
+    return dt
+
+
+# Format a UTC datetime as xs:dateTime
+def format_datetime(dt):
+    return dt.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+# Set the Name, cacheDuration and validUntil (and ID) attributes on an EntitiesDescriptor, like the pyFF finalize pipe
+# @param attrib dict with the attributes of the EntitiesDescriptor that is updated
+# @param finalize tuple of (Name, cacheDuration, validUntil). validUntil is an xs:dateTime or an xs:duration that
+#        is added to the current time
+def finalize(attrib, finalize, now=None):
+    if now is None:
+        now = datetime.utcnow()
+    (name, cache_duration, valid_until) = finalize[0:3]
+    if name:
+        attrib['Name'] = name
+    if not attrib.get('ID'):
+        attrib['ID'] = now.strftime('_%Y%m%dT%H%M%SZ')
+    if valid_until:
+        offset = parse_duration(valid_until)
+        if offset is not None:
+            attrib['validUntil'] = format_datetime(now + offset)
+        elif parse_datetime(valid_until) is not None:
+            attrib['validUntil'] = valid_until
+        else:
+            raise ValueError("validUntil '%s' is not an xs:duration or xs:dateTime" % valid_until)
+    if cache_duration:
+        if parse_duration(cache_duration) is None:
+            raise ValueError("cacheDuration '%s' is not an xs:duration" % cache_duration)
+        attrib['cacheDuration'] = cache_duration
+    return attrib
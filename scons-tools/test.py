@@ -16,6 +16,23 @@ import urllib2, urlparse
 import SCons.Builder, SCons.Node.FS, SCons.Errors, SCons.Action
 from SCons.Script import *
 
+import os
+import threading
+from datetime import datetime
+
+import promote
+
+# Directory of the bundled XML schemas
+SCHEMA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'schema')
+
+try:
+    from lxml import etree
+    import samlmd
+    import mddiff
+    import checks
+except ImportError:
+    etree = None
+
 
 # This is a "Test" builder
 # It is a SCons pseudo-builder that generates a build command
@@ -23,9 +40,12 @@ from SCons.Script import *
 
 # This builder creates a command from the actions provided in "tests"
 # Each test is an action
-# The final action copies the file. This way:
-# - All tests must be succeed before the file is copied
+# The final action promotes the file to the target. This way:
+# - All tests must be succeed before the file is promoted
 # - The tests are only run when the source files changed
+# The file is promoted without copying its data when possible (see promote.py): with a reflink, or with a hardlink
+# through the content store in TEST_STORE_DIR, so identical files (e.g. of other stages or earlier builds) share one
+# file. The methods to try are in TEST_PROMOTE.
 
 # @param env environment object
 # @param target target node
@@ -35,18 +55,41 @@ from SCons.Script import *
 # A test action must return a dict with the following format:
 # {
 #     'action': SCons.Action,
-#     'depends': (list of) Node/filenames
+#     'depends': (list of) Node/filenames,
+#     'check': function(tree, path, target, source, env),
+#     'name': string,
+#     'file': string,
+#     'modifies': bool,
+#     'tree': bool
 # }
 # - action is mandatory and is the action that executes the test. A test returns 0 on succes, nonzero otherwise.
 # - depends is optional. It can be used to add additional dependencies to the test
+# - check is optional. It is the same test, run against the parsed (lxml) tree of path. It returns None on success and
+#   an error message otherwise. When set, name must describe the test including its arguments, and file is the file
+#   to test (e.g. "${SOURCE}"). Set modifies to True when check changes the tree, also when libxml2 changes it (e.g.
+#   XML schema validation registers the IDs of the document). Set tree to False when check does not use the tree, it
+#   then gets None. A file is not parsed when none of its checks use the tree.
+#
+# When lxml is available and TEST_PARSE_ONCE is set, the tests that have a check are run by one action: each file
+# is parsed once and the checks run concurrently against the parsed tree (checks that modify the tree run after the
+# others, one at a time). The result and the time of each check is reported. The other tests run as before.
 def _test(env, target, source, tests = []) :
+    parsed = []
+    if etree is not None and env.get('TEST_PARSE_ONCE'):
+        parsed = [ test for test in tests if 'check' in test ]
+
     actions = []
+    if parsed:
+        actions.append( SCons.Action.Action(_run_checks, _run_checks_strfunction, varlist=['TEST_CHECKS']) )
     for test in tests:
-        actions.append( test['action'] )
-    actions.append( Copy(dest="$TARGET", src="$SOURCE") )
+        if not test in parsed:
+            actions.append( test['action'] )
+    actions.append( SCons.Action.Action(_promote, _promote_strfunction) )
 
     nodes = []
-    command = env.Command( target, source, actions )
+    command = env.Command( target, source, actions,
+                           TEST_CHECKS=[ "%s %s" % (test['name'], test['file']) for test in parsed ],
+                           TEST_CHECK_FUNCTIONS=checks.from_tests(parsed) if parsed else [] )
     for test in tests:
         if 'depends' in test:
             Depends(command, test['depends'])
@@ -56,12 +99,153 @@ def _test(env, target, source, tests = []) :
     return nodes
 
 
+# Run the checks of a Test command, see _test()
+def _run_checks(target, source, env):
+    return 1 if checks.run(env['TEST_CHECK_FUNCTIONS'], target, source, env, int(env.get('TEST_WORKERS', 4))) else 0
+
+def _run_checks_strfunction(target, source, env):
+    return "Test %s: running %d checks" % (source[0], len(env['TEST_CHECKS']))
+
+
+# Promote the tested file to the target, see _test()
+def _promote(target, source, env):
+    store = env.subst('$TEST_STORE_DIR')
+    store = promote.get_store(env.Dir(store).abspath) if store else None
+    try:
+        promote.promote(source[0].abspath, target[0].abspath, store, source[0].get_csig(), env['TEST_PROMOTE'])
+    except (IOError, OSError), e:
+        print "Promote %s: %s" % (target[0], e)
+        return 1
+    return 0
+
+def _promote_strfunction(target, source, env):
+    return 'Promote("%s", "%s")' % (target[0], source[0])
+
+
+_stylesheets = {}   # (path, mtime, size) => (XSLT, lock)
+_stylesheets_lock = threading.Lock()
+
+# Return the compiled XSLT of a file, and a lock that must be held while using it
+# The compiled stylesheet is cached for the duration of the build
+def _stylesheet(path):
+    st = os.stat(path)
+    key = (os.path.abspath(path), st.st_mtime, st.st_size)
+    with _stylesheets_lock:
+        if not key in _stylesheets:
+            _stylesheets[key] = (etree.XSLT(etree.parse(path)), threading.Lock())
+        return _stylesheets[key]
+
+
+_schemas = {}       # (path, mtime, size) => (XMLSchema, lock)
+_schemas_lock = threading.Lock()
+
+# Return the compiled XML schema of a file, and a lock that must be held while using it
+# The compiled schema is cached for the duration of the build. The imported schemas are not loaded from the network
+def _schema(path):
+    st = os.stat(path)
+    key = (os.path.abspath(path), st.st_mtime, st.st_size)
+    with _schemas_lock:
+        if not key in _schemas:
+            _schemas[key] = (etree.XMLSchema(etree.parse(path, etree.XMLParser(no_network=True))), threading.Lock())
+        return _schemas[key]
+
+
 # Test an XML file for well-formedness
 # Test action for use with the "Test" builder
 # @param env environment object
 # @param file file to test
 def _TestXMLWellFormedAction(env, file="${SOURCE}") :
-    return { 'action': SCons.Action.Action("${XMLLINT} --noout --nonet " + file) }
+    return {
+        'action': SCons.Action.Action("${XMLLINT} --noout --nonet " + file),
+        'check': _check_well_formed,
+        'name': 'TestXMLWellFormed',
+        'file': file
+    }
+
+# The file was parsed, so it is well-formed
+def _check_well_formed(tree, path, target, source, env):
+    return None
+
+
+# Test an XML file against an XML schema
+# Test action for use with the "Test" builder
+# With lxml the schema is compiled once per build and used for all files, without lxml "xmllint --schema" is used.
+# The default schema (TEST_SCHEMA) is the bundled schema of SAML 2.0 metadata and its extensions (xmldsig, xmlenc,
+# mdui, mdrpi, mdattr, alg, idpdisc and shibmd) in the schema directory.
+# @param env environment object
+# @param schema optional XML schema file. Defaults to TEST_SCHEMA
+# @param entities when True the file is read and validated one EntityDescriptor at a time, which uses less memory
+#        for large files. The other content of an EntitiesDescriptor (e.g. Extensions, Signature) is then not validated
+#        (requires lxml)
+# @param file file to test
+def _TestXMLSchema(env, schema=None, entities=False, file="${SOURCE}") :
+    schema_node = env.File(schema or env.subst('$TEST_SCHEMA'))
+    schema_path = schema_node.abspath
+
+    def check_schema(tree, path, target, source, env):
+        (xmlschema, lock) = _schema(schema_path)
+        if entities:
+            return _entity_schema_errors(xmlschema, lock, path)
+        with lock:
+            if xmlschema.validate(tree):
+                return None
+            return _schema_errors(xmlschema.error_log)
+
+    if entities and etree is not None:
+        def schema_action(target, source, env):
+            path = env.subst(file, target=target, source=source)
+            error = check_schema(None, path, target, source, env)
+            if error is not None:
+                print "TestXMLSchema: %s: %s" % (path, error)
+                return 1
+            return 0
+
+        def schema_strfunction(target, source, env):
+            return "TestXMLSchema: %s per entity against %s" % (env.subst(file, target=target, source=source),
+                                                                schema_path)
+
+        action = SCons.Action.Action(schema_action, schema_strfunction)
+    else:
+        action = SCons.Action.Action("${XMLLINT} --noout --nonet --schema " + schema_path + " " + file)
+
+    return {
+        'action': action,
+        # The schema and the schemas it imports
+        'depends': [schema_node] + env.Glob(os.path.join(os.path.dirname(schema_path), '*.xsd')),
+        'check': check_schema,
+        'name': 'TestXMLSchema(%s%s)' % (schema_path, ', entities' if entities else ''),
+        'file': file,
+        # libxml2 registers the xs:ID attributes of the document while validating, so validation of the tree must not
+        # run at the same time as the other checks
+        'modifies': not entities,
+        'tree': not entities
+    }
+
+# @return error message, or None when all entities in path are valid
+def _entity_schema_errors(xmlschema, lock, path):
+    errors = []
+    invalid = 0
+    try:
+        for e in samlmd.iterentities(path):
+            with lock:
+                if xmlschema.validate(e):
+                    continue
+                invalid += 1
+                if len(errors) < _SCHEMA_ERRORS:
+                    errors.append("entity '%s': %s" % (e.get('entityID'), _schema_errors(xmlschema.error_log)))
+    except (etree.Error, IOError), e:
+        return str(e)
+    if invalid:
+        return "%d invalid entities: %s" % (invalid, '; '.join(errors))
+    return None
+
+_SCHEMA_ERRORS = 10     # Maximum number of errors reported
+
+def _schema_errors(error_log):
+    errors = [ "line %d: %s" % (error.line, error.message) for error in error_log ]
+    if len(errors) > _SCHEMA_ERRORS:
+        errors = errors[:_SCHEMA_ERRORS] + ['and %d more errors' % (len(errors) - _SCHEMA_ERRORS)]
+    return '; '.join(errors)
 
 
 # Test an XML file using an XSLT with xsltproc
@@ -72,10 +256,169 @@ def _TestXMLWellFormedAction(env, file="${SOURCE}") :
 # @param xslt XSLT template containing the test
 # @param file file to test
 def _TestXSLT(env, xslt, file="${SOURCE}") :
+    xslt_path = env.File(xslt).path
+
+    def check_xslt(tree, path, target, source, env):
+        (transform, lock) = _stylesheet(xslt_path)
+        with lock:
+            try:
+                result = transform(tree)
+                error = None
+            except etree.XSLTApplyError, e:
+                result = None
+                error = str(e)
+            messages = [ entry.message for entry in transform.error_log ]
+        if error is not None:
+            return '; '.join(messages) or error
+        for message in messages:
+            print message
+        if str(result).strip():
+            print str(result)
+        return None
+
     return {
         'action': SCons.Action.Action("${XSLTPROC} " + xslt + " " + file),
-        'depends': xslt
+        'depends': xslt,
+        'check': check_xslt,
+        'name': 'TestXSLT(%s)' % xslt_path,
+        'file': file
+    }
+
+
+# Test that metadata is valid for at least some more time
+# Test action for use with the "Test" builder
+# Only the start of the file, up to the start tag of the root element, is read to check the validUntil attribute on
+# the root EntitiesDescriptor or EntityDescriptor. This is the same test as check_validity.xsl. Metadata without
+# validUntil is taken to be valid.
+# @param env environment object
+# @param valid_for xs:duration the metadata must be valid for at least. Default 'PT15M'
+# @param entities when True the validUntil attributes of all EntityDescriptors are checked as well. The file is read
+#        one entity at a time, the earliest validUntil is reported
+# @param file file to test
+def _TestMetadataValidity(env, valid_for='PT15M', entities=False, file="${SOURCE}") :
+    valid_for = env.subst(valid_for)
+    if samlmd.parse_duration(valid_for) is None:
+        raise SCons.Errors.UserError("TestMetadataValidity: valid_for '%s' is not an xs:duration" % valid_for)
+
+    def check_validity(tree, path, target, source, env):
+        try:
+            return _validity_error(path, samlmd.parse_duration(valid_for), entities)
+        except (etree.Error, IOError), e:
+            return str(e)
+
+    def validity_action(target, source, env):
+        path = env.subst(file, target=target, source=source)
+        error = check_validity(None, path, target, source, env)
+        if error is not None:
+            print "TestMetadataValidity: %s: %s" % (path, error)
+            return 1
+        return 0
+
+    def validity_strfunction(target, source, env):
+        return "TestMetadataValidity: %s valid for %s" % (env.subst(file, target=target, source=source), valid_for)
+
+    return {
+        'action': SCons.Action.Action(validity_action, validity_strfunction),
+        'check': check_validity,
+        'name': 'TestMetadataValidity(%s%s)' % (valid_for, ', entities' if entities else ''),
+        'file': file,
+        'tree': False
+    }
+
+# @return error message, or None when the metadata in path is valid for at least valid_for (timedelta)
+def _validity_error(path, valid_for, entities):
+    limit = datetime.utcnow() + valid_for
+    root = samlmd.read_root(path)
+    if root is None or not root.tag in (samlmd.ENTITIES_DESCRIPTOR, samlmd.ENTITY_DESCRIPTOR):
+        return "[ERROR] Root element must be EntitiesDescriptor or EntityDescriptor. Found: %s" % \
+               (root.tag if root is not None else None)
+    valid_until = root.get('validUntil')
+    if valid_until:
+        error = _expired(valid_until, limit, 'the %s' % etree.QName(root).localname)
+        if error:
+            return error
+    if entities:
+        earliest = None
+        for e in samlmd.iterentities(path):
+            value = e.get('validUntil')
+            if not value:
+                continue
+            dt = samlmd.parse_datetime(value)
+            if dt is None:
+                return "[ERROR] Invalid validUntil '%s' on entity '%s'" % (value, e.get('entityID'))
+            if earliest is None or dt < earliest[0]:
+                earliest = (dt, value, e.get('entityID'))
+        if earliest is not None:
+            print "  earliest validUntil of an entity: %s (%s)" % (earliest[1], earliest[2])
+            error = _expired(earliest[1], limit, "entity '%s'" % earliest[2])
+            if error:
+                return error
+    return None
+
+def _expired(valid_until, limit, description):
+    dt = samlmd.parse_datetime(valid_until)
+    if dt is None:
+        return "[ERROR] Invalid validUntil '%s' on %s" % (valid_until, description)
+    if dt < limit:
+        return "[ERROR] Metadata expired. The validUntil attribute on %s is '%s', it must be valid until at least %s" % \
+               (description, valid_until, samlmd.format_datetime(limit))
+    return None
+
+
+# Compare a metadata file with a reference (e.g. the previously published) metadata file, entity by entity
+# Test action for use with the "Test" builder
+# The added, removed and changed entities are reported. The test fails when more than max_removed percent of the
+# entities of the reference is not in the file. The test passes when the reference file does not exist.
+# @param env environment object
+# @param reference the reference metadata file. When this is a Node (e.g. returned by URLDownload) it is added as
+#        dependency
+# @param max_removed maximum percentage of the entities of the reference that may be removed
+# @param max_changed optional maximum percentage of the entities of the reference that may be changed
+# @param file file to test
+def _TestMetadataDiff(env, reference, max_removed=10, max_changed=None, file="${SOURCE}") :
+    if SCons.Util.is_List(reference):
+        reference = reference[0]    # E.g. the result of a builder
+    reference_path = env.File(reference).path
+
+    def check_diff(tree, path, target, source, env):
+        if not os.path.isfile(reference_path):
+            print "  reference '%s' does not exist, nothing to compare" % reference_path
+            return None
+        try:
+            d = mddiff.diff(reference_path, path)
+        except (etree.Error, IOError), e:
+            return str(e)
+        for line in d.report(int(env.get('TEST_DIFF_LIMIT', 30))):
+            print "  " + line
+        if d.removed_percentage() > float(max_removed):
+            return "%.1f%% of the entities of '%s' was removed, at most %s%% is allowed" % \
+                   (d.removed_percentage(), reference_path, max_removed)
+        if max_changed is not None and d.changed_percentage() > float(max_changed):
+            return "%.1f%% of the entities of '%s' changed, at most %s%% is allowed" % \
+                   (d.changed_percentage(), reference_path, max_changed)
+        return None
+
+    def diff_action(target, source, env):
+        path = env.subst(file, target=target, source=source)
+        error = check_diff(None, path, target, source, env)
+        if error is not None:
+            print "TestMetadataDiff: %s: %s" % (path, error)
+            return 1
+        return 0
+
+    def diff_strfunction(target, source, env):
+        return "TestMetadataDiff: %s against %s" % (env.subst(file, target=target, source=source), reference_path)
+
+    test = {
+        'action': SCons.Action.Action(diff_action, diff_strfunction),
+        'check': check_diff,
+        'name': 'TestMetadataDiff(%s, max_removed=%s, max_changed=%s)' % (reference_path, max_removed, max_changed),
+        'file': file,
+        'tree': False
     }
+    if isinstance(reference, SCons.Node.Node):
+        test['depends'] = reference
+    return test
 
 
 # generate function, that adds the builder to the environment,
@@ -86,14 +429,28 @@ def generate( env ) :
 
     # Add the "Test" command to the environment
     env.AddMethod(_test, "Test")
+    env.SetDefault(TEST_PARSE_ONCE = True)  # Parse the file once for all tests that support it (requires lxml)
+    env.SetDefault(TEST_WORKERS = 4)        # Maximum number of checks to run concurrently
+    env.SetDefault(TEST_PROMOTE = list(promote.METHODS))   # Methods to promote a tested file, in order
+    env.SetDefault(CACHE_DIR = "#.scons-cache")
+    env.SetDefault(TEST_STORE_DIR = "${CACHE_DIR}/store")  # Content store for promoted files. Set to '' to disable
+    env.SetDefault(TEST_SCHEMA = os.path.join(SCHEMA_DIR, 'saml-metadata.xsd'))  # Default schema of TestXMLSchema
 
+    # With lxml the tests can run without xmllint and xsltproc (see _test)
     (xmllint, xsltproc) = _detect(env)
     if xmllint:
         env['XMLLINT'] = xmllint
+    if xmllint or etree is not None:
         env.AddMethod(_TestXMLWellFormedAction, "TestXMLWellFormed")
+    if xmllint or etree is not None:
+        env.AddMethod(_TestXMLSchema, "TestXMLSchema")
     if xsltproc:
         env['XSLTPROC'] = xsltproc
+    if xsltproc or etree is not None:
         env.AddMethod(_TestXSLT, "TestXSLT")
+    if etree is not None:
+        env.AddMethod(_TestMetadataValidity, "TestMetadataValidity")
+        env.AddMethod(_TestMetadataDiff, "TestMetadataDiff")
 
 def _detect(env) :
     xmllint = env.WhereIs('xmllint')
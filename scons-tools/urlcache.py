@@ -0,0 +1,499 @@
+# Copyright 2015 GIP RENATER
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Conditional-GET download cache used by the URLDownload tool
+
+For every URL the cache directory holds two files, named after the SHA-1 of the URL:
+- <sha1>.json: the validators of the last download (ETag, Last-Modified), and the length and SHA-1 of the body
+- <sha1>.body: the body of the last download
+
+When both files are present a request for the URL is sent with If-None-Match / If-Modified-Since headers. A "304 Not
+Modified" response means the cached body is still current and no body is transferred.
+
+Bodies are requested with "Accept-Encoding: gzip" and decompressed while they are read. Bodies are written in chunks to a
+temporary file that is fsync'ed and then renamed into place, so a reader never sees a partially written file. A body
+that is shorter than its Content-Length, or a gzip stream that is cut off, raises DownloadError and is not stored.
+
+Requests are made over persistent (keep-alive) connections that are kept in a pool per host. The number of concurrent
+connections to one host is limited, and a request fails when the server does not answer within a timeout. prefetch()
+fetches a set of URLs concurrently using a bounded number of worker threads. When a proxy is configured for a URL (e.g.
+using the http_proxy environment variable) urllib2 is used instead.
+
+In offline mode no requests are made at all: the record of the last download is used as if the server answered "304 Not
+Modified". A URL that was never downloaded can not be fetched in offline mode.
+
+This module does not depend on SCons so it can be used from scripts as well.
+"""
+
+import os
+import json
+import hashlib
+import threading
+import Queue
+import httplib
+import socket
+import urllib
+import urllib2
+import urlparse
+import zlib
+
+
+CHUNK_SIZE = 65536      # Size of the blocks in which files are read and written
+DEFAULT_TIMEOUT = 60    # Seconds to wait for a connection to a server or for data from it
+
+
+# Raised when a server returns an error status
+class DownloadError(Exception):
+
+    def __init__(self, code, reason):
+        Exception.__init__(self, "HTTP Error %s: %s" % (code, reason))
+        self.code = code
+
+
+# Raised in offline mode for a URL that is not in the cache
+class NotCachedError(Exception):
+    pass
+
+
+# A response received over a pooled connection
+# The connection is returned to the pool on close() when the response body was read completely
+class _Response(object):
+
+    def __init__(self, pool, key, connection, response, url):
+        self._pool = pool
+        self._key = key
+        self._connection = connection
+        self._response = response
+        self.status = response.status
+        self.reason = response.reason
+        self.url = url
+        self.headers = response.msg
+
+    def getheader(self, name):
+        return self._response.getheader(name)
+
+    def read(self, size):
+        return self._response.read(size)
+
+    def close(self):
+        # The connection can be reused when the complete response body was read. length is the number of bytes of
+        # the body that were not read, None for a chunked body
+        length = self._response.length
+        reusable = not self._response.will_close and (length == 0 or (length is None and self._response.isclosed()))
+        self._response.close()
+        self._pool._release(self._key, self._connection if reusable else None)
+
+
+# Wraps a urllib2 response, used when a proxy is configured
+class _Urllib2Response(object):
+
+    def __init__(self, response, status):
+        self._response = response
+        self.status = status
+        self.reason = ''
+        self.url = response.geturl()
+        self.headers = response.info()
+
+    def getheader(self, name):
+        return self.headers.get(name)
+
+    def read(self, size):
+        return self._response.read(size)
+
+    def close(self):
+        self._response.close()
+
+
+class ConnectionPool(object):
+
+    max_redirects = 10
+
+    # @param max_per_host maximum number of concurrent connections to one host
+    # @param timeout seconds to wait for a connection or for data, None to wait forever
+    def __init__(self, max_per_host=2, timeout=DEFAULT_TIMEOUT):
+        self.max_per_host = max_per_host
+        self.timeout = timeout
+        self._idle = {}         # (scheme, host, port) => list of idle connections
+        self._limits = {}       # (scheme, host, port) => semaphore
+        self._lock = threading.Lock()
+
+    def _acquire(self, key):
+        with self._lock:
+            limit = self._limits.setdefault(key, threading.BoundedSemaphore(self.max_per_host))
+        limit.acquire()
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                return idle.pop(), True
+        (scheme, host, port) = key
+        if scheme == 'https':
+            return httplib.HTTPSConnection(host, port, timeout=self.timeout), False
+        return httplib.HTTPConnection(host, port, timeout=self.timeout), False
+
+    def _release(self, key, connection):
+        if connection is not None:
+            with self._lock:
+                self._idle.setdefault(key, []).append(connection)
+        self._limits[key].release()
+
+    # Close all idle connections
+    def close(self):
+        with self._lock:
+            for idle in self._idle.values():
+                for connection in idle:
+                    connection.close()
+            self._idle = {}
+
+    # Send a GET request for url, following redirects
+    # @param url URL to get
+    # @param headers dict with additional request headers
+    # @return response, the caller must close() it. Status is 200 or 304
+    def get(self, url, headers={}):
+        for i in range(self.max_redirects + 1):
+            response = self._request(url, headers)
+            if response.status in (301, 302, 303, 307, 308) and response.getheader('Location'):
+                location = response.getheader('Location')
+                _discard(response)
+                url = urlparse.urljoin(url, location)
+                continue
+            if response.status not in (200, 304):
+                _discard(response)
+                raise DownloadError(response.status, response.reason)
+            return response
+        raise DownloadError(response.status, "Too many redirects")
+
+    def _request(self, url, headers):
+        parts = urlparse.urlsplit(url)
+        if parts.scheme not in ('http', 'https') or _use_proxy(parts):
+            return _urllib2_get(url, headers, self.timeout)
+
+        key = (parts.scheme, parts.hostname, parts.port)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        headers = dict(headers)
+        headers['Host'] = parts.netloc.rsplit('@', 1)[-1]
+
+        while True:
+            connection, reused = self._acquire(key)
+            try:
+                connection.request('GET', path, headers=headers)
+                response = connection.getresponse()
+            except (httplib.HTTPException, socket.error):
+                connection.close()
+                self._release(key, None)
+                if reused:
+                    continue    # The server closed an idle connection, retry using a new connection
+                raise
+            except:
+                connection.close()
+                self._release(key, None)
+                raise
+            return _Response(self, key, connection, response, url)
+
+
+def _use_proxy(parts):
+    return parts.scheme in urllib.getproxies() and not urllib.proxy_bypass(parts.hostname)
+
+
+def _urllib2_get(url, headers, timeout=DEFAULT_TIMEOUT):
+    try:
+        request = urllib2.Request(url, headers=headers)
+        if timeout is None:
+            return _Urllib2Response(urllib2.urlopen(request), 200)
+        return _Urllib2Response(urllib2.urlopen(request, timeout=timeout), 200)
+    except urllib2.HTTPError, e:
+        if e.code == 304:
+            return _Urllib2Response(e, 304)
+        raise DownloadError(e.code, e.msg)
+
+
+# Return whether a decompressor has read the complete gzip stream, including the trailer with the CRC and size
+# The zlib module of python 2 has no eof attribute: after the end of the stream more input is kept in unused_data
+def _gzip_complete(decompressor):
+    probe = decompressor.copy()
+    try:
+        probe.decompress('\0')
+    except zlib.error:
+        return False
+    return probe.unused_data.endswith('\0')
+
+
+# Read and close a response, so its connection can be reused
+def _discard(response):
+    try:
+        while response.read(CHUNK_SIZE):
+            pass
+    finally:
+        response.close()
+
+
+class DownloadCache(object):
+
+    def __init__(self, directory, max_per_host=2, timeout=DEFAULT_TIMEOUT):
+        self.directory = directory
+        self.pool = ConnectionPool(max_per_host, timeout)
+        self._records = {}      # url => record of the request done by this process
+        self._locks = {}        # url => lock, so a URL is only fetched by one thread at a time
+        self._lock = threading.Lock()
+        self.urls = []          # URLs registered for prefetching
+        self._prefetched = False
+        self.offline = False    # When True no requests are made, the records of the last downloads are used
+
+    def _path(self, url, ext):
+        return os.path.join(self.directory, hashlib.sha1(url).hexdigest() + ext)
+
+    def _url_lock(self, url):
+        with self._lock:
+            return self._locks.setdefault(url, threading.Lock())
+
+    # Return the stored record for url, or None when there is no complete (i.e. meta and body) cache entry
+    def load(self, url):
+        try:
+            with open(self._path(url, '.json'), 'r') as f:
+                record = json.load(f)
+        except (IOError, ValueError):
+            return None
+        if not os.path.isfile(self._path(url, '.body')):
+            return None
+        return record
+
+    def _store(self, url, record):
+        with AtomicFile(self._path(url, '.json')) as f:
+            json.dump(record, f, indent=1, sort_keys=True)
+
+    # Fetch url using a conditional GET
+    # Only the first call for a URL does a request, subsequent calls return the record of that request.
+    # @param url URL to fetch
+    # @return record (dict) with the validators and the SHA-1 of the body. The "modified" key is False when
+    #         the server responded with "304 Not Modified"
+    def fetch(self, url):
+        with self._url_lock(url):
+            if url in self._records:
+                return self._records[url]
+
+            if not os.path.isdir(self.directory):
+                try:
+                    os.makedirs(self.directory)
+                except OSError:
+                    if not os.path.isdir(self.directory):
+                        raise
+
+            cached = self.load(url)
+            if self.offline:
+                if not cached:
+                    raise NotCachedError("%s was never downloaded, it can not be fetched offline" % url)
+                record = dict(cached)
+                record['modified'] = False
+                self._records[url] = record
+                return record
+
+            headers = {'Accept-Encoding': 'gzip'}
+            if cached:
+                if cached.get('etag'):
+                    headers['If-None-Match'] = cached['etag']
+                if cached.get('last_modified'):
+                    headers['If-Modified-Since'] = cached['last_modified']
+
+            response = self.pool.get(url, headers)
+            if response.status == 304:
+                response.close()
+                if not cached:
+                    raise DownloadError(304, "Not Modified response to an unconditional request")
+                record = dict(cached)
+                record['modified'] = False
+                self._records[url] = record
+                return record
+
+            try:
+                body_path = self._path(url, '.body')
+                decompressor = None
+                if (response.getheader('Content-Encoding') or '').lower() in ('gzip', 'x-gzip'):
+                    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                sha1 = hashlib.sha1()
+                length = 0
+                received = 0    # Bytes received, before decompression
+                with AtomicFile(body_path) as f:
+                    while True:
+                        data = response.read(CHUNK_SIZE)
+                        if not data:
+                            break
+                        received += len(data)
+                        if decompressor:
+                            data = decompressor.decompress(data)
+                        sha1.update(data)
+                        length += len(data)
+                        f.write(data)
+                    # read() returns less data instead of raising an error when the connection is closed early. An
+                    # exception leaves the previously downloaded body in place
+                    expected = response.getheader('Content-Length')
+                    if expected and expected.strip().isdigit() and received != int(expected):
+                        raise DownloadError(response.status, "Incomplete body, received %d of %s bytes" %
+                                            (received, expected.strip()))
+                    if decompressor:
+                        if not _gzip_complete(decompressor):
+                            raise DownloadError(response.status, "Incomplete gzip body")
+                        data = decompressor.flush()
+                        sha1.update(data)
+                        length += len(data)
+                        f.write(data)
+
+                record = {
+                    'url': url,
+                    'final_url': response.url,
+                    'etag': response.getheader('ETag'),
+                    'last_modified': response.getheader('Last-Modified'),
+                    # The length of the stored (decompressed) body, not the Content-Length of a gzip'ed body
+                    'content_length': str(length),
+                    'sha1': sha1.hexdigest(),
+                }
+            finally:
+                response.close()
+
+            self._store(url, record)
+            record = dict(record)
+            record['modified'] = True
+            self._records[url] = record
+            return record
+
+    # Return the URL the data of url was downloaded from (i.e. after following redirects)
+    # The final URL of the request done by this process, or else of the previous download, is returned. Only when
+    # url was never downloaded it is fetched
+    def final_url(self, url):
+        record = self._records.get(url) or self.load(url) or self.fetch(url)
+        return record.get('final_url') or url
+
+    # Forget the requests done by this process, so the next fetch() of a URL makes a (conditional) request again
+    # Used by long-running builds (see watch.py)
+    def reset(self):
+        with self._lock:
+            self._records = {}
+            self._prefetched = False
+
+    # Register url to be fetched by prefetch_registered()
+    def register(self, url):
+        with self._lock:
+            if url not in self.urls:
+                self.urls.append(url)
+
+    # Fetch all registered URLs, only the first call does the fetching
+    def prefetch_registered(self, max_workers=8):
+        with self._lock:
+            if self._prefetched:
+                return
+            self._prefetched = True
+        self.prefetch(self.urls, max_workers)
+
+    # Fetch urls concurrently
+    # Errors are ignored, a URL that could not be fetched is fetched again (and the error raised) on the
+    # next call to fetch()
+    # @param urls list of URLs
+    # @param max_workers maximum number of worker threads
+    def prefetch(self, urls, max_workers=8):
+        queue = Queue.Queue()
+        for url in urls:
+            if url not in self._records:
+                queue.put(url)
+
+        def worker():
+            while True:
+                try:
+                    url = queue.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    self.fetch(url)
+                except Exception:
+                    pass
+
+        threads = [threading.Thread(target=worker) for i in range(min(max_workers, queue.qsize()))]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        for t in threads:
+            t.join()
+
+    # Copy the cached body of url to path, replacing path atomically. The url must have been fetched before
+    def copy_body(self, url, path):
+        with open(self._path(url, '.body'), 'rb') as src, AtomicFile(path) as dst:
+            while True:
+                data = src.read(CHUNK_SIZE)
+                if not data:
+                    break
+                dst.write(data)
+
+
+# A file that is written to a temporary file in the same directory and that replaces
+# the file atomically when it is closed without error
+# Usage:
+# with AtomicFile(path) as f:
+#     f.write(data)
+class AtomicFile(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.tmp_path = os.path.join(os.path.dirname(path) or '.', '.%s.%d.%d.tmp' % (os.path.basename(path), os.getpid(), threading.current_thread().ident))
+        self._file = open(self.tmp_path, 'wb')
+
+    def write(self, data):
+        self._file.write(data)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        try:
+            if type is None:
+                self._file.flush()
+                os.fsync(self._file.fileno())
+            self._file.close()
+            if type is None:
+                os.rename(self.tmp_path, self.path)
+        finally:
+            if os.path.exists(self.tmp_path):
+                os.remove(self.tmp_path)
+        return False
+
+
+# Return the content signature for a record
+# This is a concatenation of the validators sent by the server and the SHA-1 of the body
+def signature(record):
+    contents = ""
+    for k in ('last_modified', 'content_length', 'etag', 'sha1'):
+        if record.get(k):
+            contents = contents + record[k]
+    if isinstance(contents, unicode):
+        contents = contents.encode('utf-8')
+    return contents
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+# Return the (shared) DownloadCache for a directory
+# @param directory cache directory
+# @param max_per_host maximum number of concurrent connections to one host, used when the cache is created
+# @param timeout seconds to wait for a connection or for data, used when the cache is created
+def get_cache(directory, max_per_host=2, timeout=DEFAULT_TIMEOUT):
+    directory = os.path.abspath(directory)
+    with _caches_lock:
+        if directory not in _caches:
+            _caches[directory] = DownloadCache(directory, max_per_host, timeout)
+        return _caches[directory]
+
+
+# Return the DownloadCache objects made by get_cache()
+def caches():
+    with _caches_lock:
+        return _caches.values()
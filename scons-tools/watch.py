@@ -0,0 +1,208 @@
+# Copyright 2015 GIP RENATER
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+""" SCons tool for continuously rebuilding when remote or local inputs change
+
+Usage (in SConstruct, before the SConscript files are read):
+env = Environment(tools=['watch'], toolpath='<(relative) path to watch.py>')
+env.Watch(60, restart=['SConstruct', 'SConscript', 'SConscript.download', 'config.py'])
+
+Instead of building once and exiting, SCons keeps running and builds the targets in cycles, using the interactive
+mode of SCons (see "scons --interactive"): the SConscript files are read once and the dependency graph, the download
+cache and the caches of the tools (e.g. verified signatures, compiled stylesheets, the pyFF worker) stay in memory.
+
+Every interval seconds:
+- all URLs of URLDownload targets are fetched concurrently with conditional requests (see urlcache.py), and the
+  source files of the targets that are not built by SCons are checked for a changed modification time or size;
+- only when a URL or a file changed (or the previous build failed) the targets are built. As in any build only the
+  targets that depend on a changed input are rebuilt. The data fetched by the poll is used by the build, it is not
+  requested again.
+Each cycle is reported with the time of the poll and of the build.
+
+When one of the restart files (the build description) changes, SCons is started again with the same arguments, so
+the SConscript files are read again.
+"""
+
+
+from SCons.Script import *  # For PyCharm code completion
+import SCons.Node, SCons.Node.FS, SCons.SConsign, SCons.Script.Main, SCons.Script.Interactive
+
+import os
+import sys
+import time
+
+import urlcache
+try:
+    import mdnormalize
+except ImportError:     # lxml is not available, there are no fragment caches
+    mdnormalize = None
+
+
+_watcher = None
+
+
+class _Watcher(object):
+
+    # @param interval number of seconds between the start of two cycles
+    # @param restart list of absolute paths of the files of the build description
+    # @param workers maximum number of concurrent requests when polling URLs
+    def __init__(self, interval, restart, workers):
+        self.interval = interval
+        self.restart = _stat_all(restart)
+        self.workers = workers
+        self.nodes = []         # nodes that were built by the last build
+        self.files = {}         # path => (mtime, size) of the source files of the last build
+        self.polled = {}        # path => (mtime, size) of the source files at the last poll
+        self.urls = {}          # URL => SHA-1 of its data in the last build
+
+    # Replacement of SCons.Script.Interactive.interact(): build the targets in cycles
+    def interact(self, fs, parser, options, targets, target_top):
+        cmd = SCons.Script.Interactive.SConsInteractiveCmd(prompt='', fs=fs, parser=parser, options=options,
+                                                           targets=targets, target_top=target_top)
+        build_targets = SCons.Script.Main._build_targets
+
+        # Keep the nodes that are built, to find their sources after the build
+        def _build_targets(*args, **kw):
+            self.nodes = build_targets(*args, **kw) or []
+            return self.nodes
+
+        SCons.Script.Main._build_targets = _build_targets
+        print "watch: building every %d seconds, stop with Ctrl-C" % self.interval
+        cycle = 0
+        failed = True
+        try:
+            while True:
+                cycle += 1
+                start = time.time()
+                if self.restart != _stat_all(self.restart.keys()):
+                    self._restart()
+                changed = self.poll() if cycle > 1 else ['first build']
+                poll = time.time() - start
+                if failed and not changed:
+                    changed = ['previous build failed']
+                if changed:
+                    # The fragment caches are pruned at the start of each build
+                    for cache in mdnormalize.caches() if mdnormalize is not None else []:
+                        cache.reset()
+                    # do_build() forgets the .sconsign files after the build, so the next builds would not be recorded
+                    sconsign = (SCons.SConsign.sig_files, SCons.SConsign.DB_sync_list)
+                    cmd.do_build(['build'] + targets)
+                    (SCons.SConsign.sig_files, SCons.SConsign.DB_sync_list) = sconsign
+                    failed = SCons.Script.Main.this_build_status != 0
+                    self.update()
+                    print "watch: cycle %d: %s changed, poll %.2fs, build %.2fs, %s" % \
+                          (cycle, _describe(changed), poll, time.time() - start - poll,
+                           'failed' if failed else 'done')
+                else:
+                    print "watch: cycle %d: no changes, poll %.2fs" % (cycle, poll)
+                time.sleep(max(0, start + self.interval - time.time()))
+        except KeyboardInterrupt:
+            print "\nwatch: stopped"
+        finally:
+            SCons.Script.Main._build_targets = build_targets
+
+    # Fetch the URLs and check the source files
+    # @return list of the URLs and files that changed
+    def poll(self):
+        self.polled = _stat_all(self.files.keys())
+        changed = [ path for path in self.files if self.polled[path] != self.files[path] ]
+        for cache in urlcache.caches():
+            cache.reset()
+            cache.prefetch(cache.urls, self.workers)
+            for url in cache.urls:
+                try:
+                    sha1 = cache.fetch(url).get('sha1')
+                except Exception, e:
+                    # Reported by the build
+                    print "watch: %s: %s" % (url, e)
+                    sha1 = None
+                if sha1 is None or sha1 != self.urls.get(url):
+                    changed.append(url)
+        return changed
+
+    # Find the URLs and source files of the last build
+    def update(self):
+        self.urls = {}
+        for cache in urlcache.caches():
+            for url in cache.urls:
+                record = cache.load(url)
+                if record:
+                    self.urls[url] = record.get('sha1')
+
+        # The state of the files at the poll before the build, so a change during the build is noticed by the next poll
+        self.files = {}
+        seen = set()
+        stack = list(self.nodes)
+        while stack:
+            node = stack.pop()
+            if node in seen:
+                continue
+            seen.add(node)
+            if isinstance(node, SCons.Node.FS.File) and not node.has_builder():
+                # The file in the source directory, not its copy in the variant dir
+                path = node.srcnode().get_abspath()
+                self.files[path] = self.polled[path] if path in self.polled else _stat(path)
+            stack.extend(node.children(scan=1))
+
+    def _restart(self):
+        print "watch: the build description changed, restarting scons"
+        sys.stdout.flush()
+        os.execv(sys.executable, [sys.executable] + sys.argv)
+
+
+# Return the (modification time, size) of a file, or None when it does not exist
+def _stat(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_mtime, st.st_size)
+
+
+def _stat_all(paths):
+    return dict( (path, _stat(path)) for path in paths )
+
+
+def _describe(changed):
+    if len(changed) > 3:
+        return ', '.join(changed[:3]) + ' and %d more' % (len(changed) - 3)
+    return ', '.join(changed)
+
+
+# Build the targets in cycles instead of once
+# @param interval number of seconds between the start of two cycles
+# @param restart files of the build description. When one of them changes scons is restarted
+def _Watch(env, interval, restart=[]):
+    global _watcher
+    if _watcher is not None:
+        return
+    _watcher = _Watcher(int(interval), [ env.File(f).abspath for f in restart ], int(env['URLDOWNLOAD_WORKERS']))
+    # The same as the --interactive option, which can not be set from a SConscript
+    SCons.Node.interactive = True
+    SCons.Script.Main.OptionsParser.values.interactive = True
+    SCons.Script.Interactive.interact = _watcher.interact
+
+
+# Called by the Environment.Tools function
+# Add ourselves to the environment
+def generate(env):
+    env.SetDefault(URLDOWNLOAD_WORKERS=8)
+    env.AddMethod(_Watch, "Watch")
+
+
+# Called during initialisation
+# The tool can make it known whether it exists (i.e. is available)
+def exists(env):
+    return 1
@@ -14,6 +14,15 @@
 
 import SCons.Action
 
+import os
+import Queue
+import pipes
+import atexit
+import threading
+import subprocess
+
+import resources
+
 def _detect(env) :
     if (not 'XMLSECTOOLSH' in env) :
         xmlsectool = env.WhereIs('xmlsectool.sh')
@@ -32,18 +41,223 @@ def _detect(env) :
 # xmlsectool.sh --sign --inFile in.xml --outFile out.xml --referenceIdAttributeName ID --digest SHA-256
 
 def _Sign( env, target, source, keystore="$XMLSECTOOLSH_KEYSTORE", key="$XMLSECTOOLSH_KEYSTORE_KEY", keyPassword="$XMLSECTOOLSH_KEYSTORE_PASSWORD", digest='SHA=256'):
+    command_str = _sign_command(env, keystore, key, keyPassword)
+    if _batch(env):
+        # Sign using the shared batch signer, command_str is used as fallback
+        overrides = {
+            'XMLSECTOOL_SIGN_COMMAND': command_str,
+            'XMLSECTOOL_SIGN_ARGS': _batch_args(env, keystore, key, keyPassword, digest),
+        }
+        action = SCons.Action.Action(_batch_sign_action, _batch_sign_strfunction, varlist=overrides.keys())
+        return env.Command( target, source, action, **overrides )
+    return env.Command( target, source, command_str)
+
+
+# Return the xmlsectool command for signing $SOURCE to $TARGET
+def _sign_command(env, keystore, key, keyPassword, in_file="$SOURCE", out_file="$TARGET"):
     command_str=""
     if 'XMLSECTOOLSH_SIGN' in env:
         command_str="${XMLSECTOOLSH_SIGN}"
     else:
         command_str="${XMLSECTOOLSH}"
-    command_str += " --sign --inFile $SOURCE --outFile $TARGET --keystore %s --key %s --keyPassword %s" % (env.subst(keystore), env.subst(key), env.subst(keyPassword))
+    command_str += " --sign --inFile %s --outFile %s --keystore %s --key %s --keyPassword %s" % (in_file, out_file, env.subst(keystore), env.subst(key), env.subst(keyPassword))
     if 'XMLSECTOOLSH_SIGN_OPTS' in env:
         command_str+=" ${XMLSECTOOLSH_SIGN_OPTS}"
-    return env.Command( target, source, command_str)
+    return command_str
+
+
+# Whether to sign using the batch signer
+def _batch(env):
+    return env.get('XMLSECTOOL_BATCH') and not 'XMLSECTOOLSH_SIGN' in env and not 'XMLSECTOOLSH_SIGN_OPTS' in env
+
+
+# Return the arguments of the batch signer: (keystore path, key name, key password, digest)
+def _batch_args(env, keystore, key, keyPassword, digest):
+    return ( env.File(keystore).abspath, env.subst(key), env.subst(keyPassword),
+             digest if digest in ('SHA-1', 'SHA-256', 'SHA-512') else 'SHA-256' )
+
+
+# Signs files in one long-lived JVM running scripts/XMLBatchSigner.java
+# The JVM is started and the keystore is loaded once for each (keystore, key, keyPassword, digest) combination. To
+# sign files in parallel, up to max_processes JVMs are started for a combination
+class _BatchSigner(object):
+
+    def __init__(self):
+        self.processes = {}     # args => list of processes (None while a process is started)
+        self.idle = {}          # args => list of processes that are not signing a file
+        self.failed = set()     # args for which the signer could not be started
+        self.condition = threading.Condition()
+
+    # Java 11 or later is required to run the signer from source
+    def _java(self, env):
+        if 'XMLSECTOOL_JAVA' in env:
+            return env.subst('$XMLSECTOOL_JAVA')
+        if env['ENV'].get('JAVA_HOME'):
+            return os.path.join(env['ENV']['JAVA_HOME'], 'bin', 'java')
+        return 'java'
+
+    def _start(self, env, args):
+        (keystore, key, key_password, digest) = args
+        script = env.File('#scripts/XMLBatchSigner.java').srcnode().abspath
+        command = [self._java(env), script, '--keystore', keystore, '--key', key, '--digest', digest]
+        print "Starting batch signer: " + ' '.join(command)
+        process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, env=env['ENV'])
+        # The password is sent on stdin so it is not visible in the process list
+        process.stdin.write(key_password + '\n')
+        process.stdin.flush()
+        if process.stdout.readline().strip() != 'READY':
+            process.stdin.close()
+            process.wait()
+            raise IOError('batch signer exited with status %s' % process.returncode)
+        return process
+
+    # Return an idle process for args, starting one when less than max_processes are running
+    # @return process, or None when the signer is not available
+    def _acquire(self, env, args, max_processes):
+        with self.condition:
+            while True:
+                if args in self.failed:
+                    return None
+                if self.idle.get(args):
+                    return self.idle[args].pop()
+                processes = self.processes.setdefault(args, [])
+                if len(processes) < max_processes:
+                    processes.append(None)
+                    break
+                self.condition.wait()
+        try:
+            process = self._start(env, args)
+        except (OSError, IOError), e:
+            print "WARNING: batch signer failed: %s" % e
+            process = None
+        with self.condition:
+            processes = self.processes[args]
+            if process is None:
+                processes.remove(None)
+                self.failed.add(args)
+                self.condition.notify_all()
+            else:
+                processes[processes.index(None)] = process
+        return process
+
+    # Sign a file
+    # @param env environment object
+    # @param args tuple of (keystore path, key name, key password, digest)
+    # @param max_processes maximum number of JVMs for args
+    # @return reply line from the signer ("OK" or "ERROR <message>"), or None when the signer is not available
+    def sign(self, env, args, in_file, out_file, max_processes=1):
+        process = self._acquire(env, args, max_processes)
+        if process is None:
+            return None
+        try:
+            process.stdin.write('%s\t%s\n' % (os.path.abspath(in_file), os.path.abspath(out_file)))
+            process.stdin.flush()
+            line = process.stdout.readline()
+        except (OSError, IOError), e:
+            line = None
+            print "WARNING: batch signer failed: %s" % e
+        with self.condition:
+            if not line:
+                print "WARNING: batch signer not available, running xmlsectool for each file"
+                self.failed.add(args)
+                self.processes[args].remove(process)
+                self.condition.notify_all()
+                return None
+            self.idle.setdefault(args, []).append(process)
+            self.condition.notify()
+        return line.strip()
+
+    def stop(self):
+        for processes in self.processes.values():
+            for process in processes:
+                if process is not None:
+                    process.stdin.close()
+                    process.wait()
+        self.processes = {}
+        self.idle = {}
+
+_signer = _BatchSigner()
+atexit.register(_signer.stop)
+
+
+def _batch_sign_action(target, source, env):
+    reply = _signer.sign(env, tuple(env['XMLSECTOOL_SIGN_ARGS']), source[0].path, target[0].path)
+    if reply is None:
+        # Fallback to running xmlsectool
+        return SCons.Action.Action(env['XMLSECTOOL_SIGN_COMMAND'])(target, source, env)
+    if reply != 'OK':
+        print "batch signer: error signing '%s': %s" % (source[0].path, reply)
+        return 1
+    return 0
+
+def _batch_sign_strfunction(target, source, env):
+    return "batch signer: %s -> %s" % (source[0], target[0])
+
+# Sign many files, using up to jobs xmlsectool processes (or batch signer JVMs, see XMLSECTOOL_BATCH) in parallel
+# For use in actions that sign files that are not known to SCons, e.g. the entities published by the mdq builder
+# @param env environment object
+# @param files list of (file to sign, signed file)
+# @param jobs maximum number of files signed in parallel
+# @return list of (file to sign, error message) of the files that could not be signed
+def sign_files(env, files, jobs=1, keystore="$XMLSECTOOLSH_KEYSTORE", key="$XMLSECTOOLSH_KEYSTORE_KEY", keyPassword="$XMLSECTOOLSH_KEYSTORE_PASSWORD", digest='SHA-256'):
+    batch_args = _batch_args(env, keystore, key, keyPassword, digest) if _batch(env) else None
+    if batch_args is not None:
+        # Each job uses a batch signer JVM, which runs until the end of the build
+        jobs = min(jobs, resources.pool.capacity.get('jvm', jobs))
+    queue = Queue.Queue()
+    for f in files:
+        queue.put(f)
+    errors = []
+
+    def sign(in_file, out_file):
+        if batch_args is not None:
+            reply = _signer.sign(env, batch_args, in_file, out_file, jobs)
+            if reply is not None:
+                return None if reply == 'OK' else reply
+        command = env.subst(_sign_command(env, keystore, key, keyPassword, _quote(in_file), _quote(out_file)))
+        # The same resource tokens and scratch directory as a command of the build (see parallel.py)
+        with resources.pool.use(resources.needs(command)):
+            with resources.scratch() as path:
+                process_env = dict(env['ENV'])
+                process_env['TMPDIR'] = path
+                process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                           env=process_env)
+                output = process.communicate()[0]
+        if process.returncode != 0:
+            return 'xmlsectool exited with status %d: %s' % (process.returncode, output.strip())
+        return None
+
+    def worker():
+        while True:
+            try:
+                (in_file, out_file) = queue.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                error = sign(in_file, out_file)
+            except (OSError, IOError), e:
+                error = str(e)
+            if error:
+                errors.append( (in_file, error) )
+
+    threads = [ threading.Thread(target=worker) for i in range(min(jobs, queue.qsize())) ]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    for t in threads:
+        t.join()
+    return errors
+
+
+# Quote a file name for the shell and for SCons variable substitution
+def _quote(path):
+    return pipes.quote(path).replace('$', '$$')
+
 
 def generate( env ) :
     _detect(env)
+    # Sign all files in one JVM (see XMLBatchSigner.java) instead of running xmlsectool for each file
+    env.SetDefault(XMLSECTOOL_BATCH=False)
     env.AddMethod( _Sign, "XML_Sign" )
 
 # @param env environment object
@@ -0,0 +1,304 @@
+# Copyright 2015 GIP RENATER
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Verification of the enveloped XML signature of a SAML metadata file against a certificate, using lxml
+
+Supported are signatures as made by xmlsectool and pyFF: one enveloped signature on the root element with a single
+reference to the root element (URI "" or "#<ID of the root>"), (exclusive) canonical XML 1.0, RSA with SHA-1, SHA-256,
+SHA-384 or SHA-512. Other signatures raise UnsupportedSignature so the caller can fall back to another verifier.
+
+The canonical XML of the document is written to the digest in blocks, it is not kept in memory.
+
+A VerifiedCache remembers successful verifications by (SHA-1 of the file, SHA-1 fingerprint of the certificate), so
+verifying an unchanged file again costs a file hash only.
+
+This module does not depend on SCons so it can be used from scripts as well.
+"""
+
+import os
+import re
+import base64
+import hashlib
+import threading
+
+from lxml import etree
+
+import samlmd
+from urlcache import AtomicFile
+
+
+DS = 'http://www.w3.org/2000/09/xmldsig#'
+EC = 'http://www.w3.org/2001/10/xml-exc-c14n#'
+
+ENVELOPED = DS + 'enveloped-signature'
+
+# Canonicalization algorithm => (exclusive, with comments)
+_C14N = {
+    'http://www.w3.org/TR/2001/REC-xml-c14n-20010315': (False, False),
+    'http://www.w3.org/TR/2001/REC-xml-c14n-20010315#WithComments': (False, True),
+    'http://www.w3.org/2001/10/xml-exc-c14n#': (True, False),
+    'http://www.w3.org/2001/10/xml-exc-c14n#WithComments': (True, True),
+}
+
+# Digest algorithm => hashlib name
+_DIGESTS = {
+    DS + 'sha1': 'sha1',
+    'http://www.w3.org/2001/04/xmlenc#sha256': 'sha256',
+    'http://www.w3.org/2001/04/xmldsig-more#sha384': 'sha384',
+    'http://www.w3.org/2001/04/xmlenc#sha512': 'sha512',
+}
+
+# Signature algorithm => hashlib name
+_RSA_SIGNATURES = {
+    DS + 'rsa-sha1': 'sha1',
+    'http://www.w3.org/2001/04/xmldsig-more#rsa-sha256': 'sha256',
+    'http://www.w3.org/2001/04/xmldsig-more#rsa-sha384': 'sha384',
+    'http://www.w3.org/2001/04/xmldsig-more#rsa-sha512': 'sha512',
+}
+
+# DER encoded DigestInfo before the digest, see RFC 3447 section 9.2
+_DIGEST_INFO = {
+    'sha1': '3021300906052b0e03021a05000414'.decode('hex'),
+    'sha256': '3031300d060960864801650304020105000420'.decode('hex'),
+    'sha384': '3041300d060960864801650304020205000430'.decode('hex'),
+    'sha512': '3051300d060960864801650304020305000440'.decode('hex'),
+}
+
+_RSA_ENCRYPTION_OID = '2a864886f70d010101'.decode('hex')
+
+_pem_re = re.compile(r'-----BEGIN CERTIFICATE-----(.*?)-----END CERTIFICATE-----', re.DOTALL)
+
+
+# Raised when a signature is not valid
+class VerificationError(Exception):
+    pass
+
+
+# Raised when a signature uses features that are not supported by this module
+class UnsupportedSignature(VerificationError):
+    pass
+
+
+# An X.509 certificate with an RSA public key
+class Certificate(object):
+
+    # @param path PEM or DER encoded certificate file. Of a PEM file the first certificate is used
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            data = f.read()
+        m = _pem_re.search(data)
+        if m:
+            data = base64.b64decode(''.join(m.group(1).split()))
+        self.der = data
+        self.fingerprint = hashlib.sha1(data).hexdigest()
+        (self.modulus, self.exponent) = _rsa_public_key(data)
+
+
+# Read a DER encoded value at pos
+# @return tuple of (tag, contents, position after the value)
+def _der_read(data, pos):
+    if pos + 2 > len(data):
+        raise ValueError('Invalid DER encoding')
+    tag = ord(data[pos])
+    length = ord(data[pos + 1])
+    pos += 2
+    if length & 0x80:
+        n = length & 0x7f
+        length = int(data[pos:pos + n].encode('hex') or '0', 16)
+        pos += n
+    if pos + length > len(data):
+        raise ValueError('Invalid DER encoding')
+    return (tag, data[pos:pos + length], pos + length)
+
+
+# Return the values in a DER encoded SEQUENCE as a list of (tag, contents)
+def _der_sequence(data):
+    values = []
+    pos = 0
+    while pos < len(data):
+        (tag, contents, pos) = _der_read(data, pos)
+        values.append( (tag, contents) )
+    return values
+
+
+# Return the (modulus, exponent) of the RSA public key of a DER encoded certificate
+def _rsa_public_key(der):
+    try:
+        (tag, certificate, pos) = _der_read(der, 0)
+        (tag, tbs, pos) = _der_read(certificate, 0)
+        fields = _der_sequence(tbs)
+        if fields[0][0] == 0xa0:      # Explicit version
+            fields = fields[1:]
+        # serialNumber, signature, issuer, validity, subject, subjectPublicKeyInfo
+        (algorithm, public_key) = _der_sequence(fields[5][1])
+        if _der_sequence(algorithm[1])[0][1] != _RSA_ENCRYPTION_OID:
+            raise UnsupportedSignature('certificate does not contain an RSA public key')
+        (tag, rsa_key, pos) = _der_read(public_key[1][1:], 0)     # Skip the unused bits of the BIT STRING
+        (modulus, exponent) = _der_sequence(rsa_key)
+        return (int(modulus[1].encode('hex'), 16), int(exponent[1].encode('hex'), 16))
+    except (ValueError, IndexError):
+        raise VerificationError('can not read the certificate')
+
+
+# Verify an RSASSA-PKCS1-v1_5 signature (RFC 3447 section 8.2.2)
+def _rsa_verify(certificate, hash_name, data, signature):
+    n = certificate.modulus
+    k = (n.bit_length() + 7) // 8
+    if len(signature) > k:
+        raise VerificationError('signature value has the wrong length')
+    s = int(signature.encode('hex') or '0', 16)
+    if s >= n:
+        raise VerificationError('signature value out of range')
+    em = ('%0*x' % (2 * k, pow(s, certificate.exponent, n))).decode('hex')
+    digest_info = _DIGEST_INFO[hash_name] + hashlib.new(hash_name, data).digest()
+    expected = '\x00\x01' + '\xff' * (k - len(digest_info) - 3) + '\x00' + digest_info
+    if em != expected:
+        raise VerificationError('signature value is not valid for the certificate')
+
+
+# Writes data to a hash
+class _HashWriter(object):
+
+    def __init__(self, hash):
+        self.hash = hash
+
+    def write(self, data):
+        self.hash.update(data)
+
+
+# Return (exclusive, with_comments, inclusive namespace prefixes) of a canonicalization element
+def _c14n_method(element):
+    algorithm = element.get('Algorithm')
+    if algorithm not in _C14N:
+        raise UnsupportedSignature("canonicalization '%s' is not supported" % algorithm)
+    (exclusive, with_comments) = _C14N[algorithm]
+    prefixes = None
+    inclusive = element.find('{%s}InclusiveNamespaces' % EC)
+    if exclusive and inclusive is not None:
+        prefixes = inclusive.get('PrefixList', '').split()
+    return (exclusive, with_comments, prefixes)
+
+
+def _child(element, name):
+    e = element.find('{%s}%s' % (DS, name))
+    if e is None:
+        raise VerificationError('%s missing in the signature' % name)
+    return e
+
+
+# Verify the enveloped signature on the root element of an XML file
+# Raises VerificationError (or UnsupportedSignature) when the signature is not valid
+# @param path file to verify
+# @param certificate Certificate to verify the signature with
+# @param tree optional parsed (lxml) tree of path. The signature is removed from the tree
+def verify(path, certificate, tree=None):
+    if tree is None:
+        parser = etree.XMLParser(huge_tree=True, resolve_entities=False, no_network=True)
+        tree = etree.parse(path, parser)
+    root = tree.getroot()
+
+    signatures = root.findall('{%s}Signature' % DS)
+    if len(signatures) != 1:
+        raise VerificationError('expected one signature on the root element, found %d' % len(signatures))
+    signature = signatures[0]
+    signed_info = _child(signature, 'SignedInfo')
+
+    references = signed_info.findall('{%s}Reference' % DS)
+    if len(references) != 1:
+        raise UnsupportedSignature('expected one reference in the signature, found %d' % len(references))
+    reference = references[0]
+    uri = reference.get('URI', '')
+    if uri != '' and (root.get('ID') is None or uri != '#' + root.get('ID')):
+        raise VerificationError("the signature does not reference the root element (URI '%s')" % uri)
+
+    transforms = reference.find('{%s}Transforms' % DS)
+    algorithms = [ t.get('Algorithm') for t in transforms ] if transforms is not None else []
+    if ENVELOPED not in algorithms:
+        raise UnsupportedSignature('the signature is not an enveloped signature')
+    c14n_transforms = [ t for t in transforms if t.get('Algorithm') != ENVELOPED ]
+    if len(c14n_transforms) > 1:
+        raise UnsupportedSignature('unsupported transforms: %s' % ', '.join(algorithms))
+    # The reference is canonicalized without comments, as a same document reference excludes comments
+    (exclusive, with_comments, prefixes) = _c14n_method(c14n_transforms[0]) if c14n_transforms \
+        else (False, False, None)
+
+    digest_algorithm = _child(reference, 'DigestMethod').get('Algorithm')
+    if digest_algorithm not in _DIGESTS:
+        raise UnsupportedSignature("digest '%s' is not supported" % digest_algorithm)
+    signature_algorithm = _child(signed_info, 'SignatureMethod').get('Algorithm')
+    if signature_algorithm not in _RSA_SIGNATURES:
+        raise UnsupportedSignature("signature algorithm '%s' is not supported" % signature_algorithm)
+    try:
+        digest_value = base64.b64decode(_child(reference, 'DigestValue').text or '')
+        signature_value = base64.b64decode(_child(signature, 'SignatureValue').text or '')
+    except TypeError:
+        raise VerificationError('invalid base64 value in the signature')
+
+    # Verify the signature of the SignedInfo
+    (si_exclusive, si_with_comments, si_prefixes) = _c14n_method(_child(signed_info, 'CanonicalizationMethod'))
+    c14n = etree.tostring(signed_info, method='c14n', exclusive=si_exclusive, with_comments=si_with_comments,
+                          inclusive_ns_prefixes=si_prefixes)
+    _rsa_verify(certificate, _RSA_SIGNATURES[signature_algorithm], c14n, signature_value)
+
+    # Verify the digest of the document without the signature (enveloped signature transform)
+    if signature.tail:
+        previous = signature.getprevious()
+        if previous is not None:
+            previous.tail = (previous.tail or '') + signature.tail
+        else:
+            root.text = (root.text or '') + signature.tail
+    root.remove(signature)
+    digest = hashlib.new(_DIGESTS[digest_algorithm])
+    tree.write_c14n(_HashWriter(digest), exclusive=exclusive, with_comments=False, inclusive_ns_prefixes=prefixes)
+    if digest.digest() != digest_value:
+        raise VerificationError('the digest of the document does not match the signature, the document was changed')
+
+
+# Remembers the successful verifications of files with a certificate
+class VerifiedCache(object):
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    # Verify the signature of a file, see verify()
+    # Nothing is done when the file was verified with the certificate before
+    # @param tree optional parsed (lxml) tree of path. The signature is removed from the tree
+    # @return True when the result was taken from the cache
+    def verify(self, path, certificate_path, tree=None):
+        certificate = Certificate(certificate_path)
+        entry = os.path.join(self.directory, '%s-%s' % (samlmd.file_sha1(path), certificate.fingerprint))
+        if os.path.isfile(entry):
+            return True
+        verify(path, certificate, tree)
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:
+                if not os.path.isdir(self.directory):
+                    raise
+        with AtomicFile(entry) as f:
+            f.write('%s\n' % os.path.abspath(path))
+        return False
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+# Return the (shared) VerifiedCache for a directory
+def get_cache(directory):
+    directory = os.path.abspath(directory)
+    with _caches_lock:
+        if directory not in _caches:
+            _caches[directory] = VerifiedCache(directory)
+        return _caches[directory]
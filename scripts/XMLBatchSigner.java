@@ -0,0 +1,209 @@
+/*
+ * Copyright 2015 GIP RENATER
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ *     http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+
+import java.io.BufferedReader;
+import java.io.File;
+import java.io.FileDescriptor;
+import java.io.FileInputStream;
+import java.io.FileOutputStream;
+import java.io.IOException;
+import java.io.InputStream;
+import java.io.InputStreamReader;
+import java.io.PrintStream;
+import java.nio.charset.StandardCharsets;
+import java.nio.file.Files;
+import java.nio.file.StandardCopyOption;
+import java.security.KeyStore;
+import java.security.PrivateKey;
+import java.security.cert.X509Certificate;
+import java.util.Arrays;
+import java.util.Collections;
+import java.util.HashMap;
+import java.util.List;
+import java.util.Map;
+
+import javax.xml.XMLConstants;
+import javax.xml.crypto.dsig.CanonicalizationMethod;
+import javax.xml.crypto.dsig.DigestMethod;
+import javax.xml.crypto.dsig.Reference;
+import javax.xml.crypto.dsig.SignatureMethod;
+import javax.xml.crypto.dsig.SignedInfo;
+import javax.xml.crypto.dsig.Transform;
+import javax.xml.crypto.dsig.XMLSignatureFactory;
+import javax.xml.crypto.dsig.dom.DOMSignContext;
+import javax.xml.crypto.dsig.keyinfo.KeyInfo;
+import javax.xml.crypto.dsig.keyinfo.KeyInfoFactory;
+import javax.xml.crypto.dsig.spec.C14NMethodParameterSpec;
+import javax.xml.crypto.dsig.spec.TransformParameterSpec;
+import javax.xml.parsers.DocumentBuilderFactory;
+import javax.xml.transform.Transformer;
+import javax.xml.transform.TransformerFactory;
+import javax.xml.transform.dom.DOMSource;
+import javax.xml.transform.stream.StreamResult;
+
+import org.w3c.dom.Document;
+import org.w3c.dom.Element;
+
+/**
+ * Long-lived XML signer used by the xmlsectool tool when XMLSECTOOL_BATCH is enabled.
+ *
+ * Signs XML files the way "xmlsectool.sh --sign" does by default: an enveloped signature as first child of the root
+ * element, referencing the ID attribute of the root element, with exclusive canonicalization and the signing
+ * certificate in the KeyInfo. Only the XML digital signature API of the JDK is used.
+ *
+ * Usage (Java 11 or later): java XMLBatchSigner.java --keystore FILE --key NAME [--digest SHA-256]
+ *
+ * The first line read from stdin is the key password. The keystore is loaded once, after which "READY" is written to
+ * stdout. Then each line read from stdin is a request "inFile TAB outFile". For each request one line is written to
+ * stdout: "OK", or "ERROR message" on failure. Other output is written to stderr. outFile is replaced only when it
+ * was signed completely.
+ */
+public class XMLBatchSigner {
+
+    private final PrivateKey key;
+    private final X509Certificate certificate;
+    private final String digestMethod;
+    private final String signatureMethod;
+    private final XMLSignatureFactory factory = XMLSignatureFactory.getInstance("DOM");
+
+    public XMLBatchSigner(PrivateKey key, X509Certificate certificate, String digest) {
+        this.key = key;
+        this.certificate = certificate;
+        boolean ec = "EC".equals(key.getAlgorithm());
+        switch (digest) {
+            case "SHA-1":
+                digestMethod = DigestMethod.SHA1;
+                signatureMethod = ec ? SignatureMethod.ECDSA_SHA1 : SignatureMethod.RSA_SHA1;
+                break;
+            case "SHA-512":
+                digestMethod = DigestMethod.SHA512;
+                signatureMethod = ec ? SignatureMethod.ECDSA_SHA512 : SignatureMethod.RSA_SHA512;
+                break;
+            default:
+                digestMethod = DigestMethod.SHA256;
+                signatureMethod = ec ? SignatureMethod.ECDSA_SHA256 : SignatureMethod.RSA_SHA256;
+        }
+    }
+
+    public void sign(File inFile, File outFile) throws Exception {
+        DocumentBuilderFactory dbf = DocumentBuilderFactory.newInstance();
+        dbf.setNamespaceAware(true);
+        dbf.setFeature(XMLConstants.FEATURE_SECURE_PROCESSING, true);
+        dbf.setFeature("http://apache.org/xml/features/disallow-doctype-decl", true);
+        Document doc;
+        try (InputStream in = new FileInputStream(inFile)) {
+            doc = dbf.newDocumentBuilder().parse(in);
+        }
+        doc.setXmlStandalone(true);
+
+        Element root = doc.getDocumentElement();
+        String uri = "";
+        if (root.hasAttributeNS(null, "ID")) {
+            root.setIdAttributeNS(null, "ID", true);
+            uri = "#" + root.getAttributeNS(null, "ID");
+        }
+
+        List<Transform> transforms = Arrays.asList(
+                factory.newTransform(Transform.ENVELOPED, (TransformParameterSpec) null),
+                factory.newTransform(CanonicalizationMethod.EXCLUSIVE, (TransformParameterSpec) null));
+        Reference reference = factory.newReference(uri, factory.newDigestMethod(digestMethod, null), transforms,
+                null, null);
+        SignedInfo signedInfo = factory.newSignedInfo(
+                factory.newCanonicalizationMethod(CanonicalizationMethod.EXCLUSIVE, (C14NMethodParameterSpec) null),
+                factory.newSignatureMethod(signatureMethod, null), Collections.singletonList(reference));
+        KeyInfoFactory kif = factory.getKeyInfoFactory();
+        KeyInfo keyInfo = kif.newKeyInfo(Collections.singletonList(
+                kif.newX509Data(Collections.singletonList(certificate))));
+
+        DOMSignContext context = new DOMSignContext(key, root, root.getFirstChild());
+        context.setDefaultNamespacePrefix("ds");
+        factory.newXMLSignature(signedInfo, keyInfo).sign(context);
+
+        Transformer transformer = TransformerFactory.newInstance().newTransformer();
+        // Written to a temporary file in the same directory that is synced and then renamed into place, as AtomicFile
+        // in urlcache.py does, so outFile is never partially written
+        File dir = outFile.getAbsoluteFile().getParentFile();
+        File tmpFile = File.createTempFile("." + outFile.getName() + ".", ".tmp", dir);
+        try {
+            try (FileOutputStream out = new FileOutputStream(tmpFile)) {
+                transformer.transform(new DOMSource(doc), new StreamResult(out));
+                out.flush();
+                out.getFD().sync();
+            }
+            Files.move(tmpFile.toPath(), outFile.toPath(), StandardCopyOption.REPLACE_EXISTING,
+                    StandardCopyOption.ATOMIC_MOVE);
+        } finally {
+            tmpFile.delete();   // Only exists when the signed document was not moved into place
+        }
+    }
+
+    private static KeyStore loadKeyStore(File file, char[] password) throws Exception {
+        KeyStore keyStore = KeyStore.getInstance(KeyStore.getDefaultType());
+        try (InputStream in = new FileInputStream(file)) {
+            keyStore.load(in, password);
+        } catch (IOException e) {
+            // The keystore password can differ from the key password, load without checking the integrity
+            keyStore = KeyStore.getInstance(KeyStore.getDefaultType());
+            try (InputStream in = new FileInputStream(file)) {
+                keyStore.load(in, null);
+            }
+        }
+        return keyStore;
+    }
+
+    public static void main(String[] args) throws Exception {
+        Map<String, String> options = new HashMap<>();
+        for (int i = 0; i + 1 < args.length; i += 2) {
+            options.put(args[i], args[i + 1]);
+        }
+        if (!options.containsKey("--keystore") || !options.containsKey("--key")) {
+            System.err.println("Usage: XMLBatchSigner --keystore FILE --key NAME [--digest SHA-256]");
+            System.exit(2);
+        }
+
+        // Replies are written to the original stdout, everything else to stderr
+        PrintStream replies = new PrintStream(new FileOutputStream(FileDescriptor.out), true, "UTF-8");
+        System.setOut(System.err);
+        BufferedReader requests = new BufferedReader(new InputStreamReader(System.in, StandardCharsets.UTF_8));
+
+        String password = requests.readLine();
+        char[] keyPassword = password == null ? new char[0] : password.toCharArray();
+        KeyStore keyStore = loadKeyStore(new File(options.get("--keystore")), keyPassword);
+        String alias = options.get("--key");
+        PrivateKey key = (PrivateKey) keyStore.getKey(alias, keyPassword);
+        if (key == null) {
+            System.err.println("XMLBatchSigner: no key '" + alias + "' in keystore " + options.get("--keystore"));
+            System.exit(1);
+        }
+        X509Certificate certificate = (X509Certificate) keyStore.getCertificate(alias);
+        XMLBatchSigner signer = new XMLBatchSigner(key, certificate, options.getOrDefault("--digest", "SHA-256"));
+        replies.println("READY");
+
+        String line;
+        while ((line = requests.readLine()) != null) {
+            String[] files = line.split("\t");
+            try {
+                if (files.length != 2) {
+                    throw new IllegalArgumentException("Expected 'inFile TAB outFile', got '" + line + "'");
+                }
+                signer.sign(new File(files[0]), new File(files[1]));
+                replies.println("OK");
+            } catch (Exception e) {
+                replies.println("ERROR " + String.valueOf(e).replace('\n', ' '));
+            }
+        }
+    }
+}
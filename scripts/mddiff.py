@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+
+# Copyright 2015 GIP RENATER
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Compare two SAML 2.0 metadata files entity by entity
+
+Usage: mddiff.py [--limit N] [--max-removed PERCENTAGE] <old metadata file> <new metadata file>
+
+Reports the added, removed and changed entities, and for changed entities which parts (e.g. IDPSSODescriptor,
+ContactPerson) changed. Requires lxml. See scons-tools/mddiff.py.
+
+Returns 0 when the files contain the same entities, 1 when they differ (or, with --max-removed, when more than
+PERCENTAGE percent of the entities of the old file was removed) and 2 on error.
+"""
+
+import os
+import sys
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scons-tools'))
+
+from lxml import etree
+import mddiff
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare two SAML 2.0 metadata files entity by entity')
+    parser.add_argument('--limit', type=int, default=30, help='Maximum number of entities to list (default 30)')
+    parser.add_argument('--max-removed', type=float, default=None, metavar='PERCENTAGE',
+                        help='Only fail when more than PERCENTAGE percent of the entities was removed')
+    parser.add_argument('old', help='Old metadata file')
+    parser.add_argument('new', help='New metadata file')
+    args = parser.parse_args()
+
+    try:
+        d = mddiff.diff(args.old, args.new)
+    except (etree.Error, IOError), e:
+        print >> sys.stderr, "%s: %s" % (os.path.basename(sys.argv[0]), e)
+        return 2
+
+    if d.same():
+        print "'%s' and '%s' contain the same entities" % (args.old, args.new)
+        return 0
+    print "'%s' and '%s' differ" % (args.old, args.new)
+    for line in d.report(args.limit):
+        print line
+    if args.max_removed is not None:
+        return 1 if d.removed_percentage() > args.max_removed else 0
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,119 @@
+# Copyright 2015 GIP RENATER
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Long-lived pyFF worker used by the pyff tool when PYFF_MODE=worker
+
+Usage: pyffworker.py [<cache size in MB>]
+
+Must be run using the python interpreter of the pyFF installation. Reads requests from stdin, one JSON object per line:
+{"pipeline": "<path to .fd file>", "directory": "<directory to run the pipeline in>", "loglevel": "INFO"}
+and writes one JSON object per line to stdout for each request:
+{"status": 0} on success, {"status": 1, "error": "<message>"} on failure
+Replies also have the CPU time used for the request ("user" and "sys", in seconds) and the peak resident set size of the
+worker ("maxrss", in KB).
+
+pyFF is imported once. Parsed (and schema validated and signature verified) metadata documents are cached by the SHA-1
+of their content, so a source file that is loaded by several pipelines is only parsed once. Pipelines change the
+documents they load, so each load gets its own copy of the cached document. The least recently used documents are
+removed from the cache when their sources are larger than the cache size (default 512 MB), so old versions of the
+sources are not kept by a long-running build. Each pipeline is run with its own MDRepository, in the directory of the
+request (the paths in the pipeline are relative to it).
+
+Output of pyFF on stdout is redirected to stderr.
+"""
+
+import sys
+import os
+import copy
+import json
+import hashlib
+import logging
+import resource
+import traceback
+from StringIO import StringIO
+from collections import OrderedDict
+
+DEFAULT_CACHE_SIZE = 512    # MB of metadata of which the parsed documents are kept
+
+
+def main():
+    # Keep stdout for the replies, send everything else (e.g. print statements in pyFF) to stderr
+    replies = os.fdopen(os.dup(sys.stdout.fileno()), 'w')
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    sys.stdout = sys.stderr
+
+    logging.basicConfig(level=logging.INFO)
+
+    from pyff.mdrepo import MDRepository
+    from pyff.pipes import plumbing
+    import pyff.index
+
+    # Cache the result of parse_metadata by content
+    cache_size = int(sys.argv[1] if len(sys.argv) > 1 else DEFAULT_CACHE_SIZE) * 1024 * 1024
+    parsed = OrderedDict()      # cache key => (size of the source, parsed document), least recently used first
+    parsed_size = [0]
+    parse_metadata = MDRepository.parse_metadata
+
+    def cached_parse_metadata(self, fn, key=None, base_url=None, fail_on_error=False, filter_invalid=True):
+        xml = fn.read()
+        cache_key = (hashlib.sha1(xml).hexdigest(), key, base_url, fail_on_error, filter_invalid)
+        if cache_key in parsed:
+            logging.debug("Using cached parse result for '%s'" % base_url)
+            parsed[cache_key] = entry = parsed.pop(cache_key)     # Now the most recently used
+            return copy.deepcopy(entry[1])
+        t = parse_metadata(self, StringIO(xml), key=key, base_url=base_url, fail_on_error=fail_on_error,
+                           filter_invalid=filter_invalid)
+        if t is None:
+            return None     # Do not cache failures
+        parsed[cache_key] = (len(xml), t)
+        parsed_size[0] += len(xml)
+        while parsed_size[0] > cache_size and parsed:
+            (size, _) = parsed.popitem(last=False)[1]
+            parsed_size[0] -= size
+        # The cached document is never handed out, the pipeline may change its copy
+        return copy.deepcopy(t)
+
+    MDRepository.parse_metadata = cached_parse_metadata
+
+    cwd = os.getcwd()
+    while True:
+        line = sys.stdin.readline()
+        if not line:
+            break
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        try:
+            request = json.loads(line)
+            logging.getLogger().setLevel(getattr(logging, request.get('loglevel', 'INFO').upper(), logging.INFO))
+            # A new index must be given, the default MemoryIndex instance is shared between MDRepository instances
+            md = MDRepository(index=pyff.index.MemoryIndex())
+            os.chdir(request.get('directory') or cwd)
+            try:
+                plumbing(request['pipeline']).process(md, state={'batch': True, 'stats': {}})
+            finally:
+                os.chdir(cwd)
+            reply = {'status': 0}
+        except Exception, ex:
+            if logging.getLogger().isEnabledFor(logging.DEBUG):
+                traceback.print_exc()
+            logging.error(ex)
+            reply = {'status': 1, 'error': str(ex)}
+        usage_end = resource.getrusage(resource.RUSAGE_SELF)
+        reply.update(user=usage_end.ru_utime - usage.ru_utime, sys=usage_end.ru_stime - usage.ru_stime,
+                     maxrss=usage_end.ru_maxrss)
+        replies.write(json.dumps(reply) + '\n')
+        replies.flush()
+
+
+if __name__ == "__main__":
+    main()
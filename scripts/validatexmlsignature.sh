@@ -30,8 +30,8 @@ function error_exit
 {
     echo "$PROGNAME: $1" 1>&2
 
-    if [ -f "$TEMP_FD" ]; then
-        rm $TEMP_FD
+    if [ -n "$WORK_DIR" ]; then
+        rm -rf "$WORK_DIR"
     fi
     exit 1
 } 
@@ -46,18 +46,32 @@ if [ -z "$PYFF" ]; then
     error_exit "PYFF not set"
 fi 
 
-TEMP_FD=`mktemp ${TMPDIR:-/tmp}/scons-fd.XXXXXXXXX`
+# Absolute path of a file, pyff is run in another directory
+function abspath
+{
+    case "$1" in
+        /*) echo "$1" ;;
+        *) echo "`pwd`/$1" ;;
+    esac
+}
+
+# pyff is run in a directory of its own, so parallel runs do not share the .cache directory pyff makes
+WORK_DIR=`mktemp -d ${TMPDIR:-/tmp}/scons-fd.XXXXXXXXX`
 if [ $? -ne 0 ]; then
     error_exit "mktemp failed"
 fi
+TEMP_FD=$WORK_DIR/verify.fd
 
 # Write .fd file 
 cat << EOF > $TEMP_FD
 - load:
-   - $2 as dummy verify $1
+   - `abspath "$2"` as dummy verify `abspath "$1"`
 EOF
 
-echo `$PYFF $TEMP_FD`
+case "$PYFF" in
+    */*) PYFF=`abspath "$PYFF"` ;;
+esac
+(cd "$WORK_DIR" && $PYFF $TEMP_FD)
 res=$?
 
 if [ $res -ne 0 ]; then
@@ -65,6 +79,6 @@ if [ $res -ne 0 ]; then
     cat $TEMP_FD
 fi
 
-rm $TEMP_FD
+rm -rf "$WORK_DIR"
 
 exit $res
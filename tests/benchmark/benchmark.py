@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+
+# Copyright 2015 GIP RENATER
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Benchmark of a reference metadata pipeline
+
+Usage: benchmark.py [options] [-- VARIABLE=value ...]
+
+For each requested number of entities:
+- synthetic metadata is generated (see mdgen.py): a federation feed with 10% and an interfederation feed with 90% of
+  the entities;
+- the feeds are served by an HTTP server on localhost;
+- the reference pipeline (SConscript.download and SConscript in this directory) is built in a project directory that
+  uses the SConstruct and tools of this repository: download the feeds, select and merge (pyff or mdselect), remove
+  entities, normalize, test and (with --sign) sign;
+- the build is run with --perf-trace, and once more to measure a build in which nothing changed.
+The wall time, CPU time, peak memory and throughput of each stage are reported.
+
+Variables after "--" are passed to scons, e.g. PYFF=/opt/pyff/bin/pyff or the XMLSECTOOLSH* variables for signing.
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import socket
+import shutil
+import argparse
+import subprocess
+
+import mdgen
+
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPOSITORY_DIR = os.path.dirname(os.path.dirname(BENCHMARK_DIR))
+
+FEEDS = (('federation.xml', 'f', 0.1), ('interfederation.xml', 'g', 0.9))
+
+# Stages of the reference pipeline, found by the name of the target of an action
+STAGES = (
+    ('sign', 'signed.xml'),
+    ('test', 'tested.xml'),
+    ('normalize', 'normalized.xml'),
+    ('select', 'selected.xml'),
+)
+
+_entity_re = re.compile(r'<(?:[\w.-]+:)?EntityDescriptor[\s>]')
+
+
+# Return the number of EntityDescriptor elements in a file
+def count_entities(path):
+    n = 0
+    with open(path, 'rb') as f:
+        for line in f:
+            n += len(_entity_re.findall(line))
+    return n
+
+
+# Start an HTTP server for directory on a free port
+# @return (process, base URL)
+def start_server(directory):
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    with open(os.devnull, 'w') as devnull:
+        server = subprocess.Popen([sys.executable, '-m', 'SimpleHTTPServer', str(port)], cwd=directory,
+                                  stdout=devnull, stderr=devnull)
+    for i in range(50):
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            break
+        except socket.error:
+            time.sleep(0.1)
+    return server, 'http://127.0.0.1:%d/' % port
+
+
+# Make a project directory that uses the SConstruct and tools of this repository and the reference pipeline
+def make_project(directory, settings):
+    if os.path.exists(directory):
+        shutil.rmtree(directory)
+    os.makedirs(directory)
+    for name in ('SConstruct', 'scons-tools', 'scripts', 'check_validity.xsl'):
+        os.symlink(os.path.join(REPOSITORY_DIR, name), os.path.join(directory, name))
+    for name in ('SConscript', 'SConscript.download'):
+        shutil.copy(os.path.join(BENCHMARK_DIR, name), directory)
+    with open(os.path.join(directory, 'benchmark.json'), 'w') as f:
+        json.dump(settings, f, indent=1)
+
+
+# Run scons in the project directory
+# @return wall time
+def run_scons(args, directory, log):
+    start = time.time()
+    with open(log, 'a') as f:
+        status = subprocess.call(args, cwd=directory, stdout=f, stderr=subprocess.STDOUT)
+    if status:
+        raise RuntimeError('scons failed with status %d, see %s' % (status, log))
+    return time.time() - start
+
+
+# Sum the actions of a performance trace per stage
+def stages(trace, download_dir):
+    result = {}
+    for e in trace['traceEvents']:
+        r = e['args']
+        if r['kind'] in ('LinkFunc', 'UnlinkFunc', 'MkdirFunc'):
+            continue
+        name = e['name']
+        stage = 'download' if name.startswith(download_dir) else None
+        for (s, target) in STAGES:
+            if stage is None and target in name:
+                stage = s
+        stage = stage or 'other'
+        t = result.setdefault(stage, {'actions': 0, 'wall': 0.0, 'cpu': 0.0, 'maxrss_kb': 0, 'input': 0,
+                                      'output': 0})
+        t['actions'] += 1
+        t['wall'] += r['wall']
+        t['cpu'] += r['user'] + r['sys'] + r['child_user'] + r['child_sys']
+        t['maxrss_kb'] = max(t['maxrss_kb'], r['child_maxrss'])
+        t['input'] = max(t['input'], r['input'])
+        t['output'] = max(t['output'], r['output'])
+    return result
+
+
+# Run the benchmark for one number of entities
+# @return dict with the results
+def run(args, entities):
+    work = os.path.join(os.path.abspath(args.work_dir), '%s-%d' % (args.engine, entities))
+    www = os.path.join(work, 'www')
+    project = os.path.join(work, 'project')
+    build = os.path.join(work, 'build')
+    log = os.path.join(work, 'scons.log')
+    if os.path.exists(work):
+        shutil.rmtree(work)
+    os.makedirs(www)
+
+    start = time.time()
+    for (name, prefix, fraction) in FEEDS:
+        with open(os.path.join(www, name), 'wb') as f:
+            mdgen.generate(f, int(entities * fraction), args.idp_ratio, args.cert_bytes, args.extension_bytes,
+                           prefix=prefix, seed=args.seed)
+    generate_time = time.time() - start
+
+    server, base_url = start_server(www)
+    try:
+        settings = {
+            'base_url': base_url,
+            'feeds': [ name for (name, prefix, fraction) in FEEDS ],
+            'engine': args.engine,
+            'sign': args.sign,
+            # Remove the first 10 IdPs of the interfederation feed
+            'remove': first_idps(os.path.join(www, 'interfederation.xml'), 10),
+        }
+        make_project(project, settings)
+        scons = args.scons.split() + ['--build-dir=' + build, '-j', str(args.jobs)] + args.variables
+        wall = run_scons(scons + ['--perf-trace'], project, log)
+        noop = run_scons(scons, project, log)
+    finally:
+        server.terminate()
+        server.wait()
+
+    with open(os.path.join(build, 'perftrace.json')) as f:
+        trace = json.load(f)
+    result = {
+        'engine': args.engine,
+        'entities': entities,
+        'generate': generate_time,
+        'wall': wall,
+        'noop': noop,
+        'scons_maxrss_kb': trace['otherData']['maxrss_kb'],
+        'input_bytes': sum( os.path.getsize(os.path.join(www, name)) for (name, prefix, fraction) in FEEDS ),
+        'selected_entities': count_entities(os.path.join(build, 'build', 'selected.xml')),
+        'stages': stages(trace, os.path.join(build, 'download')),
+    }
+    if not args.keep:
+        shutil.rmtree(work)
+    return result
+
+
+# Return the entityIDs of the first n IdPs in a generated file
+def first_idps(path, n):
+    idps = []
+    with open(path, 'rb') as f:
+        for line in f:
+            m = re.search(r'entityID="(https://[\w.-]+/idp/shibboleth)"', line)
+            if m:
+                idps.append(m.group(1))
+                if len(idps) == n:
+                    break
+    return idps
+
+
+# Print the results as a table
+def report(results):
+    print '%-10s %8s %-10s %8s %8s %10s %10s %12s %10s' % \
+          ('engine', 'entities', 'stage', 'actions', 'wall (s)', 'cpu (s)', 'rss (MB)', 'entities/s', 'MB/s')
+    for r in results:
+        for stage in ('download', 'select', 'normalize', 'test', 'sign', 'other'):
+            t = r['stages'].get(stage)
+            if not t:
+                continue
+            entities = r['entities'] if stage in ('download', 'select') else r['selected_entities']
+            size = r['input_bytes'] if stage in ('download', 'select') else t['input']
+            print '%-10s %8d %-10s %8d %8.2f %10.2f %10d %12.0f %10.1f' % \
+                  (r['engine'], r['entities'], stage, t['actions'], t['wall'], t['cpu'], t['maxrss_kb'] / 1024,
+                   entities / t['wall'] if t['wall'] else 0, size / 1048576.0 / t['wall'] if t['wall'] else 0)
+        print '%-10s %8d %-10s %8s %8.2f %10s %10d   (no-op build %.2fs, %d entities selected)' % \
+              (r['engine'], r['entities'], 'build', '', r['wall'], '', r['scons_maxrss_kb'] / 1024, r['noop'],
+               r['selected_entities'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of a reference metadata pipeline')
+    parser.add_argument('--entities', default='1000',
+                        help='Comma separated list of the numbers of entities, e.g. 1000,10000,50000 (default 1000)')
+    parser.add_argument('--idp-ratio', type=float, default=0.3, help='Fraction of the entities that is an IdP (default 0.3)')
+    parser.add_argument('--cert-bytes', type=int, default=1200, help='Size of a certificate in bytes (default 1200)')
+    parser.add_argument('--extension-bytes', type=int, default=400,
+                        help='Size of the EntityAttributes of an entity in bytes (default 400)')
+    parser.add_argument('--seed', type=int, default=1, help='Seed for generating the metadata (default 1)')
+    parser.add_argument('--engine', choices=('pyff', 'mdstream'), default='pyff',
+                        help='Select and normalize using pyff or the mdstream tool (default pyff)')
+    parser.add_argument('--sign', action='store_true', help='Sign the output, requires the XMLSECTOOLSH variables')
+    parser.add_argument('--jobs', type=int, default=1, help='Number of parallel jobs of scons (default 1)')
+    parser.add_argument('--scons', default='scons', help='Command to run scons (default scons)')
+    parser.add_argument('--work-dir', default='benchmark-work', help='Directory for the generated files and builds')
+    parser.add_argument('--keep', action='store_true', help='Keep the generated files and builds')
+    parser.add_argument('--json', help='Also write the results to this file, e.g. to compare builds')
+    parser.add_argument('variables', nargs='*', help='VARIABLE=value passed to scons')
+    args = parser.parse_args()
+
+    results = []
+    for entities in [ int(n) for n in args.entities.split(',') ]:
+        try:
+            results.append(run(args, entities))
+        except (RuntimeError, IOError, OSError), e:
+            print >> sys.stderr, "benchmark: %s" % e
+            return 1
+    report(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=1)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
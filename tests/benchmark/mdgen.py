@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+
+# Copyright 2015 GIP RENATER
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Generate synthetic SAML 2.0 federation metadata for benchmarking
+
+Usage: mdgen.py [options] <output file>
+
+Writes an EntitiesDescriptor with the requested number of EntityDescriptor elements, a mix of IdPs and SPs. Each
+entity has a RegistrationInfo (one of --federations registration authorities), EntityAttributes, an mdui:UIInfo, a
+signing certificate, endpoints, an Organization and a ContactPerson. The certificates are random data of the size of a
+real certificate, they are not valid certificates.
+
+The output only depends on the options: the same options (and --seed) give the same file.
+"""
+
+import sys
+import random
+import base64
+import argparse
+from xml.sax.saxutils import escape, quoteattr
+
+
+HEADER = '''<?xml version="1.0" encoding="UTF-8"?>
+<md:EntitiesDescriptor xmlns:md="urn:oasis:names:tc:SAML:2.0:metadata" xmlns:ds="http://www.w3.org/2000/09/xmldsig#" \
+xmlns:mdrpi="urn:oasis:names:tc:SAML:metadata:rpi" xmlns:mdui="urn:oasis:names:tc:SAML:metadata:ui" \
+xmlns:mdattr="urn:oasis:names:tc:SAML:metadata:attribute" xmlns:saml="urn:oasis:names:tc:SAML:2.0:assertion" \
+xmlns:shibmd="urn:mace:shibboleth:metadata:1.0" Name=%(name)s validUntil="2099-01-01T00:00:00Z">
+'''
+
+FOOTER = '</md:EntitiesDescriptor>\n'
+
+ENTITY = '''  <!-- %(kind)s %(n)d -->
+  <md:EntityDescriptor entityID=%(entity_id)s>
+    <md:Extensions>
+      <mdrpi:RegistrationInfo registrationAuthority=%(authority)s registrationInstant="2015-01-01T00:00:00Z"/>
+      <mdattr:EntityAttributes>
+%(attributes)s      </mdattr:EntityAttributes>
+    </md:Extensions>
+    <md:%(role)s protocolSupportEnumeration="urn:oasis:names:tc:SAML:2.0:protocol">
+      <md:Extensions>
+%(role_extensions)s        <mdui:UIInfo>
+          <mdui:DisplayName xml:lang="en">%(display_name)s</mdui:DisplayName>
+          <mdui:Description xml:lang="en">Synthetic %(kind)s number %(n)d for benchmarking</mdui:Description>
+        </mdui:UIInfo>
+      </md:Extensions>
+      <md:KeyDescriptor use="signing">
+        <ds:KeyInfo>
+          <ds:X509Data>
+            <ds:X509Certificate>
+%(certificate)s
+            </ds:X509Certificate>
+          </ds:X509Data>
+        </ds:KeyInfo>
+      </md:KeyDescriptor>
+%(endpoints)s    </md:%(role)s>
+    <md:Organization>
+      <md:OrganizationName xml:lang="en">Organization %(n)d</md:OrganizationName>
+      <md:OrganizationDisplayName xml:lang="en">Organization %(n)d</md:OrganizationDisplayName>
+      <md:OrganizationURL xml:lang="en">https://www.%(host)s/</md:OrganizationURL>
+    </md:Organization>
+    <md:ContactPerson contactType="technical">
+      <md:GivenName>Support</md:GivenName>
+      <md:EmailAddress>mailto:support@%(host)s</md:EmailAddress>
+    </md:ContactPerson>
+  </md:EntityDescriptor>
+'''
+
+IDP_ENDPOINTS = '''      <md:SingleSignOnService Binding="urn:oasis:names:tc:SAML:2.0:bindings:HTTP-Redirect" Location="https://%(host)s/idp/profile/SAML2/Redirect/SSO"/>
+      <md:SingleSignOnService Binding="urn:oasis:names:tc:SAML:2.0:bindings:HTTP-POST" Location="https://%(host)s/idp/profile/SAML2/POST/SSO"/>
+'''
+
+IDP_EXTENSIONS = '''        <shibmd:Scope regexp="false">%(host)s</shibmd:Scope>
+'''
+
+SP_ENDPOINTS = '''      <md:AssertionConsumerService Binding="urn:oasis:names:tc:SAML:2.0:bindings:HTTP-POST" Location="https://%(host)s/Shibboleth.sso/SAML2/POST" index="1"/>
+'''
+
+ATTRIBUTE = '''        <saml:Attribute Name="http://macedir.org/entity-category" NameFormat="urn:oasis:names:tc:SAML:2.0:attrname-format:uri">
+%s        </saml:Attribute>
+'''
+
+ATTRIBUTE_VALUE = '          <saml:AttributeValue>%s</saml:AttributeValue>\n'
+
+
+# Return a random base64 encoded "certificate" of size bytes, in lines of 64 characters
+def certificate(rnd, size):
+    data = base64.b64encode(('%0*x' % (size * 2, rnd.getrandbits(size * 8))).decode('hex'))
+    return '\n'.join( data[i:i + 64] for i in xrange(0, len(data), 64) )
+
+
+# Return EntityAttributes content of about size bytes
+# The values are distinct, as in real metadata (pyFF does not index an attribute with duplicate values)
+def attributes(rnd, size):
+    values = []
+    length = 0
+    used = set()
+    while length < size or not values:
+        n = rnd.randint(0, 1000)
+        if n in used:
+            continue
+        used.add(n)
+        value = ATTRIBUTE_VALUE % escape('http://example.org/category/%d' % n)
+        values.append(value)
+        length += len(value)
+    return ATTRIBUTE % ''.join(values)
+
+
+# Write the metadata
+# @param out file object
+# @param entities number of entities
+# @param idp_ratio fraction of the entities that is an IdP
+# @param cert_bytes size of a (DER) certificate in bytes
+# @param extension_bytes size of the EntityAttributes of an entity in bytes
+# @param federations number of registration authorities
+# @param prefix prefix of the host names of the entities, so different files can have different entities
+# @param seed seed of the random generator
+def generate(out, entities, idp_ratio=0.3, cert_bytes=1200, extension_bytes=400, federations=20, prefix='e', seed=1):
+    rnd = random.Random(seed)
+    out.write(HEADER % {'name': quoteattr('urn:example:benchmark:%s' % prefix)})
+    for n in xrange(entities):
+        idp = rnd.random() < idp_ratio
+        host = '%s%d.%s.example.org' % (prefix, n, 'idp' if idp else 'sp')
+        values = {
+            'n': n,
+            'kind': 'IdP' if idp else 'SP',
+            'role': 'IDPSSODescriptor' if idp else 'SPSSODescriptor',
+            'host': host,
+            'entity_id': quoteattr('https://%s/%s' % (host, 'idp/shibboleth' if idp else 'shibboleth')),
+            'authority': quoteattr('https://federation%d.example.org/' % rnd.randint(1, federations)),
+            'attributes': attributes(rnd, extension_bytes),
+            'role_extensions': IDP_EXTENSIONS % {'host': host} if idp else '',
+            'display_name': escape('Synthetic %s %d' % ('IdP' if idp else 'SP', n)),
+            'certificate': certificate(rnd, cert_bytes),
+        }
+        values['endpoints'] = (IDP_ENDPOINTS if idp else SP_ENDPOINTS) % values
+        out.write(ENTITY % values)
+    out.write(FOOTER)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate synthetic SAML 2.0 federation metadata')
+    parser.add_argument('--entities', type=int, default=1000, help='Number of entities (default 1000)')
+    parser.add_argument('--idp-ratio', type=float, default=0.3, help='Fraction of the entities that is an IdP (default 0.3)')
+    parser.add_argument('--cert-bytes', type=int, default=1200, help='Size of a certificate in bytes (default 1200)')
+    parser.add_argument('--extension-bytes', type=int, default=400,
+                        help='Size of the EntityAttributes of an entity in bytes (default 400)')
+    parser.add_argument('--federations', type=int, default=20, help='Number of registration authorities (default 20)')
+    parser.add_argument('--prefix', default='e', help='Prefix of the host names of the entities (default "e")')
+    parser.add_argument('--seed', type=int, default=1, help='Seed of the random generator (default 1)')
+    parser.add_argument('output', help='Output file, "-" for stdout')
+    args = parser.parse_args()
+
+    out = sys.stdout if args.output == '-' else open(args.output, 'wb')
+    try:
+        generate(out, args.entities, args.idp_ratio, args.cert_bytes, args.extension_bytes, args.federations,
+                 args.prefix, args.seed)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -51,7 +51,7 @@ if [ ! -f "$2" ]; then
 fi
 
 # Create two temp files
-tmp1=`mktemp mdcompare.XXXX` && tmp2=`mktemp mdcompare.XXXX`
+tmp1=`mktemp ${TMPDIR:-/tmp}/mdcompare.XXXXXXXX` && tmp2=`mktemp ${TMPDIR:-/tmp}/mdcompare.XXXXXXXX`
 if [ $? -ne "0" ]; then
     error_exit "Error creating temp files"
 fi
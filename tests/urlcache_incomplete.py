@@ -0,0 +1,107 @@
+# Copyright 2015 GIP RENATER
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Verify that urlcache does not keep a download of which the connection was closed before the whole body arrived
+
+Starts a local HTTP server that sends less data than it declares in Content-Length, and a gzip'ed body that is cut
+off, and checks that DownloadCache.fetch() raises DownloadError and keeps the previously downloaded body.
+
+Usage: python tests/urlcache_incomplete.py
+"""
+
+import os
+import sys
+import gzip
+import shutil
+import tempfile
+import threading
+import BaseHTTPServer
+from StringIO import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scons-tools'))
+import urlcache
+
+
+BODY = ''.join( '<line number="%d"/>\n' % i for i in range(20000) )
+
+def gzipped(data):
+    s = StringIO()
+    g = gzip.GzipFile(fileobj=s, mode='wb')
+    g.write(data)
+    g.close()
+    return s.getvalue()
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    broken = False      # When True the responses are cut off
+
+    def do_GET(self):
+        gzip_body = self.path.startswith('/gzip')
+        data = gzipped(BODY) if gzip_body else BODY
+        length = len(data)
+        if Handler.broken:
+            data = data[:len(data) // 2]
+            if gzip_body:
+                length = len(data)  # A correct Content-Length, the gzip stream itself is incomplete
+        self.send_response(200)
+        if gzip_body:
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(length))
+        self.end_headers()
+        self.wfile.write(data)
+        if Handler.broken:
+            self.close_connection = 1
+
+    def log_message(self, *args):
+        pass
+
+
+def main():
+    server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    directory = tempfile.mkdtemp()
+    failures = 0
+    try:
+        for path in ('/plain', '/gzip'):
+            url = 'http://127.0.0.1:%d%s' % (server.server_address[1], path)
+            Handler.broken = False
+            record = dict(urlcache.DownloadCache(directory).fetch(url))
+            del record['modified']
+            Handler.broken = True
+            try:
+                urlcache.DownloadCache(directory).fetch(url)
+                print "FAILED %s: incomplete body was accepted" % path
+                failures += 1
+                continue
+            except urlcache.DownloadError, e:
+                print "%s: %s" % (path, e)
+            cache = urlcache.DownloadCache(directory)
+            with open(cache._path(url, '.body'), 'rb') as f:
+                kept = f.read()
+            if kept != BODY or cache.load(url) != record:
+                print "FAILED %s: the previous download was not kept" % path
+                failures += 1
+    finally:
+        server.shutdown()
+        shutil.rmtree(directory)
+    print "FAILED" if failures else "OK"
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())